@@ -1,3 +1,8 @@
 from django.contrib import admin
+from .models import Document, Invoice, ExtractionJob, ExtractionQuota
 
 # Register your models here.
+admin.site.register(Document)
+admin.site.register(Invoice)
+admin.site.register(ExtractionJob)
+admin.site.register(ExtractionQuota)
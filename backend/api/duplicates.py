@@ -0,0 +1,130 @@
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db.models import Q
+from django.utils import timezone
+from module_data_extraction.dedupe import (
+    PHASH_BANDS,
+    file_perceptual_hash,
+    file_text_fingerprint,
+    hash_bands,
+    hamming_distance,
+)
+from module_data_extraction.telemetry import incr
+from .jobs import enqueue_job
+from .models import Document, ExtractionJob
+
+
+def fingerprint_document(document):
+    """Store the first-page perceptual hash, its lookup bands and the text-layer digest on a document."""
+    path = default_storage.path(document.file_path)
+    value = file_perceptual_hash(path)
+    if value is None:
+        return document
+    document.perceptual_hash = f"{value:064x}"
+    for band, band_value in enumerate(hash_bands(value)):
+        setattr(document, f"phash_band_{band}", band_value)
+    document.text_fingerprint = file_text_fingerprint(path)
+    document.save(
+        update_fields=["perceptual_hash", "text_fingerprint"] + [f"phash_band_{band}" for band in range(PHASH_BANDS)]
+    )
+    return document
+
+
+def same_text(document, original):
+    """True when both documents have a text layer and it is the same."""
+    return bool(document.text_fingerprint) and document.text_fingerprint == original.text_fingerprint
+
+
+def find_duplicate(document):
+    """
+    Return (original, kind) for an earlier document of the same owner with identical
+    bytes or a perceptual hash within EXTRACTION_NEAR_DUPLICATE_DISTANCE bits, else (None, "").
+    Both lookups are equality matches on (owner, ...) indexes. Documents whose text layers
+    differ are never near duplicates, however alike the pages look, so they are left out of
+    the query; invoices from one template share bands, so at most
+    EXTRACTION_NEAR_DUPLICATE_CANDIDATES of the most recent look-alikes are compared.
+    """
+    earlier = Document.objects.filter(owner=document.owner_id).exclude(pk=document.pk)
+
+    if document.content_hash:
+        original = earlier.filter(content_hash=document.content_hash).order_by("pk").first()
+        if original:
+            return original.duplicate_of or original, Document.DUPLICATE_EXACT
+
+    # An all-white or all-black first page hashes to 0 and says nothing about the content
+    if not document.perceptual_hash or int(document.perceptual_hash, 16) == 0:
+        return None, ""
+    value = int(document.perceptual_hash, 16)
+    bands = Q()
+    for band in range(PHASH_BANDS):
+        bands |= Q(**{f"phash_band_{band}": getattr(document, f"phash_band_{band}")})
+    candidates = earlier.filter(bands)
+    if document.text_fingerprint:
+        candidates = candidates.filter(Q(text_fingerprint=document.text_fingerprint) | Q(text_fingerprint=""))
+    candidates = candidates.order_by("-pk").values_list("pk", "perceptual_hash", "duplicate_of_id")
+    best = None
+    for pk, perceptual_hash, duplicate_of_id in candidates[: settings.EXTRACTION_NEAR_DUPLICATE_CANDIDATES]:
+        distance = hamming_distance(value, int(perceptual_hash, 16))
+        if distance <= settings.EXTRACTION_NEAR_DUPLICATE_DISTANCE and (best is None or distance < best[0]):
+            best = (distance, duplicate_of_id or pk)
+    if best is None:
+        return None, ""
+    return Document.objects.get(pk=best[1]), Document.DUPLICATE_NEAR
+
+
+def mark_duplicate(document):
+    """Flag a fingerprinted document as a copy of an earlier one. Returns find_duplicate's (original, kind)."""
+    original, kind = find_duplicate(document)
+    if original is not None:
+        document.duplicate_of = original
+        document.duplicate_kind = kind
+        document.page_count = original.page_count or document.page_count
+        document.save(update_fields=["duplicate_of", "duplicate_kind", "page_count"])
+        incr("duplicates_total", kind=kind)
+    return original, kind
+
+
+def submit_document(owner, document, engine, fingerprinted=False):
+    """
+    Queue a document for extraction unless it duplicates an earlier upload.
+    Exact duplicates (and, when EXTRACTION_REUSE_NEAR_DUPLICATES is on, near duplicates
+    whose text layer matches the original's) get an already-finished job carrying the
+    original's result; other near duplicates are flagged and extracted as usual.
+    Pass fingerprinted=True when fingerprint_document has already run. Invoices stay on the original
+    document, so a reused result does not add rows to the invoice list.
+    """
+    if not fingerprinted:
+        fingerprint_document(document)
+    original, kind = mark_duplicate(document)
+    if original is None:
+        return enqueue_job(
+            owner, document.file_path, engine, content_hash=document.content_hash, document=document,
+            pages=document.page_count or 1,
+        )
+
+    previous = None
+    # Looking alike is not enough to hand over another file's data; the text has to match as well
+    if kind == Document.DUPLICATE_EXACT or (settings.EXTRACTION_REUSE_NEAR_DUPLICATES and same_text(document, original)):
+        previous = (
+            ExtractionJob.objects.filter(document=original, engine=engine, status=ExtractionJob.STATUS_DONE)
+            .order_by("-pk")
+            .first()
+        )
+    if previous is None:
+        return enqueue_job(
+            owner, document.file_path, engine, content_hash=document.content_hash, document=document,
+            pages=document.page_count or 1,
+        )
+
+    now = timezone.now()
+    return ExtractionJob.objects.create(
+        owner=owner,
+        document=document,
+        file_path=document.file_path,
+        content_hash=document.content_hash,
+        engine=engine,
+        status=ExtractionJob.STATUS_DONE,
+        result=previous.result,
+        started_at=now,
+        finished_at=now,
+    )
@@ -0,0 +1,56 @@
+"""
+Extraction engines runnable inside worker processes.
+
+Nothing in this module touches the Django ORM, so it can be executed in a
+process pool without the child having to set up Django. Extractors come
+from the process-wide registry, so each pool worker builds them (and their
+API clients) on its first job and reuses them for the rest.
+"""
+from module_data_extraction import documents, progress, registry
+from module_data_extraction.telemetry import telemetry, span
+
+
+def _run_ocr(file_path):
+    return registry.get("ocr").process_file(file_path)
+
+
+def _run_vision(file_path):
+    return registry.get("vision").extract_key_info(file_path)
+
+
+def _run_document_ai(file_path):
+    result = registry.get("documentai").process_invoice(file_path)
+    if result.get("extraction_status") == "error":
+        raise RuntimeError(result.get("error_message") or "Document AI extraction failed")
+    return result
+
+
+def _run_auto(file_path):
+    return registry.get("router").extract(file_path)
+
+
+ENGINE_RUNNERS = {
+    "ocr": _run_ocr,
+    "vision": _run_vision,
+    "documentai": _run_document_ai,
+    "auto": _run_auto,
+}
+
+
+def run_engine(engine, file_path, job_id=None):
+    """
+    Run the named extraction engine on a file and return its JSON-serialisable result.
+    With a job_id, per-page progress events are written for the job's event stream.
+    """
+    try:
+        runner = ENGINE_RUNNERS[engine]
+    except KeyError:
+        raise ValueError(f"Unknown extraction engine: {engine}")
+    try:
+        # Every engine the runner touches (and the result cache) shares one mapping and hash of the file
+        with documents.sharing(file_path), progress.reporting(job_id), span("extract", engine=engine):
+            progress.emit("started", engine=engine)
+            return runner(file_path)
+    finally:
+        # Runs in a pool worker, so publish this process's metrics for the web process to collect
+        telemetry.flush()
@@ -0,0 +1,325 @@
+"""
+Bulk ingestion of a directory tree or ZIP archive, for backfills.
+
+Files are hashed in this process and skipped if their SHA-256 was already
+extracted in the run (or, when writing to the database, already stored for
+the owner). A copy of a file that is still being extracted waits for it: it
+is a duplicate once the extraction succeeds, and gets an attempt of its own
+if it fails. The rest run through ``run_engine`` on a process pool with a
+bounded number of files in flight. Each result is written as soon as it arrives,
+either to the database (Document, ExtractionJob, Invoice rows, as if the file
+had been uploaded) or as a line of JSON. A checkpoint file records every
+source entry that has been settled. Re-running the same command skips those
+entries and carries on where an interrupted run stopped.
+
+ZIP members are unpacked one at a time into a staging directory just before
+they are dispatched, and removed once their result is written.
+"""
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from dataclasses import dataclass
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.utils import timezone
+from module_data_extraction.documents import document_kind
+from module_data_extraction.rasterizer import file_page_count
+from module_data_extraction.telemetry import logger, incr
+from .duplicates import fingerprint_document, mark_duplicate
+from .engines import run_engine
+from .jobs import complete_job, fail_job
+from .models import Document, ExtractionJob
+from .records import create_document
+
+HASH_BLOCK_SIZE = 1024 * 1024
+STATUS_DONE = "done"
+STATUS_FAILED = "failed"
+STATUS_DUPLICATE = "duplicate"
+STATUS_SKIPPED = "skipped"
+
+
+@dataclass
+class Entry:
+    """One file of the source: key is stable across runs and names it in the checkpoint"""
+    key: str
+    name: str
+    path: str = ""
+    member: zipfile.ZipInfo = None
+    sha256: str = ""
+    size: int = 0
+    staged: bool = False
+    started_at: object = None
+
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def iter_entries(source):
+    """Yield an Entry per file under a directory, or per member of a ZIP archive, in a stable order"""
+    if os.path.isdir(source):
+        for root, dirs, names in os.walk(source):
+            dirs.sort()
+            for name in sorted(names):
+                path = os.path.join(root, name)
+                yield Entry(key=os.path.relpath(path, source), name=name, path=path)
+    elif zipfile.is_zipfile(source):
+        with zipfile.ZipFile(source) as archive:
+            for member in archive.infolist():
+                if not member.is_dir():
+                    yield Entry(key=member.filename, name=os.path.basename(member.filename), member=member)
+    else:
+        raise ValueError(f"{source} is neither a directory nor a ZIP archive")
+
+
+class Checkpoint:
+    """Append-only JSON lines of settled entries; loading it tells a resumed run what to skip"""
+
+    def __init__(self, path):
+        self.path = path
+        self.settled = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    # A line cut off by a crash is simply not settled
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.settled[record["key"]] = record
+        self._file = open(path, "a", encoding="utf-8")
+
+    def hashes(self):
+        """sha256 -> key of every entry already extracted, for deduplication across runs"""
+        return {
+            record["sha256"]: record["key"]
+            for record in self.settled.values()
+            if record.get("sha256") and record["status"] == STATUS_DONE
+        }
+
+    def record(self, entry, status):
+        record = {"key": entry.key, "sha256": entry.sha256, "status": status}
+        self.settled[entry.key] = record
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class JsonlSink:
+    """Append one JSON line per settled entry"""
+
+    def __init__(self, path):
+        self._file = open(path, "a", encoding="utf-8")
+
+    def is_known(self, sha256):
+        return False
+
+    def write(self, entry, engine, status, result=None, error=None, duplicate_of=None):
+        record = {"source": entry.key, "file": entry.name, "sha256": entry.sha256, "engine": engine, "status": status}
+        if duplicate_of:
+            record["duplicate_of"] = duplicate_of
+        if result is not None:
+            record["result"] = result
+        if error:
+            record["error"] = error
+        self._file.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+class DatabaseSink:
+    """Store each extracted file and its result the way an upload followed by a queue job would"""
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def _documents(self, sha256):
+        return Document.objects.filter(owner=self.owner, content_hash=sha256)
+
+    def _failed_only(self, sha256):
+        """Documents with this hash whose every job failed, so extracting the file again is not a duplicate"""
+        settled = self._documents(sha256).exclude(jobs__status=ExtractionJob.STATUS_FAILED).values("pk")
+        return self._documents(sha256).exclude(pk__in=settled).filter(jobs__isnull=False).distinct()
+
+    def is_known(self, sha256):
+        return self._documents(sha256).exclude(pk__in=self._failed_only(sha256).values("pk")).exists()
+
+    def write(self, entry, engine, status, result=None, error=None, duplicate_of=None):
+        if status not in (STATUS_DONE, STATUS_FAILED):
+            return
+        # A retried file gets a new job on the document its failed attempt left behind
+        document = self._failed_only(entry.sha256).order_by("pk").first()
+        if document is None:
+            with open(entry.path, "rb") as f:
+                file_path = default_storage.save(f"uploads/{entry.name}", File(f, name=entry.name))
+            document = create_document(
+                self.owner, file_path, entry.sha256, entry.size, entry.name, file_page_count(entry.path)
+            )
+            # Fingerprinted and flagged like an upload, so later uploads of the same invoice find it
+            fingerprint_document(document)
+            mark_duplicate(document)
+        job = ExtractionJob.objects.create(
+            owner=self.owner,
+            document=document,
+            file_path=document.file_path,
+            content_hash=entry.sha256,
+            engine=engine,
+            status=ExtractionJob.STATUS_RUNNING,
+            started_at=entry.started_at,
+            attempts=1,
+            pages=document.page_count or 1,
+        )
+        if status == STATUS_DONE:
+            complete_job(job, result)
+        else:
+            fail_job(job, error)
+
+    def close(self):
+        pass
+
+
+@dataclass
+class Summary:
+    done: int = 0
+    failed: int = 0
+    duplicate: int = 0
+    skipped: int = 0
+    resumed: int = 0
+    elapsed_seconds: float = 0.0
+
+
+def ingest(source, engine, sink, checkpoint_path, workers=None, limit=None, retry_failed=False, report=None,
+           report_every=100):
+    """
+    Extract every supported file in source with engine, writing results to sink.
+    report(summary) is called every report_every settled entries. Returns the final Summary.
+    """
+    workers = workers or settings.EXTRACTION_WORKERS
+    checkpoint = Checkpoint(checkpoint_path)
+    # sha256 -> key of the entry that was extracted; only finished extractions make later copies duplicates
+    seen = checkpoint.hashes()
+    # sha256 of each file being extracted -> copies of it found meanwhile, settled once its outcome is known
+    waiting = {}
+    summary = Summary()
+    start = time.perf_counter()
+    staging = tempfile.mkdtemp(prefix="ingest-")
+    archive = zipfile.ZipFile(source) if not os.path.isdir(source) and zipfile.is_zipfile(source) else None
+
+    def settle(entry, status, **output):
+        sink.write(entry, engine, status, **output)
+        checkpoint.record(entry, status)
+        setattr(summary, status, getattr(summary, status) + 1)
+        incr("ingest_files_total", status=status)
+        if entry.staged and os.path.exists(entry.path):
+            os.remove(entry.path)
+        settled = summary.done + summary.failed + summary.duplicate + summary.skipped
+        if report and settled % report_every == 0:
+            summary.elapsed_seconds = round(time.perf_counter() - start, 3)
+            report(summary)
+
+    def stage(entry, index):
+        """Give the entry a local path (unpacking a ZIP member while hashing it), size and hash"""
+        if entry.member is None:
+            entry.size = os.path.getsize(entry.path)
+            entry.sha256 = _hash_file(entry.path)
+            return
+        digest = hashlib.sha256()
+        # Members are renamed on the way out so nothing in the archive can write outside staging
+        entry.path = os.path.join(staging, f"{index}-{entry.name}")
+        entry.staged = True
+        with archive.open(entry.member) as src, open(entry.path, "wb") as dst:
+            for block in iter(lambda: src.read(HASH_BLOCK_SIZE), b""):
+                digest.update(block)
+                dst.write(block)
+        entry.size = entry.member.file_size
+        entry.sha256 = digest.hexdigest()
+
+    try:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            pending = {}
+
+            def submit(entry):
+                entry.started_at = timezone.now()
+                pending[pool.submit(run_engine, engine, entry.path)] = entry
+
+            entries = iter_entries(source)
+            dispatched = 0
+            exhausted = False
+            while True:
+                # Keep a couple of files per worker in flight; the source is never listed into memory
+                while not exhausted and len(pending) < workers * 2 and (limit is None or dispatched < limit):
+                    entry = next(entries, None)
+                    if entry is None:
+                        exhausted = True
+                        break
+                    settled = checkpoint.settled.get(entry.key)
+                    # Older checkpoints may hold copies marked as duplicates of a file that then failed
+                    retryable = settled and retry_failed and (
+                        settled["status"] == STATUS_FAILED
+                        or (settled["status"] == STATUS_DUPLICATE and settled["sha256"] not in seen)
+                    )
+                    if settled and not retryable:
+                        summary.resumed += 1
+                        continue
+                    # The sink already holds the failed attempt of a retried entry; that is not a duplicate
+                    retrying = settled is not None
+                    dispatched += 1
+                    try:
+                        stage(entry, dispatched)
+                    except Exception as e:
+                        logger.warning("Could not read %s: %s", entry.key, e)
+                        settle(entry, STATUS_FAILED, error=str(e))
+                        continue
+                    if document_kind(entry.path) is None:
+                        settle(entry, STATUS_SKIPPED)
+                    elif entry.sha256 in seen or (not retrying and sink.is_known(entry.sha256)):
+                        settle(entry, STATUS_DUPLICATE, duplicate_of=seen.get(entry.sha256))
+                    elif entry.sha256 in waiting:
+                        waiting[entry.sha256].append(entry)
+                    else:
+                        waiting[entry.sha256] = []
+                        submit(entry)
+
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    entry = pending.pop(future)
+                    copies = waiting.pop(entry.sha256)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        logger.warning("Ingestion of %s failed: %s", entry.key, e)
+                        settle(entry, STATUS_FAILED, error=str(e))
+                        if copies:
+                            # A copy of a failed file is not a duplicate of anything, so it gets its own attempt
+                            waiting[entry.sha256] = copies[1:]
+                            submit(copies[0])
+                    else:
+                        seen[entry.sha256] = entry.key
+                        settle(entry, STATUS_DONE, result=result)
+                        for copy in copies:
+                            settle(copy, STATUS_DUPLICATE, duplicate_of=entry.key)
+    finally:
+        if archive:
+            archive.close()
+        shutil.rmtree(staging, ignore_errors=True)
+        checkpoint.close()
+        sink.close()
+
+    summary.elapsed_seconds = round(time.perf_counter() - start, 3)
+    return summary
@@ -0,0 +1,120 @@
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from datetime import timedelta
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from module_data_extraction import progress
+from module_data_extraction.telemetry import telemetry, incr
+from .engines import run_engine
+from .models import ExtractionJob
+from .quotas import fair_candidates
+from .records import finite_json, save_extraction
+
+
+def enqueue_job(owner, file_path, engine, content_hash="", document=None, pages=1):
+    """Create a queued extraction job for an uploaded file."""
+    return ExtractionJob.objects.create(
+        owner=owner, file_path=file_path, engine=engine, content_hash=content_hash, document=document, pages=pages
+    )
+
+
+def claim_next_job():
+    """
+    Atomically move the next queued job to running and return it.
+    Users take turns by weighted recent throughput, and users at their
+    concurrency or pages-per-minute limit wait (see quotas.py); None means
+    nothing is claimable right now. The conditional UPDATE acts as a
+    compare-and-swap, so several runners can share one SQLite or Postgres
+    database without double-claiming a job.
+    """
+    for job_id in fair_candidates():
+        claimed = ExtractionJob.objects.filter(pk=job_id, status=ExtractionJob.STATUS_QUEUED).update(
+            status=ExtractionJob.STATUS_RUNNING,
+            started_at=timezone.now(),
+            attempts=F("attempts") + 1,
+        )
+        if claimed:
+            return ExtractionJob.objects.get(pk=job_id)
+    return None
+
+
+def complete_job(job, result):
+    """Store the extraction result, persist its pages/invoices and mark the job as done."""
+    # Model output parsed with json.loads may hold NaN, which neither the JSON columns nor the amounts accept
+    result = finite_json(result)
+    with transaction.atomic():
+        if job.document_id:
+            save_extraction(job.document, job.engine, result)
+        job.result = result
+        job.status = ExtractionJob.STATUS_DONE
+        job.finished_at = timezone.now()
+        job.save(update_fields=["result", "status", "finished_at"])
+
+
+def fail_job(job, error):
+    """Record the error and mark the job as failed."""
+    job.error = str(error)
+    job.status = ExtractionJob.STATUS_FAILED
+    job.finished_at = timezone.now()
+    job.save(update_fields=["error", "status", "finished_at"])
+
+
+def requeue_stale_jobs(timeout_seconds, max_attempts=None):
+    """
+    Put back jobs left running by a runner that died mid-extraction.
+    A job that has already been claimed max_attempts times is failed instead,
+    so a file that crashes every runner cannot keep the queue busy forever.
+    Returns the number of jobs requeued.
+    """
+    max_attempts = max_attempts or settings.EXTRACTION_JOB_MAX_ATTEMPTS
+    cutoff = timezone.now() - timedelta(seconds=timeout_seconds)
+    stale = ExtractionJob.objects.filter(status=ExtractionJob.STATUS_RUNNING, started_at__lt=cutoff)
+    stale.filter(attempts__gte=max_attempts).update(
+        status=ExtractionJob.STATUS_FAILED,
+        error=f"Gave up after {max_attempts} attempts",
+        finished_at=timezone.now(),
+    )
+    return stale.filter(attempts__lt=max_attempts).update(status=ExtractionJob.STATUS_QUEUED, started_at=None)
+
+
+def run_workers(max_workers=None, poll_interval=None, once=False):
+    """
+    Drain the job queue with a process pool.
+    Only this parent process talks to the database; children just run the
+    extraction engine and hand the result back.
+    """
+    max_workers = max_workers or settings.EXTRACTION_WORKERS
+    poll_interval = poll_interval if poll_interval is not None else settings.EXTRACTION_POLL_INTERVAL
+    requeue_stale_jobs(settings.EXTRACTION_JOB_TIMEOUT)
+    progress.prune(settings.EXTRACTION_PROGRESS_TTL, settings.EXTRACTION_PROGRESS_DIR)
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        pending = {}
+        while True:
+            while len(pending) < max_workers:
+                job = claim_next_job()
+                if job is None:
+                    break
+                future = pool.submit(run_engine, job.engine, default_storage.path(job.file_path), job.id)
+                pending[future] = job
+
+            if not pending:
+                if once:
+                    return
+                time.sleep(poll_interval)
+                continue
+
+            done, _ = wait(pending, timeout=poll_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                job = pending.pop(future)
+                try:
+                    complete_job(job, future.result())
+                    incr("jobs_total", engine=job.engine, status=ExtractionJob.STATUS_DONE)
+                except Exception as e:
+                    fail_job(job, e)
+                    incr("jobs_total", engine=job.engine, status=ExtractionJob.STATUS_FAILED)
+            if done:
+                telemetry.flush()
@@ -0,0 +1,68 @@
+import os
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from api.ingest import DatabaseSink, JsonlSink, ingest
+from api.models import ExtractionJob
+
+
+class Command(BaseCommand):
+    help = "Extract every file in a directory or ZIP archive, resumably, into the database or a JSONL file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("source", help="Directory (walked recursively) or ZIP archive")
+        parser.add_argument("--engine", default=settings.EXTRACTION_DEFAULT_ENGINE,
+                            choices=[engine for engine, _ in ExtractionJob.ENGINE_CHOICES])
+        parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+        parser.add_argument("--owner", help="Username to store documents under (database output)")
+        parser.add_argument("--output", help="Write results to this JSONL file instead of the database")
+        parser.add_argument("--checkpoint", help="Checkpoint file (default: next to the output, or named after the source)")
+        parser.add_argument("--limit", type=int, default=None, help="Dispatch at most this many new files")
+        parser.add_argument("--retry-failed", action="store_true", help="Run files that failed in an earlier run again")
+        parser.add_argument("--report-every", type=int, default=100, help="Print progress every N files")
+
+    def handle(self, *args, **options):
+        source = options["source"]
+        if not os.path.exists(source):
+            raise CommandError(f"{source} does not exist")
+
+        if options["output"]:
+            sink = JsonlSink(options["output"])
+            checkpoint = options["checkpoint"] or f"{options['output']}.checkpoint"
+        else:
+            if not options["owner"]:
+                raise CommandError("--owner is required unless --output is given")
+            try:
+                owner = User.objects.get(username=options["owner"])
+            except User.DoesNotExist:
+                raise CommandError(f"No user named {options['owner']}")
+            sink = DatabaseSink(owner)
+            name = os.path.basename(os.path.normpath(source))
+            checkpoint = options["checkpoint"] or f"ingest-{owner.username}-{name}.checkpoint"
+
+        self.stdout.write(f"Ingesting {source} with {options['engine']} (checkpoint {checkpoint})...")
+        try:
+            summary = ingest(
+                source,
+                options["engine"],
+                sink,
+                checkpoint,
+                workers=options["workers"],
+                limit=options["limit"],
+                retry_failed=options["retry_failed"],
+                report=self.report,
+                report_every=max(1, options["report_every"]),
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.report(summary)
+        self.stdout.write(self.style.SUCCESS("Ingestion finished."))
+
+    def report(self, summary):
+        extracted = summary.done + summary.failed
+        rate = extracted / summary.elapsed_seconds if summary.elapsed_seconds else 0.0
+        self.stdout.write(
+            f"done={summary.done} failed={summary.failed} duplicate={summary.duplicate} "
+            f"skipped={summary.skipped} resumed={summary.resumed} "
+            f"elapsed={summary.elapsed_seconds:.1f}s rate={rate:.2f} files/s"
+        )
@@ -0,0 +1,19 @@
+from django.core.management.base import BaseCommand
+from api.jobs import run_workers
+
+
+class Command(BaseCommand):
+    help = "Drain queued extraction jobs with a local process pool."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=None, help="Number of worker processes")
+        parser.add_argument("--poll-interval", type=float, default=None, help="Seconds between queue polls")
+        parser.add_argument("--once", action="store_true", help="Exit once the queue is empty")
+
+    def handle(self, *args, **options):
+        self.stdout.write("Starting extraction workers...")
+        run_workers(
+            max_workers=options["workers"],
+            poll_interval=options["poll_interval"],
+            once=options["once"],
+        )
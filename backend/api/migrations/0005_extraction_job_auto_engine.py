@@ -0,0 +1,23 @@
+# Generated by Django 5.2.18 on 2026-10-16 23:57
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_duplicate_detection'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chunkedupload',
+            name='engine',
+            field=models.CharField(choices=[('ocr', 'Local OCR'), ('vision', 'OpenAI Vision'), ('documentai', 'Google Document AI'), ('auto', 'Cascade (local first, remote on low confidence)')], default='ocr', max_length=20),
+        ),
+        migrations.AlterField(
+            model_name='extractionjob',
+            name='engine',
+            field=models.CharField(choices=[('ocr', 'Local OCR'), ('vision', 'OpenAI Vision'), ('documentai', 'Google Document AI'), ('auto', 'Cascade (local first, remote on low confidence)')], default='ocr', max_length=20),
+        ),
+    ]
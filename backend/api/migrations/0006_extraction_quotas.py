@@ -0,0 +1,44 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:02
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_extraction_job_auto_engine'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExtractionQuota',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('max_running', models.PositiveIntegerField(blank=True, null=True)),
+                ('pages_per_minute', models.PositiveIntegerField(blank=True, null=True)),
+                ('max_queued_pages', models.PositiveIntegerField(blank=True, null=True)),
+                ('weight', models.FloatField(default=1.0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='extractionjob',
+            name='pages',
+            field=models.PositiveIntegerField(default=1),
+        ),
+        migrations.AddIndex(
+            model_name='extractionjob',
+            index=models.Index(fields=['owner', 'status', 'created_at'], name='api_extract_owner_i_74374c_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='extractionjob',
+            index=models.Index(fields=['started_at'], name='api_extract_started_6eeedc_idx'),
+        ),
+        migrations.AddField(
+            model_name='extractionquota',
+            name='owner',
+            field=models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='extraction_quota', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
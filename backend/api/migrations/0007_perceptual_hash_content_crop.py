@@ -0,0 +1,32 @@
+# Generated by Django 5.2.18 on 2026-10-17 00:20
+
+from django.db import migrations, models
+
+
+def clear_whole_page_hashes(apps, schema_editor):
+    # 64-bit whole-page hashes cannot be compared with the new ones; those documents simply go unmatched
+    Document = apps.get_model('api', 'Document')
+    Document.objects.exclude(perceptual_hash='').update(
+        perceptual_hash='', phash_band_0=None, phash_band_1=None, phash_band_2=None, phash_band_3=None,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0006_extraction_quotas'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='document',
+            name='text_fingerprint',
+            field=models.CharField(blank=True, default='', max_length=40),
+        ),
+        migrations.AlterField(
+            model_name='document',
+            name='perceptual_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+        migrations.RunPython(clear_whole_page_hashes, migrations.RunPython.noop),
+    ]
@@ -1,3 +1,190 @@
+import uuid
 from django.db import models
+from django.contrib.auth.models import User
 
-# Create your models here.
+
+class Document(models.Model):
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="documents")
+    file_path = models.CharField(max_length=500)
+    original_name = models.CharField(max_length=255, blank=True, default="")
+    content_hash = models.CharField(max_length=64, blank=True, default="")
+    mime_type = models.CharField(max_length=100, blank=True, default="")
+    size = models.PositiveBigIntegerField(default=0)
+    page_count = models.PositiveIntegerField(null=True, blank=True)
+    # 256-bit dHash of the first page's printed area (hex) and four 16-bit bands of it folded
+    # to 64 bits, for near-duplicate lookups; text_fingerprint digests the first page's text layer
+    perceptual_hash = models.CharField(max_length=64, blank=True, default="")
+    phash_band_0 = models.PositiveIntegerField(null=True, blank=True)
+    phash_band_1 = models.PositiveIntegerField(null=True, blank=True)
+    phash_band_2 = models.PositiveIntegerField(null=True, blank=True)
+    phash_band_3 = models.PositiveIntegerField(null=True, blank=True)
+    text_fingerprint = models.CharField(max_length=40, blank=True, default="")
+    duplicate_of = models.ForeignKey(
+        "self", null=True, blank=True, on_delete=models.SET_NULL, related_name="duplicates"
+    )
+    duplicate_kind = models.CharField(max_length=10, blank=True, default="")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    DUPLICATE_EXACT = "exact"
+    DUPLICATE_NEAR = "near"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["content_hash"]),
+            models.Index(fields=["owner", "-id"]),
+            models.Index(fields=["owner", "content_hash"]),
+            models.Index(fields=["owner", "phash_band_0"]),
+            models.Index(fields=["owner", "phash_band_1"]),
+            models.Index(fields=["owner", "phash_band_2"]),
+            models.Index(fields=["owner", "phash_band_3"]),
+        ]
+
+    def __str__(self):
+        return self.original_name or self.file_path
+
+
+class DocumentPage(models.Model):
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name="pages")
+    number = models.PositiveIntegerField()
+    text = models.TextField(blank=True, default="")
+    source = models.CharField(max_length=20, blank=True, default="")
+
+    class Meta:
+        ordering = ["document", "number"]
+        constraints = [
+            models.UniqueConstraint(fields=["document", "number"], name="unique_document_page"),
+        ]
+
+    def __str__(self):
+        return f"{self.document} page {self.number}"
+
+
+class Invoice(models.Model):
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="invoices")
+    document = models.ForeignKey(Document, on_delete=models.CASCADE, related_name="invoices")
+    page = models.PositiveIntegerField(null=True, blank=True)
+    engine = models.CharField(max_length=20, blank=True, default="")
+    vendor_name = models.CharField(max_length=255, blank=True, default="")
+    invoice_number = models.CharField(max_length=100, blank=True, default="")
+    invoice_date = models.DateField(null=True, blank=True)
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, null=True, blank=True)
+    currency = models.CharField(max_length=3, blank=True, default="")
+    raw = models.JSONField(null=True, blank=True)
+    # Normalized (vendor, invoice number, total) key; the first invoice with a key is the original
+    dedupe_key = models.CharField(max_length=40, blank=True, default="")
+    duplicate_of = models.ForeignKey(
+        "self", null=True, blank=True, on_delete=models.SET_NULL, related_name="duplicates"
+    )
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["owner", "-id"]),
+            models.Index(fields=["vendor_name"]),
+            models.Index(fields=["invoice_number"]),
+            models.Index(fields=["invoice_date"]),
+            models.Index(fields=["owner", "dedupe_key"]),
+        ]
+
+    def __str__(self):
+        return f"{self.vendor_name or 'Unknown vendor'} {self.invoice_number}".strip()
+
+
+class LineItem(models.Model):
+    invoice = models.ForeignKey(Invoice, on_delete=models.CASCADE, related_name="line_items")
+    position = models.PositiveIntegerField(default=0)
+    description = models.TextField(blank=True, default="")
+    quantity = models.DecimalField(max_digits=14, decimal_places=4, null=True, blank=True)
+    unit_price = models.DecimalField(max_digits=14, decimal_places=4, null=True, blank=True)
+    amount = models.DecimalField(max_digits=14, decimal_places=2, null=True, blank=True)
+
+    class Meta:
+        ordering = ["invoice", "position"]
+
+    def __str__(self):
+        return f"{self.description} {self.amount}"
+
+
+class ExtractionJob(models.Model):
+    ENGINE_OCR = "ocr"
+    ENGINE_VISION = "vision"
+    ENGINE_DOCUMENT_AI = "documentai"
+    ENGINE_AUTO = "auto"
+    ENGINE_CHOICES = [
+        (ENGINE_OCR, "Local OCR"),
+        (ENGINE_VISION, "OpenAI Vision"),
+        (ENGINE_DOCUMENT_AI, "Google Document AI"),
+        (ENGINE_AUTO, "Cascade (local first, remote on low confidence)"),
+    ]
+
+    STATUS_QUEUED = "queued"
+    STATUS_RUNNING = "running"
+    STATUS_DONE = "done"
+    STATUS_FAILED = "failed"
+    STATUS_CHOICES = [
+        (STATUS_QUEUED, "Queued"),
+        (STATUS_RUNNING, "Running"),
+        (STATUS_DONE, "Done"),
+        (STATUS_FAILED, "Failed"),
+    ]
+
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="extraction_jobs")
+    document = models.ForeignKey(Document, on_delete=models.SET_NULL, null=True, blank=True, related_name="jobs")
+    file_path = models.CharField(max_length=500)
+    content_hash = models.CharField(max_length=64, blank=True, default="", db_index=True)
+    engine = models.CharField(max_length=20, choices=ENGINE_CHOICES, default=ENGINE_OCR)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_QUEUED)
+    result = models.JSONField(null=True, blank=True)
+    error = models.TextField(blank=True, default="")
+    attempts = models.PositiveIntegerField(default=0)
+    # Page count known at upload time; charged against the owner's pages-per-minute quota
+    pages = models.PositiveIntegerField(default=1)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["created_at"]
+        indexes = [
+            models.Index(fields=["status", "created_at"]),
+            models.Index(fields=["owner", "status", "created_at"]),
+            models.Index(fields=["started_at"]),
+        ]
+
+    def __str__(self):
+        return f"{self.engine} job {self.pk} ({self.status})"
+
+
+class ExtractionQuota(models.Model):
+    """Per-user overrides of the EXTRACTION_USER_* quota settings; empty fields use the defaults."""
+    owner = models.OneToOneField(User, on_delete=models.CASCADE, related_name="extraction_quota")
+    max_running = models.PositiveIntegerField(null=True, blank=True)
+    pages_per_minute = models.PositiveIntegerField(null=True, blank=True)
+    max_queued_pages = models.PositiveIntegerField(null=True, blank=True)
+    # Share of the workers this user gets relative to others when both have queued jobs
+    weight = models.FloatField(default=1.0)
+
+    def __str__(self):
+        return f"Quota for {self.owner}"
+
+
+class ChunkedUpload(models.Model):
+    STATUS_UPLOADING = "uploading"
+    STATUS_COMPLETE = "complete"
+    STATUS_CHOICES = [
+        (STATUS_UPLOADING, "Uploading"),
+        (STATUS_COMPLETE, "Complete"),
+    ]
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    owner = models.ForeignKey(User, on_delete=models.CASCADE, related_name="chunked_uploads")
+    filename = models.CharField(max_length=255)
+    engine = models.CharField(max_length=20, choices=ExtractionJob.ENGINE_CHOICES, default=ExtractionJob.ENGINE_OCR)
+    size = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default=STATUS_UPLOADING)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"{self.filename} ({self.offset}/{self.size} bytes)"
@@ -0,0 +1,141 @@
+"""
+Per-user extraction quotas and weighted-fair job scheduling.
+
+Every user gets at most ``pages_per_minute`` pages started in any 60-second
+window. Uploads are refused with 429 once the user's queued pages exceed
+``max_queued_pages``; ``admitting()`` makes that check and the new job one
+step, so concurrent uploads cannot all slip under the cap. When several
+users have queued work, the next job goes to the one with the fewest
+recently started pages per unit of ``weight``, so a tenant dumping
+thousands of files only delays their own backlog. ``max_running`` only
+matters while others are waiting: users below it go first, and workers
+nobody else needs still pick up the jobs of users at or above it.
+"""
+from contextlib import contextmanager
+from dataclasses import dataclass
+from datetime import timedelta
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import Count, Min, Sum
+from django.utils import timezone
+from rest_framework.exceptions import Throttled
+from .models import ExtractionJob, ExtractionQuota
+
+WINDOW = timedelta(minutes=1)
+
+
+@dataclass
+class Quota:
+    max_running: int
+    pages_per_minute: int
+    max_queued_pages: int
+    weight: float = 1.0
+
+
+def _quota(override=None):
+    quota = Quota(
+        max_running=settings.EXTRACTION_USER_MAX_RUNNING,
+        pages_per_minute=settings.EXTRACTION_USER_PAGES_PER_MINUTE,
+        max_queued_pages=settings.EXTRACTION_USER_MAX_QUEUED_PAGES,
+    )
+    if override:
+        for field in ("max_running", "pages_per_minute", "max_queued_pages"):
+            if getattr(override, field) is not None:
+                setattr(quota, field, getattr(override, field))
+        quota.weight = override.weight or 1.0
+    return quota
+
+
+def quotas_for(owner_ids):
+    """Effective quota for each owner id, with database overrides applied."""
+    overrides = {quota.owner_id: quota for quota in ExtractionQuota.objects.filter(owner_id__in=owner_ids)}
+    return {owner_id: _quota(overrides.get(owner_id)) for owner_id in owner_ids}
+
+
+def empty_usage():
+    return {"queued_jobs": 0, "queued_pages": 0, "oldest_queued_at": None, "running_jobs": 0, "pages_last_minute": 0}
+
+
+def usage(owner_ids=None):
+    """
+    Queue depth and recent throughput per owner id: queued jobs and pages,
+    oldest queued job, running jobs and pages started in the last minute.
+    """
+    jobs = ExtractionJob.objects.all()
+    if owner_ids is not None:
+        jobs = jobs.filter(owner_id__in=owner_ids)
+    rows = {}
+
+    def row(owner_id):
+        return rows.setdefault(owner_id, empty_usage())
+
+    queued = jobs.filter(status=ExtractionJob.STATUS_QUEUED).values("owner_id").annotate(
+        jobs=Count("id"), pages=Sum("pages"), oldest=Min("created_at")
+    )
+    for item in queued:
+        entry = row(item["owner_id"])
+        entry.update(queued_jobs=item["jobs"], queued_pages=item["pages"] or 0, oldest_queued_at=item["oldest"])
+    for item in jobs.filter(status=ExtractionJob.STATUS_RUNNING).values("owner_id").annotate(jobs=Count("id")):
+        row(item["owner_id"])["running_jobs"] = item["jobs"]
+    recent = jobs.filter(started_at__gte=timezone.now() - WINDOW).values("owner_id").annotate(pages=Sum("pages"))
+    for item in recent:
+        row(item["owner_id"])["pages_last_minute"] = item["pages"] or 0
+    return rows
+
+
+def check_upload(owner, pages):
+    """Raise Throttled (429) if queuing `pages` more pages would exceed the owner's backlog quota."""
+    quota = quotas_for([owner.pk])[owner.pk]
+    queued_pages = usage([owner.pk]).get(owner.pk, {}).get("queued_pages", 0)
+    if queued_pages and queued_pages + pages > quota.max_queued_pages:
+        # Roughly how long until the backlog has drained enough to take this upload
+        wait = 60 * (queued_pages + pages - quota.max_queued_pages) / max(1, quota.pages_per_minute)
+        raise Throttled(wait=wait, detail=f"Extraction queue is full ({queued_pages} pages waiting).")
+
+
+@contextmanager
+def admitting(owner, pages):
+    """
+    check_upload, then hold the owner's lock until the block exits, so the job queued inside
+    the block is counted by any other upload's check. Keep slow work (storing, fingerprinting)
+    outside the block.
+    """
+    with transaction.atomic():
+        # A row lock on Postgres; SQLite takes its write lock when the transaction begins (transaction_mode)
+        list(User.objects.select_for_update().filter(pk=owner.pk).values_list("pk", flat=True))
+        check_upload(owner, pages)
+        yield
+
+
+def fair_candidates():
+    """
+    Yield queued jobs to try next, one per eligible owner, in weighted-fair order.
+    Owners over their pages-per-minute budget are skipped. Owners at their concurrency
+    limit come after everyone else, so they only get workers no other owner can use.
+    """
+    owner_usage = usage()
+    waiting = [owner_id for owner_id, entry in owner_usage.items() if entry["queued_jobs"]]
+    if not waiting:
+        return
+    quotas = quotas_for(waiting)
+    # Least recent throughput per unit of weight first; the oldest backlog breaks ties
+    waiting.sort(key=lambda owner_id: (
+        owner_usage[owner_id]["pages_last_minute"] / quotas[owner_id].weight,
+        owner_usage[owner_id]["oldest_queued_at"],
+    ))
+    saturated = [owner_id for owner_id in waiting if owner_usage[owner_id]["running_jobs"] >= quotas[owner_id].max_running]
+    for owner_id in [owner_id for owner_id in waiting if owner_id not in saturated] + saturated:
+        entry, quota = owner_usage[owner_id], quotas[owner_id]
+        job = (
+            ExtractionJob.objects.filter(owner_id=owner_id, status=ExtractionJob.STATUS_QUEUED)
+            .order_by("created_at", "pk")
+            .only("pk", "pages")
+            .first()
+        )
+        if job is None:
+            continue
+        # A job bigger than the whole budget still runs, but only once the window is empty
+        if entry["pages_last_minute"] and entry["pages_last_minute"] + job.pages > quota.pages_per_minute:
+            continue
+        yield job.pk
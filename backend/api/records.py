@@ -0,0 +1,140 @@
+import math
+import mimetypes
+import os
+from decimal import Decimal
+from django.core.files.storage import default_storage
+from django.db import transaction
+from module_data_extraction.dedupe import invoice_key
+from module_data_extraction.documents import sniff_path
+from module_data_extraction.normalize import parse_amount, parse_date, parse_currency
+from module_data_extraction.telemetry import span
+from .models import Document, DocumentPage, Invoice, LineItem
+
+# Largest value that fits DecimalField(max_digits=14)
+MAX_AMOUNT = Decimal("1e12")
+
+
+def create_document(owner, file_path, content_hash="", size=0, original_name="", page_count=None):
+    """Register an uploaded file before any extraction has run."""
+    # Sniffed from the stored bytes, so a scan uploaded as "invoice.pdf" is recorded as the image it is
+    try:
+        mime_type = sniff_path(default_storage.path(file_path))
+    except (OSError, NotImplementedError):
+        mime_type, _ = mimetypes.guess_type(file_path)
+    return Document.objects.create(
+        owner=owner,
+        file_path=file_path,
+        original_name=original_name or os.path.basename(file_path),
+        content_hash=content_hash,
+        mime_type=mime_type or "",
+        size=size,
+        page_count=page_count,
+    )
+
+
+def finite_json(value):
+    """Copy of an engine result with NaN and Infinity floats replaced by None, which JSON columns cannot store."""
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    if isinstance(value, dict):
+        return {key: finite_json(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [finite_json(item) for item in value]
+    return value
+
+
+def _amount(value):
+    amount = parse_amount(value)
+    # NaN and Infinity floats in engine JSON parse, but cannot be compared or stored
+    if amount is None or not amount.is_finite() or abs(amount) >= MAX_AMOUNT:
+        return None
+    return amount
+
+
+def _invoice_fields(info):
+    """Map the vision engine's or Document AI's field names onto Invoice columns."""
+    total_text = info.get("total_amount", info.get("total_cost"))
+    return {
+        "vendor_name": (info.get("vendor_name") or info.get("supplier_name") or "")[:255],
+        "invoice_number": str(info.get("invoice_number") or info.get("invoice_id") or "")[:100],
+        "invoice_date": parse_date(info.get("date") or info.get("invoice_date")),
+        "total_amount": _amount(total_text),
+        "currency": parse_currency(info.get("currency"), total_text) or "",
+    }
+
+
+def _line_items(info):
+    costs = info.get("costs") or []
+    return [
+        {
+            "position": position,
+            "description": str(cost.get("description") or ""),
+            "quantity": _amount(cost.get("quantity")),
+            "unit_price": _amount(cost.get("unit_price")),
+            "amount": _amount(cost.get("amount")),
+        }
+        for position, cost in enumerate(costs, 1)
+        if isinstance(cost, dict)
+    ]
+
+
+def _flag_duplicate_invoices(owner, invoices):
+    """Point invoices at the earliest stored invoice with the same (vendor, number, total) key."""
+    keys = {invoice.dedupe_key for invoice in invoices if invoice.dedupe_key}
+    originals = {}
+    for key, pk in Invoice.objects.filter(owner=owner, dedupe_key__in=keys).order_by("-pk").values_list("dedupe_key", "pk"):
+        originals[key] = pk
+    for invoice in invoices:
+        if invoice.dedupe_key in originals:
+            invoice.duplicate_of_id = originals[invoice.dedupe_key]
+
+
+def save_extraction(document, engine, result):
+    """
+    Persist an engine result for a document with bulk inserts.
+    OCR results become DocumentPage rows; vision and Document AI results
+    become Invoice rows with their LineItems. Returns the created invoices.
+    """
+    with span("save", engine=engine):
+        return _save_extraction(document, engine, result)
+
+
+def _save_extraction(document, engine, result):
+    if engine == "ocr":
+        pages = [
+            DocumentPage(document=document, number=page["page"], text=page["text"], source=page.get("source", ""))
+            for page in result
+        ]
+        with transaction.atomic():
+            DocumentPage.objects.bulk_create(pages, ignore_conflicts=True)
+            document.page_count = max((page.number for page in pages), default=0)
+            document.save(update_fields=["page_count"])
+        return []
+
+    # Vision results are a list of per-page records; Document AI returns one flat dict
+    if isinstance(result, dict):
+        records = [(None, result)]
+    else:
+        records = [(item["page"], item["extracted_info"]) for item in result if isinstance(item.get("extracted_info"), dict)]
+
+    invoices, items = [], []
+    for page, info in records:
+        fields = _invoice_fields(info)
+        dedupe_key = invoice_key(fields["vendor_name"], fields["invoice_number"], fields["total_amount"])
+        # The cascade reports which engine produced the record it settled on
+        used_engine = info.get("engine") or engine
+        invoices.append(Invoice(owner=document.owner, document=document, page=page, engine=used_engine, raw=info, dedupe_key=dedupe_key, **fields))
+        items.append(_line_items(info))
+
+    with transaction.atomic():
+        _flag_duplicate_invoices(document.owner, invoices)
+        # Postgres and SQLite both return primary keys from bulk_create, so line items can reference them
+        invoices = Invoice.objects.bulk_create(invoices)
+        LineItem.objects.bulk_create(
+            LineItem(invoice=invoice, **item) for invoice, invoice_items in zip(invoices, items) for item in invoice_items
+        )
+        if not isinstance(result, dict):
+            # Document-mode vision results are one record covering "pages" pages
+            document.page_count = max((item.get("pages") or item.get("page", 0) for item in result), default=0)
+            document.save(update_fields=["page_count"])
+    return invoices
@@ -1,5 +1,8 @@
+import os
+from django.conf import settings
 from django.contrib.auth.models import User
 from rest_framework import serializers
+from .models import ExtractionJob, ChunkedUpload, Invoice, LineItem
 
 
 class UserSerializer(serializers.ModelSerializer):
@@ -12,3 +15,45 @@ class UserSerializer(serializers.ModelSerializer):
         print(validated_data)
         user = User.objects.create_user(**validated_data)
         return user
+
+
+class ExtractionJobSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ExtractionJob
+        fields = ["id", "document", "file_path", "content_hash", "engine", "status", "result", "error", "created_at", "started_at", "finished_at"]
+        read_only_fields = fields
+
+
+class ChunkedUploadSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = ChunkedUpload
+        fields = ["id", "filename", "engine", "size", "offset", "status", "created_at"]
+        read_only_fields = ["id", "offset", "status", "created_at"]
+
+    def validate_size(self, value):
+        if value > settings.UPLOAD_MAX_BYTES:
+            raise serializers.ValidationError(f"Uploads are limited to {settings.UPLOAD_MAX_BYTES} bytes.")
+        return value
+
+    def validate_filename(self, value):
+        return os.path.basename(value)
+
+
+class LineItemSerializer(serializers.ModelSerializer):
+    class Meta:
+        model = LineItem
+        fields = ["position", "description", "quantity", "unit_price", "amount"]
+
+
+class InvoiceSerializer(serializers.ModelSerializer):
+    line_items = LineItemSerializer(many=True, read_only=True)
+    file_path = serializers.CharField(source="document.file_path", read_only=True)
+    content_hash = serializers.CharField(source="document.content_hash", read_only=True)
+
+    class Meta:
+        model = Invoice
+        fields = [
+            "id", "document", "file_path", "content_hash", "page", "engine", "vendor_name", "invoice_number",
+            "invoice_date", "total_amount", "currency", "duplicate_of", "line_items", "created_at",
+        ]
+        read_only_fields = fields
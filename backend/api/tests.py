@@ -1,3 +1,820 @@
-from django.test import TestCase
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from unittest import mock
 
-# Create your tests here.
+from PIL import Image
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from datetime import date, timedelta
+from decimal import Decimal
+
+from django.db import connection
+from django.test import AsyncClient, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.exceptions import Throttled
+from rest_framework.test import APIClient
+from rest_framework_simplejwt.tokens import AccessToken
+
+from module_data_extraction import benchmark, registry
+from . import duplicates, ingest as ingest_module
+from .duplicates import submit_document
+from .ingest import Checkpoint, DatabaseSink, JsonlSink, ingest
+from .jobs import claim_next_job, complete_job, enqueue_job, requeue_stale_jobs
+from .models import ChunkedUpload, Document, DocumentPage, ExtractionJob, ExtractionQuota, Invoice
+from .quotas import admitting, check_upload, fair_candidates, quotas_for
+from .records import _amount, create_document, save_extraction
+from .uploads import PayloadTooLarge, append_chunk, partial_upload_path
+
+
+class OutputDirsMixin:
+    """Uploads, metrics, progress and result cache files go to a temporary directory instead of the project's"""
+
+    def setUp(self):
+        super().setUp()
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root, ignore_errors=True)
+        self.media_root = os.path.join(root, "media")
+        outputs = {
+            "EXTRACTION_METRICS_DIR": os.path.join(root, "metrics"),
+            "EXTRACTION_PROGRESS_DIR": os.path.join(root, "progress"),
+        }
+        # Engines read the directories from the environment, which ingest's forked workers inherit
+        environ = mock.patch.dict(os.environ, outputs, EXTRACTION_CACHE_PATH=os.path.join(root, "cache.sqlite3"))
+        environ.start()
+        self.addCleanup(environ.stop)
+        self.addCleanup(registry.reset)
+        override = override_settings(
+            MEDIA_ROOT=self.media_root, CHUNKED_UPLOAD_DIR=os.path.join(self.media_root, "uploads", "partial"), **outputs
+        )
+        override.enable()
+        self.addCleanup(override.disable)
+
+
+class MediaRootMixin(OutputDirsMixin):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user("owner", password="pw")
+
+    def store(self, name, content):
+        """Save bytes under uploads/ and register them as the owner's document."""
+        file_path = default_storage.save(f"uploads/{name}", ContentFile(content))
+        return create_document(self.owner, file_path, hashlib.sha256(content).hexdigest(), len(content), name)
+
+
+def _invoice_pdf(number, total, trailer=b""):
+    """A one-page text-layer invoice; trailer bytes change the file without changing its text"""
+    truth = {
+        "vendor_name": "Acme Office Goods", "invoice_number": number, "date": "2024-03-01",
+        "total_amount": total, "currency": "USD",
+        "costs": [{"description": "Toner cartridge", "quantity": 1, "unit_price": total, "amount": total}],
+    }
+    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as f:
+        path = f.name
+    try:
+        benchmark.write_text_pdf(path, [benchmark._invoice_lines(truth)])
+        with open(path, "rb") as f:
+            return f.read() + trailer
+    finally:
+        os.remove(path)
+
+
+class MetricsViewTests(OutputDirsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+
+    def test_scrape_network_needs_no_token(self):
+        response = self.client.get("/api/metrics/", REMOTE_ADDR="127.0.0.1")
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("text/plain", response["Content-Type"])
+
+    @override_settings(EXTRACTION_METRICS_ALLOWED_NETWORKS=["10.0.0.0/8"])
+    def test_other_clients_are_refused(self):
+        response = self.client.get("/api/metrics/", REMOTE_ADDR="203.0.113.7")
+        self.assertIn(response.status_code, (401, 403))
+
+    @override_settings(EXTRACTION_METRICS_ALLOWED_NETWORKS=[])
+    def test_staff_users_are_allowed_from_anywhere(self):
+        self.client.force_authenticate(User.objects.create_user("ops", password="pw", is_staff=True))
+        response = self.client.get("/api/metrics/", REMOTE_ADDR="203.0.113.7")
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(EXTRACTION_METRICS_ALLOWED_NETWORKS=[])
+    def test_regular_users_are_refused(self):
+        self.client.force_authenticate(User.objects.create_user("alice", password="pw"))
+        response = self.client.get("/api/metrics/", REMOTE_ADDR="203.0.113.7")
+        self.assertEqual(response.status_code, 403)
+
+
+# Stands in for the poppler render: every first page looks the same, as invoices from one template nearly do
+SAME_LOOKING_PAGE = 0x8080800000000000 << 192
+
+
+@mock.patch("api.duplicates.file_perceptual_hash", return_value=SAME_LOOKING_PAGE)
+class DuplicateDetectionTests(MediaRootMixin, TestCase):
+    def finished(self, document, result):
+        return ExtractionJob.objects.create(
+            owner=self.owner, document=document, file_path=document.file_path, engine="ocr",
+            status=ExtractionJob.STATUS_DONE, result=result,
+        )
+
+    def test_exact_copy_reuses_the_result(self, _):
+        content = _invoice_pdf("INV-10231", "70.00")
+        original = self.store("a.pdf", content)
+        submit_document(self.owner, original, "ocr")
+        self.finished(original, {"invoice_id": "INV-10231"})
+
+        job = submit_document(self.owner, self.store("b.pdf", content), "ocr")
+        self.assertEqual(job.status, ExtractionJob.STATUS_DONE)
+        self.assertEqual(job.result, {"invoice_id": "INV-10231"})
+        self.assertEqual(job.document.duplicate_kind, Document.DUPLICATE_EXACT)
+
+    @override_settings(EXTRACTION_REUSE_NEAR_DUPLICATES=True)
+    def test_same_template_with_different_text_is_not_a_duplicate(self, _):
+        original = self.store("a.pdf", _invoice_pdf("INV-10231", "70.00"))
+        submit_document(self.owner, original, "ocr")
+        self.finished(original, {"invoice_id": "INV-10231"})
+
+        job = submit_document(self.owner, self.store("b.pdf", _invoice_pdf("INV-58812", "912.40")), "ocr")
+        self.assertEqual(job.status, ExtractionJob.STATUS_QUEUED)
+        self.assertIsNone(job.document.duplicate_of)
+
+    @override_settings(EXTRACTION_REUSE_NEAR_DUPLICATES=True)
+    def test_near_copy_with_the_same_text_reuses_the_result(self, _):
+        original = self.store("a.pdf", _invoice_pdf("INV-10231", "70.00"))
+        submit_document(self.owner, original, "ocr")
+        self.finished(original, {"invoice_id": "INV-10231"})
+
+        job = submit_document(self.owner, self.store("b.pdf", _invoice_pdf("INV-10231", "70.00", b"% resaved\n")), "ocr")
+        self.assertEqual(job.document.duplicate_kind, Document.DUPLICATE_NEAR)
+        self.assertEqual(job.status, ExtractionJob.STATUS_DONE)
+        self.assertEqual(job.result, {"invoice_id": "INV-10231"})
+
+    @override_settings(EXTRACTION_REUSE_NEAR_DUPLICATES=True)
+    def test_look_alike_scans_are_flagged_but_extracted(self, _):
+        original = self.store("a.png", b"\x89PNG\r\n\x1a\n first scan")
+        submit_document(self.owner, original, "ocr")
+        self.finished(original, {"invoice_id": "INV-10231"})
+
+        job = submit_document(self.owner, self.store("b.png", b"\x89PNG\r\n\x1a\n second scan"), "ocr")
+        self.assertEqual(job.document.duplicate_kind, Document.DUPLICATE_NEAR)
+        self.assertEqual(job.status, ExtractionJob.STATUS_QUEUED)
+
+    def test_template_siblings_with_other_text_are_not_fetched(self, _):
+        for number in range(3):
+            submit_document(self.owner, self.store(f"{number}.pdf", _invoice_pdf(f"INV-{number}", "70.00")), "ocr")
+
+        with CaptureQueriesContext(connection) as queries:
+            job = submit_document(self.owner, self.store("new.pdf", _invoice_pdf("INV-99", "70.00")), "ocr")
+        self.assertIsNone(job.document.duplicate_of)
+        lookup = next(sql for sql in (query["sql"] for query in queries)
+                      if sql.startswith("SELECT") and "\"phash_band_0\" =" in sql)
+        self.assertIn(f"\"text_fingerprint\" = '{job.document.text_fingerprint}'", lookup)
+        self.assertIn("LIMIT 200", lookup)
+
+    @override_settings(EXTRACTION_NEAR_DUPLICATE_CANDIDATES=2)
+    def test_only_the_most_recent_look_alikes_are_compared(self, _):
+        scans = [self.store(f"{number}.png", b"\x89PNG\r\n\x1a\n scan %d" % number) for number in range(4)]
+        for scan in scans:
+            submit_document(self.owner, scan, "ocr")
+
+        with mock.patch("api.duplicates.hamming_distance", wraps=duplicates.hamming_distance) as compared:
+            job = submit_document(self.owner, self.store("new.png", b"\x89PNG\r\n\x1a\n new scan"), "ocr")
+        self.assertEqual(compared.call_count, 2)
+        self.assertEqual(job.document.duplicate_of, scans[0])
+
+
+# Bytes the fake engine refuses to extract; the retry tests clear it to let the file through
+REJECTED = {b"%PDF-1.4 corrupt"}
+
+
+def _fake_engine(engine, file_path, job_id=None):
+    """Module-level so the ingest pool can pickle it; forked workers see REJECTED as it was at submit time"""
+    with open(file_path, "rb") as f:
+        content = f.read()
+    if content in REJECTED:
+        raise ValueError("Cannot read PDF")
+    # Fails however often its bytes are seen elsewhere, like a request that timed out
+    if "flaky" in os.path.basename(file_path):
+        raise TimeoutError("Engine timed out")
+    return [{"page": 1, "text": content.decode(), "source": os.path.basename(file_path)}]
+
+
+@mock.patch.object(ingest_module, "run_engine", _fake_engine)
+class IngestTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.source = tempfile.mkdtemp()
+        self.work = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.source, ignore_errors=True)
+        self.addCleanup(shutil.rmtree, self.work, ignore_errors=True)
+        self.addCleanup(REJECTED.add, b"%PDF-1.4 corrupt")
+        self.checkpoint = os.path.join(self.work, "checkpoint.jsonl")
+        for name, content in [("a.pdf", b"%PDF-1.4 first"), ("b.pdf", b"%PDF-1.4 second"),
+                              ("copy-of-a.pdf", b"%PDF-1.4 first"), ("broken.pdf", b"%PDF-1.4 corrupt"),
+                              ("notes.txt", b"not an invoice")]:
+            with open(os.path.join(self.source, name), "wb") as f:
+                f.write(content)
+
+    def run_ingest(self, sink=None, **options):
+        return ingest(self.source, "ocr", sink or DatabaseSink(self.owner), self.checkpoint, workers=1, **options)
+
+    def test_first_run_settles_every_entry(self):
+        summary = self.run_ingest()
+        self.assertEqual((summary.done, summary.failed, summary.duplicate, summary.skipped), (2, 1, 1, 1))
+        self.assertEqual(Document.objects.filter(owner=self.owner).count(), 3)
+        self.assertEqual(ExtractionJob.objects.filter(status=ExtractionJob.STATUS_FAILED).count(), 1)
+
+    def test_rerun_resumes_from_the_checkpoint(self):
+        self.run_ingest()
+        summary = self.run_ingest()
+        self.assertEqual(summary.resumed, 5)
+        self.assertEqual(summary.done + summary.failed + summary.duplicate + summary.skipped, 0)
+
+    def test_interrupted_run_carries_on(self):
+        self.run_ingest(limit=2)
+        with open(self.checkpoint, "a", encoding="utf-8") as f:
+            f.write('{"key": "b.pdf", "sha')
+        summary = self.run_ingest()
+        self.assertEqual(summary.resumed, 2)
+        self.assertEqual(Document.objects.filter(owner=self.owner, content_hash=hashlib.sha256(b"%PDF-1.4 second").hexdigest()).count(), 1)
+
+    def test_retry_failed_extracts_the_file_again(self):
+        self.run_ingest()
+        REJECTED.clear()
+        summary = self.run_ingest(retry_failed=True)
+        self.assertEqual((summary.done, summary.failed, summary.duplicate, summary.resumed), (1, 0, 0, 4))
+
+        content_hash = hashlib.sha256(b"%PDF-1.4 corrupt").hexdigest()
+        document = Document.objects.get(owner=self.owner, content_hash=content_hash)
+        self.assertEqual(
+            sorted(document.jobs.values_list("status", flat=True)),
+            [ExtractionJob.STATUS_DONE, ExtractionJob.STATUS_FAILED],
+        )
+        self.assertEqual(Checkpoint(self.checkpoint).settled["broken.pdf"]["status"], "done")
+
+    def test_retry_that_fails_again_is_not_a_duplicate(self):
+        self.run_ingest()
+        summary = self.run_ingest(retry_failed=True)
+        self.assertEqual((summary.failed, summary.duplicate), (1, 0))
+
+    def test_failed_upload_is_not_known(self):
+        self.run_ingest()
+        sink = DatabaseSink(self.owner)
+        self.assertFalse(sink.is_known(hashlib.sha256(b"%PDF-1.4 corrupt").hexdigest()))
+        self.assertTrue(sink.is_known(hashlib.sha256(b"%PDF-1.4 first").hexdigest()))
+
+    def write_source(self, name, content):
+        with open(os.path.join(self.source, name), "wb") as f:
+            f.write(content)
+
+    def test_copy_of_a_file_in_flight_waits_for_its_result(self):
+        output = os.path.join(self.work, "results.jsonl")
+        summary = ingest(self.source, "ocr", JsonlSink(output), self.checkpoint, workers=2)
+        self.assertEqual((summary.done, summary.failed, summary.duplicate), (2, 1, 1))
+        with open(output, encoding="utf-8") as f:
+            records = {record["source"]: record for record in map(json.loads, f)}
+        self.assertEqual((records["copy-of-a.pdf"]["status"], records["copy-of-a.pdf"]["duplicate_of"]), ("duplicate", "a.pdf"))
+
+    def test_copy_of_a_failed_file_is_extracted(self):
+        # Dispatched while the original is still running, and the original then fails
+        self.write_source("0-flaky.pdf", b"%PDF-1.4 third")
+        self.write_source("1-copy.pdf", b"%PDF-1.4 third")
+        summary = self.run_ingest()
+        self.assertEqual((summary.done, summary.failed, summary.duplicate), (3, 2, 1))
+        settled = Checkpoint(self.checkpoint).settled
+        self.assertEqual((settled["0-flaky.pdf"]["status"], settled["1-copy.pdf"]["status"]), ("failed", "done"))
+        document = Document.objects.get(owner=self.owner, content_hash=hashlib.sha256(b"%PDF-1.4 third").hexdigest())
+        self.assertEqual(
+            sorted(document.jobs.values_list("status", flat=True)),
+            [ExtractionJob.STATUS_DONE, ExtractionJob.STATUS_FAILED],
+        )
+
+    def test_retry_failed_extracts_copies_marked_as_duplicates_of_a_failure(self):
+        self.run_ingest()
+        content_hash = hashlib.sha256(b"%PDF-1.4 corrupt").hexdigest()
+        self.write_source("copy-of-broken.pdf", b"%PDF-1.4 corrupt")
+        # As an earlier version of ingest recorded a copy dispatched while its original was running
+        with open(self.checkpoint, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"key": "copy-of-broken.pdf", "sha256": content_hash, "status": "duplicate"}) + "\n")
+        REJECTED.clear()
+        summary = self.run_ingest(retry_failed=True)
+        self.assertEqual((summary.done, summary.duplicate, summary.resumed), (1, 1, 4))
+        settled = Checkpoint(self.checkpoint).settled
+        self.assertEqual((settled["broken.pdf"]["status"], settled["copy-of-broken.pdf"]["status"]), ("done", "duplicate"))
+
+    @mock.patch("api.duplicates.file_perceptual_hash", return_value=SAME_LOOKING_PAGE)
+    def test_ingested_documents_are_fingerprinted_like_uploads(self, _):
+        uploaded = self.store("upload.pdf", _invoice_pdf("INV-10231", "70.00"))
+        submit_document(self.owner, uploaded, "ocr")
+        self.write_source("resaved.pdf", _invoice_pdf("INV-10231", "70.00", b"% resaved\n"))
+        self.run_ingest()
+
+        document = Document.objects.get(owner=self.owner, original_name="resaved.pdf")
+        self.assertEqual(document.perceptual_hash, f"{SAME_LOOKING_PAGE:064x}")
+        self.assertEqual(document.text_fingerprint, uploaded.text_fingerprint)
+        self.assertEqual((document.duplicate_of, document.duplicate_kind), (uploaded, Document.DUPLICATE_NEAR))
+        self.assertEqual((document.page_count, document.jobs.get().pages), (1, 1))
+
+    def test_jsonl_output(self):
+        output = os.path.join(self.work, "results.jsonl")
+        self.run_ingest(sink=JsonlSink(output))
+        with open(output, encoding="utf-8") as f:
+            records = {record["source"]: record for record in map(json.loads, f)}
+        self.assertEqual(records["copy-of-a.pdf"]["duplicate_of"], "a.pdf")
+        self.assertEqual(records["a.pdf"]["result"][0]["text"], "%PDF-1.4 first")
+        self.assertEqual(records["broken.pdf"]["status"], "failed")
+
+
+def _vision_page(page, number, total, vendor="Acme Office Goods", **info):
+    return {
+        "page": page,
+        "extracted_info": {
+            "vendor_name": vendor, "invoice_number": number, "date": "2024-03-01", "total_amount": total,
+            "currency": "USD", "costs": [
+                {"description": "Printer paper A4", "quantity": 2, "unit_price": "4.50", "amount": "9.00"},
+                {"description": "Toner cartridge", "quantity": 1, "unit_price": "61.00", "amount": "61.00"},
+            ],
+            **info,
+        },
+    }
+
+
+class SaveExtractionTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.document = self.store("a.pdf", b"%PDF-1.4 a")
+
+    def test_ocr_pages(self):
+        result = [
+            {"page": 1, "text": "Invoice INV-1", "source": "text"},
+            {"page": 2, "text": "Total 70.00", "source": "ocr"},
+        ]
+        self.assertEqual(save_extraction(self.document, "ocr", result), [])
+        # A retried job writes the same pages again; they are kept once
+        save_extraction(self.document, "ocr", result)
+        pages = DocumentPage.objects.filter(document=self.document)
+        self.assertEqual(list(pages.values_list("number", "text", "source")),
+                         [(1, "Invoice INV-1", "text"), (2, "Total 70.00", "ocr")])
+        self.assertEqual(Document.objects.get(pk=self.document.pk).page_count, 2)
+
+    def test_vision_pages_become_invoices_with_line_items(self):
+        invoices = save_extraction(self.document, "auto", [
+            _vision_page(1, "INV-1", "$70.00", engine="ocr"), _vision_page(2, "INV-2", "1.234,50"),
+            {"page": 3, "extracted_info": None},
+        ])
+        self.assertEqual([(invoice.page, invoice.engine) for invoice in invoices], [(1, "ocr"), (2, "auto")])
+        first = Invoice.objects.get(invoice_number="INV-1")
+        self.assertEqual((first.total_amount, first.currency, first.invoice_date),
+                         (Decimal("70.00"), "USD", date(2024, 3, 1)))
+        self.assertEqual(Invoice.objects.get(invoice_number="INV-2").total_amount, Decimal("1234.50"))
+        self.assertEqual(
+            list(first.line_items.values_list("position", "description", "quantity", "amount")),
+            [(1, "Printer paper A4", Decimal("2"), Decimal("9.00")), (2, "Toner cartridge", Decimal("1"), Decimal("61.00"))],
+        )
+        self.assertEqual(Document.objects.get(pk=self.document.pk).page_count, 3)
+
+    def test_document_ai_dict(self):
+        invoice, = save_extraction(self.document, "documentai", {
+            "supplier_name": "Acme", "invoice_id": "INV-9", "invoice_date": "03/01/2024", "total_cost": "€12.00",
+        })
+        self.assertEqual((invoice.page, invoice.vendor_name, invoice.invoice_number, invoice.currency),
+                         (None, "Acme", "INV-9", "EUR"))
+
+    def test_non_finite_and_oversized_amounts_are_dropped(self):
+        job = ExtractionJob.objects.create(
+            owner=self.owner, document=self.document, file_path=self.document.file_path, engine="vision",
+            status=ExtractionJob.STATUS_RUNNING,
+        )
+        page = _vision_page(1, "INV-1", float("nan"))
+        page["extracted_info"]["costs"] = [
+            {"description": "Bad", "quantity": float("inf"), "unit_price": float("-inf"), "amount": 1e15},
+        ]
+        complete_job(job, [page])
+        self.assertEqual(job.status, ExtractionJob.STATUS_DONE)
+        invoice = Invoice.objects.get()
+        self.assertIsNone(invoice.total_amount)
+        self.assertEqual(list(invoice.line_items.values_list("quantity", "unit_price", "amount")), [(None, None, None)])
+        self.assertIsNone(job.result[0]["extracted_info"]["total_amount"])
+        for value in (float("nan"), float("inf"), Decimal("NaN"), Decimal("-Infinity")):
+            self.assertIsNone(_amount(value))
+
+    def test_resent_invoices_point_at_the_first_copy(self):
+        original, = save_extraction(self.document, "vision", [_vision_page(1, "INV-0042", "70.00", vendor="ACME, Inc.")])
+        copy, other = save_extraction(self.store("b.pdf", b"%PDF-1.4 b"), "vision", [
+            _vision_page(1, "inv 0042", "70", vendor="Acme"), _vision_page(2, "INV-0043", "70.00", vendor="Acme"),
+        ])
+        again, = save_extraction(self.store("c.pdf", b"%PDF-1.4 c"), "vision", [_vision_page(1, "INV-0042", "70.00", vendor="Acme")])
+        self.assertEqual((copy.duplicate_of_id, other.duplicate_of_id, again.duplicate_of_id), (original.pk, None, original.pk))
+
+        stranger = User.objects.create_user("stranger", password="pw")
+        document = create_document(stranger, self.document.file_path, "", 0, "a.pdf")
+        theirs, = save_extraction(document, "vision", [_vision_page(1, "INV-0042", "70.00", vendor="Acme")])
+        self.assertIsNone(theirs.duplicate_of_id)
+
+
+class InvoiceListTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        self.first = self.store("a.pdf", b"%PDF-1.4 a")
+        save_extraction(self.first, "vision", [
+            _vision_page(1, "INV-1", "10.00"), _vision_page(2, "INV-2", "20.00", vendor="Globex", currency="EUR"),
+        ])
+        save_extraction(self.store("b.pdf", b"%PDF-1.4 b"), "vision", [
+            _vision_page(1, "INV-3", "30.00", date="2024-04-15"), _vision_page(2, "INV-1", "10.00"),
+        ])
+        other = User.objects.create_user("other", password="pw")
+        save_extraction(create_document(other, "uploads/x.pdf", "", 0, "x.pdf"), "vision", [_vision_page(1, "INV-9", "9.00")])
+
+    def numbers(self, **params):
+        response = self.client.get("/api/invoices/", params)
+        self.assertEqual(response.status_code, 200)
+        return [invoice["invoice_number"] for invoice in response.data["results"]]
+
+    def test_keyset_pages_cover_every_invoice_once(self):
+        response = self.client.get("/api/invoices/", {"page_size": 3})
+        numbers = [invoice["invoice_number"] for invoice in response.data["results"]]
+        self.assertIsNone(response.data["previous"])
+        response = self.client.get(response.data["next"])
+        numbers += [invoice["invoice_number"] for invoice in response.data["results"]]
+        self.assertIsNone(response.data["next"])
+        self.assertEqual(numbers, ["INV-1", "INV-3", "INV-2", "INV-1"])
+
+    def test_filters(self):
+        self.assertEqual(self.numbers(vendor="Globex"), ["INV-2"])
+        self.assertEqual(self.numbers(invoice_number="INV-1"), ["INV-1", "INV-1"])
+        self.assertEqual(self.numbers(currency="eur"), ["INV-2"])
+        self.assertEqual(self.numbers(content_hash=self.first.content_hash), ["INV-2", "INV-1"])
+        self.assertEqual(self.numbers(date_from="2024-04-01"), ["INV-3"])
+        self.assertEqual(self.numbers(date_to="2024-03-31"), ["INV-1", "INV-2", "INV-1"])
+        self.assertEqual(self.numbers(duplicates="exclude"), ["INV-3", "INV-2", "INV-1"])
+
+    def test_line_items_are_included(self):
+        invoice = self.client.get("/api/invoices/", {"invoice_number": "INV-3"}).data["results"][0]
+        self.assertEqual([item["description"] for item in invoice["line_items"]], ["Printer paper A4", "Toner cartridge"])
+        self.assertEqual(invoice["file_path"], "uploads/b.pdf")
+
+
+class JobEventsTests(OutputDirsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.user = User.objects.create_user("alice", password="pw")
+        self.job = ExtractionJob.objects.create(
+            owner=self.user, file_path="uploads/a.pdf", engine="ocr", status=ExtractionJob.STATUS_DONE, result=[],
+        )
+        self.token = str(AccessToken.for_user(self.user))
+        self.url = f"/api/jobs/{self.job.pk}/events/"
+
+    async def read_events(self, response):
+        return b"".join([chunk async for chunk in response.streaming_content]).decode()
+
+    async def test_finished_job_streams_its_final_event(self):
+        response = await AsyncClient().get(self.url, headers={"Authorization": f"Bearer {self.token}"})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertIn("event: done", await self.read_events(response))
+
+    async def test_token_in_query_string(self):
+        response = await AsyncClient().get(self.url, {"token": self.token})
+        self.assertEqual(response.status_code, 200)
+
+    async def test_missing_or_malformed_token_is_401(self):
+        self.assertEqual((await AsyncClient().get(self.url)).status_code, 401)
+        self.assertEqual((await AsyncClient().get(self.url, {"token": "not-a-jwt"})).status_code, 401)
+
+    async def test_token_of_inactive_user_is_401(self):
+        self.user.is_active = False
+        await self.user.asave(update_fields=["is_active"])
+        self.assertEqual((await AsyncClient().get(self.url, {"token": self.token})).status_code, 401)
+        response = await AsyncClient().get(self.url, headers={"Authorization": f"Bearer {self.token}"})
+        self.assertEqual(response.status_code, 401)
+
+    async def test_token_of_deleted_user_is_401(self):
+        await self.user.adelete()
+        self.assertEqual((await AsyncClient().get(self.url, {"token": self.token})).status_code, 401)
+
+    async def test_other_users_job_is_404(self):
+        other = await User.objects.acreate_user("bob", password="pw")
+        response = await AsyncClient().get(self.url, {"token": str(AccessToken.for_user(other))})
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(EXTRACTION_JOB_MAX_ATTEMPTS=3)
+class JobQueueTests(OutputDirsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.owner = User.objects.create_user("owner", password="pw")
+
+    def running(self, attempts, ago):
+        job = enqueue_job(self.owner, f"uploads/{attempts}-{ago.seconds}.pdf", "ocr")
+        ExtractionJob.objects.filter(pk=job.pk).update(
+            status=ExtractionJob.STATUS_RUNNING, attempts=attempts, started_at=timezone.now() - ago,
+        )
+        return job
+
+    def test_claim_moves_the_job_to_running(self):
+        job = enqueue_job(self.owner, "uploads/a.pdf", "ocr")
+        claimed = claim_next_job()
+        self.assertEqual((claimed.pk, claimed.status, claimed.attempts), (job.pk, ExtractionJob.STATUS_RUNNING, 1))
+        self.assertIsNotNone(claimed.started_at)
+        self.assertIsNone(claim_next_job())
+
+    def test_claim_that_loses_the_race_tries_the_next_candidate(self):
+        taken = enqueue_job(self.owner, "uploads/a.pdf", "ocr")
+        free = enqueue_job(self.owner, "uploads/b.pdf", "ocr")
+        # Another runner claims the first candidate between the candidate query and this runner's UPDATE
+        ExtractionJob.objects.filter(pk=taken.pk).update(status=ExtractionJob.STATUS_RUNNING, attempts=1)
+        with mock.patch("api.jobs.fair_candidates", return_value=[taken.pk, free.pk]):
+            claimed = claim_next_job()
+        self.assertEqual(claimed.pk, free.pk)
+        self.assertEqual(ExtractionJob.objects.get(pk=taken.pk).attempts, 1)
+
+    def test_claim_when_every_candidate_is_taken(self):
+        taken = enqueue_job(self.owner, "uploads/a.pdf", "ocr")
+        ExtractionJob.objects.filter(pk=taken.pk).update(status=ExtractionJob.STATUS_DONE)
+        with mock.patch("api.jobs.fair_candidates", return_value=[taken.pk]):
+            self.assertIsNone(claim_next_job())
+
+    def test_stale_running_jobs_are_requeued(self):
+        stale = self.running(attempts=1, ago=timedelta(hours=1))
+        fresh = self.running(attempts=1, ago=timedelta(seconds=5))
+        self.assertEqual(requeue_stale_jobs(60), 1)
+        stale.refresh_from_db()
+        self.assertEqual((stale.status, stale.started_at), (ExtractionJob.STATUS_QUEUED, None))
+        self.assertEqual(ExtractionJob.objects.get(pk=fresh.pk).status, ExtractionJob.STATUS_RUNNING)
+        self.assertEqual(claim_next_job().attempts, 2)
+
+    def test_job_out_of_attempts_is_failed(self):
+        exhausted = self.running(attempts=3, ago=timedelta(hours=1))
+        retried = self.running(attempts=2, ago=timedelta(hours=1))
+        self.assertEqual(requeue_stale_jobs(60), 1)
+        exhausted.refresh_from_db()
+        self.assertEqual(exhausted.status, ExtractionJob.STATUS_FAILED)
+        self.assertEqual(exhausted.error, "Gave up after 3 attempts")
+        self.assertIsNotNone(exhausted.finished_at)
+        self.assertEqual(ExtractionJob.objects.get(pk=retried.pk).status, ExtractionJob.STATUS_QUEUED)
+        self.assertEqual(requeue_stale_jobs(60, max_attempts=1), 0)
+
+
+@override_settings(EXTRACTION_USER_MAX_RUNNING=2, EXTRACTION_USER_PAGES_PER_MINUTE=120, EXTRACTION_USER_MAX_QUEUED_PAGES=100)
+class SchedulerTests(OutputDirsMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.alice = User.objects.create_user("alice", password="pw")
+        self.bob = User.objects.create_user("bob", password="pw")
+
+    def queue(self, owner, count=1, pages=1):
+        return [enqueue_job(owner, f"uploads/{owner.username}-{n}.pdf", "ocr", pages=pages) for n in range(count)]
+
+    def start(self, owner, count=1, pages=1, ago=timedelta(seconds=10)):
+        for job in self.queue(owner, count, pages):
+            ExtractionJob.objects.filter(pk=job.pk).update(
+                status=ExtractionJob.STATUS_RUNNING, started_at=timezone.now() - ago,
+            )
+
+    def owners(self):
+        return [ExtractionJob.objects.get(pk=pk).owner for pk in fair_candidates()]
+
+    def test_least_recent_throughput_goes_first(self):
+        self.queue(self.alice, 5)
+        self.queue(self.bob, 1)
+        self.start(self.alice, 1, pages=30, ago=timedelta(minutes=5))
+        ExtractionJob.objects.filter(owner=self.alice, status=ExtractionJob.STATUS_RUNNING).update(
+            status=ExtractionJob.STATUS_DONE, started_at=timezone.now() - timedelta(seconds=5),
+        )
+        self.assertEqual(self.owners(), [self.bob, self.alice])
+
+    def test_weight_scales_throughput(self):
+        ExtractionQuota.objects.create(owner=self.alice, weight=10)
+        self.queue(self.alice, 2)
+        self.queue(self.bob, 2)
+        self.start(self.alice, 1, pages=20)
+        self.start(self.bob, 1, pages=5)
+        self.assertEqual(self.owners(), [self.alice, self.bob])
+
+    def test_oldest_backlog_breaks_ties(self):
+        self.queue(self.bob, 1)
+        self.queue(self.alice, 1)
+        self.assertEqual(self.owners(), [self.bob, self.alice])
+
+    def test_owner_at_max_running_yields_to_others(self):
+        self.start(self.alice, 2)
+        self.queue(self.alice, 3)
+        self.queue(self.bob, 1)
+        self.assertEqual(self.owners(), [self.bob, self.alice])
+
+    def test_single_tenant_is_not_capped_by_max_running(self):
+        self.start(self.alice, 2)
+        self.queue(self.alice, 3)
+        claimed = [claim_next_job() for _ in range(3)]
+        self.assertTrue(all(claimed))
+        self.assertEqual(ExtractionJob.objects.filter(status=ExtractionJob.STATUS_RUNNING).count(), 5)
+        self.assertIsNone(claim_next_job())
+
+    def test_pages_per_minute_budget(self):
+        self.start(self.alice, 1, pages=110)
+        self.queue(self.alice, 1, pages=20)
+        self.queue(self.bob, 1, pages=20)
+        self.assertEqual(self.owners(), [self.bob])
+
+    def test_oversized_job_runs_once_the_window_is_empty(self):
+        self.queue(self.alice, 1, pages=500)
+        self.assertEqual(self.owners(), [self.alice])
+
+    def test_claims_follow_the_fair_order(self):
+        self.queue(self.alice, 3)
+        self.queue(self.bob, 1)
+        first, second = claim_next_job(), claim_next_job()
+        self.assertEqual({first.owner, second.owner}, {self.alice, self.bob})
+        self.assertEqual(first.attempts, 1)
+        self.assertEqual(first.status, ExtractionJob.STATUS_RUNNING)
+
+
+@override_settings(EXTRACTION_USER_MAX_RUNNING=2, EXTRACTION_USER_PAGES_PER_MINUTE=120, EXTRACTION_USER_MAX_QUEUED_PAGES=100)
+class QuotaTests(MediaRootMixin, TestCase):
+    def test_defaults_and_overrides(self):
+        ExtractionQuota.objects.create(owner=self.owner, max_queued_pages=10, weight=0)
+        other = User.objects.create_user("other", password="pw")
+        quotas = quotas_for([self.owner.pk, other.pk])
+        self.assertEqual((quotas[self.owner.pk].max_queued_pages, quotas[self.owner.pk].max_running), (10, 2))
+        self.assertEqual(quotas[self.owner.pk].weight, 1.0)
+        self.assertEqual(quotas[other.pk].max_queued_pages, 100)
+
+    def test_backlog_cap(self):
+        enqueue_job(self.owner, "uploads/a.pdf", "ocr", pages=90)
+        check_upload(self.owner, 10)
+        with self.assertRaises(Throttled) as raised:
+            check_upload(self.owner, 11)
+        # 1 page over at 120 pages a minute; DRF rounds the wait up to whole seconds
+        self.assertEqual(raised.exception.wait, 1)
+
+    def test_empty_queue_takes_any_upload(self):
+        check_upload(self.owner, 5000)
+
+    def test_admitted_job_counts_against_the_next_upload(self):
+        enqueue_job(self.owner, "uploads/a.pdf", "ocr", pages=50)
+        with admitting(self.owner, 40):
+            enqueue_job(self.owner, "uploads/b.pdf", "ocr", pages=40)
+        with self.assertRaises(Throttled):
+            with admitting(self.owner, 40):
+                self.fail("a second upload must not be admitted")
+
+    def test_refused_upload_leaves_nothing_behind(self):
+        enqueue_job(self.owner, "uploads/a.pdf", "ocr", pages=100)
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        response = client.post("/api/upload/", {"file": _content_png()}, format="multipart")
+        self.assertEqual(response.status_code, 429)
+        self.assertFalse(Document.objects.exists())
+        self.assertEqual(ExtractionJob.objects.count(), 1)
+
+    def test_upload_under_the_cap_is_queued(self):
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        response = client.post("/api/upload/", {"file": _content_png()}, format="multipart")
+        self.assertEqual(response.status_code, 202)
+        job = ExtractionJob.objects.get(pk=response.data["job_id"])
+        self.assertEqual((job.status, job.pages), (ExtractionJob.STATUS_QUEUED, 1))
+
+    def test_queue_usage_endpoint(self):
+        enqueue_job(self.owner, "uploads/a.pdf", "ocr", pages=7)
+        client = APIClient()
+        client.force_authenticate(self.owner)
+        data = client.get("/api/queue/").data
+        self.assertEqual((data["queued_jobs"], data["queued_pages"]), (1, 7))
+        self.assertEqual(data["limits"]["max_queued_pages"], 100)
+        self.assertNotIn("users", data)
+
+
+def _content_png():
+    buffer = ContentFile(b"", name="receipt.png")
+    Image.new("RGB", (60, 80), "white").save(buffer, format="PNG")
+    buffer.seek(0)
+    return buffer
+
+
+class ChunkedUploadTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = APIClient()
+        self.client.force_authenticate(self.owner)
+        self.content = _content_png().read()
+        self.sha256 = hashlib.sha256(self.content).hexdigest()
+
+    def start(self, size=None):
+        response = self.client.post("/api/upload/chunked/", {"filename": "scans/receipt.png", "size": size or len(self.content)})
+        self.assertEqual(response.status_code, 201)
+        return f"/api/upload/chunked/{response.data['id']}/"
+
+    def put(self, url, start, end, data=None):
+        data = self.content[start:end] if data is None else data
+        return self.client.put(
+            url, data, content_type="application/octet-stream",
+            HTTP_CONTENT_RANGE=f"bytes {start}-{start + len(data) - 1}/{len(self.content)}",
+        )
+
+    def complete(self, url, sha256=None):
+        return self.client.post(f"{url}complete/", {"sha256": sha256 or self.sha256}, format="json")
+
+    def test_chunks_resume_from_the_reported_offset(self):
+        url = self.start()
+        middle = len(self.content) // 2
+        self.assertEqual(self.put(url, 0, middle).data["offset"], middle)
+
+        # An interrupted client asks where to carry on; a chunk anywhere else is refused
+        self.assertEqual(self.client.get(url).data["offset"], middle)
+        conflict = self.put(url, 0, middle)
+        self.assertEqual((conflict.status_code, conflict.data["offset"]), (409, middle))
+
+        self.assertEqual(self.put(url, middle, None).data["offset"], len(self.content))
+        response = self.complete(url)
+        self.assertEqual(response.status_code, 202)
+        document = Document.objects.get()
+        self.assertEqual((document.original_name, document.content_hash), ("receipt.png", self.sha256))
+        with default_storage.open(document.file_path, "rb") as f:
+            self.assertEqual(f.read(), self.content)
+        self.assertEqual(ExtractionJob.objects.get(pk=response.data["job_id"]).status, ExtractionJob.STATUS_QUEUED)
+
+    def test_partial_tail_of_an_interrupted_chunk_is_dropped(self):
+        url = self.start()
+        middle = len(self.content) // 2
+        self.put(url, 0, middle)
+        upload = ChunkedUpload.objects.get()
+        # The server died while writing the next chunk: bytes are on disk but the offset never moved
+        with open(partial_upload_path(upload), "ab") as part:
+            part.write(b"half a chunk")
+
+        self.put(url, middle, None)
+        self.assertEqual(self.complete(url).status_code, 202)
+        self.assertFalse(os.path.exists(partial_upload_path(upload)))
+
+    def test_short_chunk_keeps_what_arrived(self):
+        self.start()
+        upload = ChunkedUpload.objects.get()
+        self.assertFalse(append_chunk(upload, ContentFile(self.content[:10]), 40))
+        upload.refresh_from_db()
+        self.assertEqual(upload.offset, 10)
+        self.assertTrue(append_chunk(upload, ContentFile(self.content[10:50]), 40))
+        self.assertEqual(upload.offset, 50)
+
+    def test_chunk_past_the_declared_size_is_refused(self):
+        url = self.start(size=10)
+        self.assertEqual(self.put(url, 0, None, data=self.content[:20]).status_code, 413)
+        self.assertEqual(ChunkedUpload.objects.get().offset, 0)
+        with self.assertRaises(PayloadTooLarge):
+            append_chunk(ChunkedUpload.objects.get(), ContentFile(self.content), 20)
+
+    @override_settings(UPLOAD_MAX_BYTES=64, UPLOAD_MAX_CHUNK_BYTES=32)
+    def test_size_limits(self):
+        response = self.client.post("/api/upload/chunked/", {"filename": "big.png", "size": 65})
+        self.assertEqual(response.status_code, 400)
+        url = self.start(size=64)
+        self.assertEqual(self.put(url, 0, 33).status_code, 413)
+
+    @override_settings(UPLOAD_MAX_BYTES=64)
+    def test_multipart_upload_is_cut_off_while_it_streams(self):
+        with mock.patch("api.views.default_storage.save") as save:
+            response = self.client.post("/api/upload/", {"file": _content_png()}, format="multipart")
+        self.assertEqual(response.status_code, 413)
+        save.assert_not_called()
+        self.assertFalse(Document.objects.exists())
+
+    def test_checksum_mismatch_keeps_the_upload_open(self):
+        url = self.start()
+        self.put(url, 0, None)
+        response = self.complete(url, sha256="0" * 64)
+        self.assertEqual(response.status_code, 400)
+        upload = ChunkedUpload.objects.get()
+        self.assertEqual(upload.status, ChunkedUpload.STATUS_UPLOADING)
+        self.assertTrue(os.path.exists(partial_upload_path(upload)))
+        self.assertFalse(Document.objects.exists())
+
+        self.assertEqual(self.complete(url).status_code, 202)
+
+    def test_completing_twice_creates_one_document(self):
+        url = self.start()
+        self.put(url, 0, None)
+        self.assertEqual(self.complete(url).status_code, 202)
+        self.assertEqual(self.complete(url).status_code, 404)
+        self.assertEqual((Document.objects.count(), ExtractionJob.objects.count()), (1, 1))
+
+    def test_completion_that_loses_the_race_is_404(self):
+        url = self.start()
+        self.put(url, 0, None)
+
+        def other_request_completes(*args):
+            # The competing request claims the upload after this one has loaded it
+            ChunkedUpload.objects.update(status=ChunkedUpload.STATUS_COMPLETE)
+
+        with mock.patch("api.views.check_upload", side_effect=other_request_completes):
+            response = self.complete(url)
+        self.assertEqual(response.status_code, 404)
+        self.assertTrue(os.path.exists(partial_upload_path(ChunkedUpload.objects.get())))
+        self.assertFalse(Document.objects.exists())
@@ -0,0 +1,96 @@
+import hashlib
+import os
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.files.uploadhandler import MemoryFileUploadHandler, TemporaryFileUploadHandler
+from rest_framework import status
+from rest_framework.exceptions import APIException
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+class PayloadTooLarge(APIException):
+    status_code = status.HTTP_413_REQUEST_ENTITY_TOO_LARGE
+    default_detail = "Upload exceeds the maximum allowed size."
+    default_code = "payload_too_large"
+
+
+class HashingUploadMixin:
+    """
+    Hash and size-check multipart file data as it streams in.
+    The SHA-256 digest ends up on the uploaded file as ``content_hash``, and
+    the upload is aborted as soon as it grows past UPLOAD_MAX_BYTES.
+    """
+
+    def new_file(self, *args, **kwargs):
+        self.digest = hashlib.sha256()
+        self.received = 0
+        super().new_file(*args, **kwargs)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.received += len(raw_data)
+        if self.received > settings.UPLOAD_MAX_BYTES:
+            raise PayloadTooLarge()
+        self.digest.update(raw_data)
+        return super().receive_data_chunk(raw_data, start)
+
+    def file_complete(self, file_size):
+        uploaded_file = super().file_complete(file_size)
+        if uploaded_file is not None:
+            uploaded_file.content_hash = self.digest.hexdigest()
+        return uploaded_file
+
+
+class HashingMemoryFileUploadHandler(HashingUploadMixin, MemoryFileUploadHandler):
+    pass
+
+
+class HashingTemporaryFileUploadHandler(HashingUploadMixin, TemporaryFileUploadHandler):
+    pass
+
+
+def partial_upload_path(upload):
+    """Local file that collects the chunks of a resumable upload"""
+    os.makedirs(settings.CHUNKED_UPLOAD_DIR, exist_ok=True)
+    return os.path.join(settings.CHUNKED_UPLOAD_DIR, f"{upload.pk}.part")
+
+
+def append_chunk(upload, stream, length):
+    """Append length bytes from stream to a resumable upload, never holding more than one block in memory."""
+    if upload.offset + length > upload.size:
+        raise PayloadTooLarge("Chunk runs past the declared upload size.")
+
+    remaining = length
+    with open(partial_upload_path(upload), "ab") as part:
+        if part.tell() != upload.offset:
+            # A previous chunk was cut off mid-write; drop the partial tail so the client can resend it
+            part.truncate(upload.offset)
+        while remaining:
+            block = stream.read(min(HASH_BLOCK_SIZE, remaining))
+            if not block:
+                break
+            part.write(block)
+            remaining -= len(block)
+
+    upload.offset += length - remaining
+    upload.save(update_fields=["offset", "updated_at"])
+    return remaining == 0
+
+
+def finalize_chunked_upload(upload, expected_hash=None):
+    """
+    Hash the assembled file, move it into storage and return (storage path, content hash).
+    Raises ValueError, leaving the partial file in place, if expected_hash does not match.
+    """
+    part_path = partial_upload_path(upload)
+    digest = hashlib.sha256()
+    with open(part_path, "rb") as part:
+        for block in iter(lambda: part.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+        if expected_hash and expected_hash.lower() != digest.hexdigest():
+            raise ValueError("Uploaded data does not match the expected SHA-256 checksum.")
+        part.seek(0)
+        file_path = default_storage.save(f"uploads/{upload.filename}", File(part, name=upload.filename))
+    os.remove(part_path)
+    return file_path, digest.hexdigest()
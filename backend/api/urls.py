@@ -1,6 +1,24 @@
 from django.urls import path
-from .views import UploadView
+from .views import (
+    UploadView,
+    ExtractionJobDetailView,
+    ChunkedUploadCreateView,
+    ChunkedUploadView,
+    ChunkedUploadCompleteView,
+    InvoiceListView,
+    MetricsView,
+    QueueUsageView,
+    job_events,
+)
 
 urlpatterns = [
-    path("upload/", UploadView.as_view(), name="upload")
+    path("upload/", UploadView.as_view(), name="upload"),
+    path("upload/chunked/", ChunkedUploadCreateView.as_view(), name="chunked-upload-create"),
+    path("upload/chunked/<uuid:pk>/", ChunkedUploadView.as_view(), name="chunked-upload"),
+    path("upload/chunked/<uuid:pk>/complete/", ChunkedUploadCompleteView.as_view(), name="chunked-upload-complete"),
+    path("invoices/", InvoiceListView.as_view(), name="invoice-list"),
+    path("jobs/<int:pk>/", ExtractionJobDetailView.as_view(), name="job-detail"),
+    path("jobs/<int:pk>/events/", job_events, name="job-events"),
+    path("queue/", QueueUsageView.as_view(), name="queue-usage"),
+    path("metrics/", MetricsView.as_view(), name="metrics"),
 ]
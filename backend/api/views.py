@@ -1,12 +1,62 @@
-from django.shortcuts import render
+import asyncio
+import ipaddress
+import json
+import re
+import time
+from asgiref.sync import sync_to_async
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.shortcuts import render, get_object_or_404
+from django.utils import timezone
 from django.contrib.auth.models import User
 from rest_framework.views import APIView
 from rest_framework.response import Response
-from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.permissions import IsAuthenticated, AllowAny, BasePermission
 from rest_framework import status, generics
 from django.core.files.storage import default_storage
-from django.core.files.base import ContentFile
-from .serializers import UserSerializer
+from django.conf import settings
+from rest_framework.exceptions import AuthenticationFailed, Throttled
+from rest_framework.pagination import CursorPagination
+from rest_framework_simplejwt.authentication import JWTAuthentication
+from rest_framework_simplejwt.exceptions import TokenError
+from .models import ExtractionJob, ChunkedUpload, Invoice
+from .serializers import UserSerializer, ExtractionJobSerializer, ChunkedUploadSerializer, InvoiceSerializer
+from .duplicates import fingerprint_document, submit_document
+from .quotas import admitting, check_upload, empty_usage, quotas_for, usage
+from .records import create_document
+from .uploads import PayloadTooLarge, append_chunk, finalize_chunked_upload, partial_upload_path
+from module_data_extraction import progress
+from module_data_extraction.rasterizer import file_page_count
+from module_data_extraction.telemetry import collect, render_prometheus
+
+CONTENT_RANGE_RE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+
+def admit_document(user, document, engine, pages):
+    """Fingerprint, then queue the document under the user's quota lock; a refused document is deleted."""
+    fingerprint_document(document)
+    try:
+        with admitting(user, pages):
+            return submit_document(user, document, engine, fingerprinted=True)
+    except Throttled:
+        default_storage.delete(document.file_path)
+        document.delete()
+        raise
+
+
+def upload_accepted(file_path, job):
+    document = job.document
+    return Response(
+        {
+            "message": "File uploaded successfully",
+            "path": file_path,
+            "job_id": job.id,
+            "status": job.status,
+            "duplicate_of": document.duplicate_of_id if document else None,
+            "duplicate_kind": document.duplicate_kind if document else "",
+        },
+        status=status.HTTP_202_ACCEPTED,
+    )
+
 
 class UploadView(APIView):
     permission_classes = [IsAuthenticated]
@@ -15,10 +65,260 @@ class UploadView(APIView):
         file_obj = request.FILES.get("file")
         if not file_obj:
             return Response({"error": "No file uploaded"}, status=status.HTTP_400_BAD_REQUEST)
-        file_path = default_storage.save(f"uploads/{file_obj.name}", ContentFile(file_obj.read()))
+        engine = request.data.get("engine", settings.EXTRACTION_DEFAULT_ENGINE)
+        if engine not in dict(ExtractionJob.ENGINE_CHOICES):
+            return Response({"error": f"Unknown extraction engine: {engine}"}, status=status.HTTP_400_BAD_REQUEST)
+        # Storage streams the upload chunk by chunk (or moves the temp file) instead of reading it whole
+        file_path = default_storage.save(f"uploads/{file_obj.name}", file_obj)
+        pages = file_page_count(default_storage.path(file_path))
+        try:
+            # Refuse early without a lock; admitting() re-checks atomically with the job insert
+            check_upload(request.user, pages)
+        except Throttled:
+            default_storage.delete(file_path)
+            raise
+        content_hash = getattr(file_obj, "content_hash", "")
+        document = create_document(request.user, file_path, content_hash, file_obj.size, file_obj.name, pages)
+        job = admit_document(request.user, document, engine, pages)
+
+        return upload_accepted(file_path, job)
+
+
+class ChunkedUploadCreateView(generics.CreateAPIView):
+    """Start a resumable upload; the client then PUTs chunks to the returned id."""
+    serializer_class = ChunkedUploadSerializer
+    permission_classes = [IsAuthenticated]
+
+    def perform_create(self, serializer):
+        serializer.save(owner=self.request.user)
+
+
+class ChunkedUploadView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def get_upload(self, request, pk):
+        return get_object_or_404(ChunkedUpload, pk=pk, owner=request.user, status=ChunkedUpload.STATUS_UPLOADING)
+
+    def get(self, request, pk, format=None):
+        """Report how many bytes have been received so an interrupted client can resume."""
+        return Response(ChunkedUploadSerializer(self.get_upload(request, pk)).data)
+
+    def put(self, request, pk, format=None):
+        """Append one raw chunk, optionally positioned with a Content-Range header."""
+        upload = self.get_upload(request, pk)
+        length = int(request.META.get("CONTENT_LENGTH") or 0)
+        if length > settings.UPLOAD_MAX_CHUNK_BYTES:
+            raise PayloadTooLarge(f"Chunks are limited to {settings.UPLOAD_MAX_CHUNK_BYTES} bytes.")
+        if not length:
+            return Response({"error": "Empty chunk"}, status=status.HTTP_400_BAD_REQUEST)
+
+        match = CONTENT_RANGE_RE.match(request.META.get("HTTP_CONTENT_RANGE", ""))
+        if match and int(match.group(1)) != upload.offset:
+            return Response(
+                {"error": "Chunk does not start at the current offset", "offset": upload.offset},
+                status=status.HTTP_409_CONFLICT,
+            )
+
+        if not append_chunk(upload, request.stream, length):
+            return Response(
+                {"error": "Chunk was truncated", "offset": upload.offset},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        return Response(ChunkedUploadSerializer(upload).data)
+
+
+class ChunkedUploadCompleteView(APIView):
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request, pk, format=None):
+        upload = get_object_or_404(ChunkedUpload, pk=pk, owner=request.user, status=ChunkedUpload.STATUS_UPLOADING)
+        if upload.offset != upload.size:
+            return Response(
+                {"error": "Upload is incomplete", "offset": upload.offset, "size": upload.size},
+                status=status.HTTP_400_BAD_REQUEST,
+            )
+        # Checked before the parts are assembled, so a throttled client can complete the same upload later.
+        # Only an upload that loses a race with another one is refused after assembly, by admit_document
+        pages = file_page_count(partial_upload_path(upload))
+        check_upload(request.user, pages)
+        # The conditional UPDATE claims the upload, so a second completion sent alongside this one gets a 404
+        # instead of assembling a part file that is already being moved into storage
+        uploading = ChunkedUpload.objects.filter(pk=upload.pk, status=ChunkedUpload.STATUS_UPLOADING)
+        if not uploading.update(status=ChunkedUpload.STATUS_COMPLETE, updated_at=timezone.now()):
+            raise Http404
+        try:
+            file_path, content_hash = finalize_chunked_upload(upload, expected_hash=request.data.get("sha256"))
+        except ValueError as e:
+            # The parts are kept, so the client can fix the checksum or resend and complete again
+            ChunkedUpload.objects.filter(pk=upload.pk).update(status=ChunkedUpload.STATUS_UPLOADING)
+            return Response({"error": str(e)}, status=status.HTTP_400_BAD_REQUEST)
+
+        document = create_document(request.user, file_path, content_hash, upload.size, upload.filename, pages)
+        job = admit_document(request.user, document, upload.engine, pages)
+
+        return upload_accepted(file_path, job)
+
+
+class ExtractionJobDetailView(generics.RetrieveAPIView):
+    serializer_class = ExtractionJobSerializer
+    permission_classes = [IsAuthenticated]
+
+    def get_queryset(self):
+        return ExtractionJob.objects.filter(owner=self.request.user)
+
+
+def _stream_user(request):
+    """Authenticate a JWT from the Authorization header or, for EventSource clients, ?token=."""
+    auth = JWTAuthentication()
+    try:
+        if request.GET.get("token"):
+            return auth.get_user(auth.get_validated_token(request.GET["token"]))
+        authenticated = auth.authenticate(request)
+    except (AuthenticationFailed, TokenError):
+        # InvalidToken is an AuthenticationFailed, as are tokens of deleted or inactive users
+        return None
+    return authenticated[0] if authenticated else None
+
+
+def _sse(event_id, event_type, data):
+    return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+async def _job_event_stream(job, last_event_id):
+    """Yield the job's page events as they are written, then a final done/failed event."""
+    offset, sent, last_write = 0, 0, time.monotonic()
+    while True:
+        # Read the status before the file so no page written before completion is missed
+        status_row = await ExtractionJob.objects.filter(pk=job.pk).values("status", "error").afirst()
+        events, offset = await sync_to_async(progress.read_events)(job.pk, offset, settings.EXTRACTION_PROGRESS_DIR)
+        for event in events:
+            sent += 1
+            if sent > last_event_id:
+                yield _sse(sent, event["type"], event)
+                last_write = time.monotonic()
+
+        if status_row is None or status_row["status"] in (ExtractionJob.STATUS_DONE, ExtractionJob.STATUS_FAILED):
+            job = await ExtractionJob.objects.filter(pk=job.pk).afirst()
+            if job is None:
+                return
+            data = await sync_to_async(lambda: ExtractionJobSerializer(job).data)()
+            yield _sse(sent + 1, job.status, data)
+            return
+
+        if time.monotonic() - last_write > 15:
+            # Comment line keeps proxies from closing an idle stream
+            yield ": keepalive\n\n"
+            last_write = time.monotonic()
+        await asyncio.sleep(settings.EXTRACTION_EVENTS_POLL_INTERVAL)
+
+
+async def job_events(request, pk):
+    """
+    Server-sent events for one extraction job (serve the project with an ASGI server).
+    Emits "started", one "page" event per finished page with its partial result,
+    and a final "done" or "failed" event carrying the job. Reconnecting clients
+    send Last-Event-ID and only receive what they missed.
+    """
+    user = await sync_to_async(_stream_user)(request)
+    if user is None:
+        return JsonResponse({"detail": "Authentication credentials were not provided or are invalid."}, status=401)
+    job = await ExtractionJob.objects.filter(pk=pk, owner=user).afirst()
+    if job is None:
+        raise Http404
+    try:
+        last_event_id = int(request.headers.get("Last-Event-ID") or request.GET.get("last_event_id") or 0)
+    except ValueError:
+        last_event_id = 0
+    response = StreamingHttpResponse(_job_event_stream(job, last_event_id), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    # Stop nginx from buffering the stream
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+class InvoicePagination(CursorPagination):
+    # Keyset pagination on the primary key: each page is an index range scan, however deep
+    ordering = "-id"
+    page_size = 50
+    page_size_query_param = "page_size"
+    max_page_size = 500
+
+
+class InvoiceListView(generics.ListAPIView):
+    """
+    List the user's extracted invoices, newest first.
+    Filters: vendor, invoice_number, currency, content_hash, date_from, date_to (YYYY-MM-DD),
+    duplicates=exclude to hide invoices flagged as re-sent copies.
+    """
+    serializer_class = InvoiceSerializer
+    permission_classes = [IsAuthenticated]
+    pagination_class = InvoicePagination
+
+    def get_queryset(self):
+        params = self.request.query_params
+        queryset = Invoice.objects.filter(owner=self.request.user).select_related("document").prefetch_related("line_items")
+        if params.get("vendor"):
+            queryset = queryset.filter(vendor_name=params["vendor"])
+        if params.get("invoice_number"):
+            queryset = queryset.filter(invoice_number=params["invoice_number"])
+        if params.get("currency"):
+            queryset = queryset.filter(currency=params["currency"].upper())
+        if params.get("content_hash"):
+            queryset = queryset.filter(document__content_hash=params["content_hash"])
+        if params.get("date_from"):
+            queryset = queryset.filter(invoice_date__gte=params["date_from"])
+        if params.get("date_to"):
+            queryset = queryset.filter(invoice_date__lte=params["date_to"])
+        if params.get("duplicates") == "exclude":
+            queryset = queryset.filter(duplicate_of__isnull=True)
+        return queryset
+
+
+class QueueUsageView(APIView):
+    """The caller's queue depth, recent throughput and limits; staff also see every user's usage."""
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, format=None):
+        user = request.user
+        everyone = usage()
+        quota = quotas_for([user.pk])[user.pk]
+        data = {
+            **everyone.get(user.pk, empty_usage()),
+            "limits": vars(quota),
+            "total_queued_jobs": sum(entry["queued_jobs"] for entry in everyone.values()),
+        }
+        if user.is_staff:
+            data["users"] = {str(owner_id): entry for owner_id, entry in everyone.items()}
+        return Response(data)
+
+
+class IsStaffOrScrapeNetwork(BasePermission):
+    """Staff users, or any client connecting from EXTRACTION_METRICS_ALLOWED_NETWORKS."""
+
+    def has_permission(self, request, view):
+        if request.user and request.user.is_staff:
+            return True
+        try:
+            address = ipaddress.ip_address(request.META.get("REMOTE_ADDR", ""))
+        except ValueError:
+            return False
+        return any(
+            address in ipaddress.ip_network(network, strict=False)
+            for network in settings.EXTRACTION_METRICS_ALLOWED_NETWORKS
+        )
+
+
+class MetricsView(APIView):
+    """Extraction stage latencies and counters from every process, in Prometheus text format."""
+    permission_classes = [IsStaffOrScrapeNetwork]
+
+    def get(self, request, format=None):
+        if not settings.EXTRACTION_METRICS_ENABLED:
+            raise Http404
+        snapshot = collect(settings.EXTRACTION_METRICS_DIR)
+        return HttpResponse(render_prometheus(snapshot), content_type="text/plain; version=0.0.4")
+
 
-        return Response({"message": "File uploaded successfully", "path": file_path}, status=status.HTTP_201_CREATED)
-    
 class CreateUserView(generics.CreateAPIView):
     queryset = User.objects.all()
     serializer_class = UserSerializer
@@ -44,6 +44,67 @@ REST_FRAMEWORK = {
     ],
 }
 
+# Extraction job queue
+EXTRACTION_DEFAULT_ENGINE = os.getenv("EXTRACTION_DEFAULT_ENGINE", "ocr")
+EXTRACTION_WORKERS = int(os.getenv("EXTRACTION_WORKERS", os.cpu_count() or 1))
+EXTRACTION_POLL_INTERVAL = float(os.getenv("EXTRACTION_POLL_INTERVAL", 1.0))
+EXTRACTION_JOB_TIMEOUT = int(os.getenv("EXTRACTION_JOB_TIMEOUT", 60 * 30))
+# Jobs found stale after this many claims are failed rather than requeued
+EXTRACTION_JOB_MAX_ATTEMPTS = int(os.getenv("EXTRACTION_JOB_MAX_ATTEMPTS", 3))
+# Per-page progress events written by queue workers and streamed by /api/jobs/<id>/events/
+EXTRACTION_PROGRESS_DIR = os.environ.setdefault("EXTRACTION_PROGRESS_DIR", os.path.join(BASE_DIR, "progress"))
+EXTRACTION_PROGRESS_TTL = int(os.getenv("EXTRACTION_PROGRESS_TTL", 60 * 60 * 24))
+EXTRACTION_EVENTS_POLL_INTERVAL = float(os.getenv("EXTRACTION_EVENTS_POLL_INTERVAL", 0.5))
+# Per-user defaults, overridable per user with an ExtractionQuota row; uploads past the queued-pages cap get a 429.
+# Users past MAX_RUNNING yield to other users' queued jobs but still use workers nobody else needs
+EXTRACTION_USER_MAX_RUNNING = int(os.getenv("EXTRACTION_USER_MAX_RUNNING", 2))
+EXTRACTION_USER_PAGES_PER_MINUTE = int(os.getenv("EXTRACTION_USER_PAGES_PER_MINUTE", 120))
+EXTRACTION_USER_MAX_QUEUED_PAGES = int(os.getenv("EXTRACTION_USER_MAX_QUEUED_PAGES", 2000))
+
+# Re-sent invoices: 256-bit perceptual hashes this many bits apart count as near duplicates
+# (pairs within 3 bits are always found, wider ones when one lookup band survives). They are only
+# served from the original's result when reuse is switched on and their text layers match
+EXTRACTION_NEAR_DUPLICATE_DISTANCE = int(os.getenv("EXTRACTION_NEAR_DUPLICATE_DISTANCE", 10))
+EXTRACTION_REUSE_NEAR_DUPLICATES = os.getenv("EXTRACTION_REUSE_NEAR_DUPLICATES", "0") == "1"
+# Most recent look-alike uploads compared per new document; one template's invoices all share lookup bands
+EXTRACTION_NEAR_DUPLICATE_CANDIDATES = int(os.getenv("EXTRACTION_NEAR_DUPLICATE_CANDIDATES", 200))
+
+# Stage timings and counters; every process (web, queue runner, pool workers) flushes to this directory
+EXTRACTION_METRICS_ENABLED = os.getenv("EXTRACTION_METRICS_ENABLED", "1") == "1"
+EXTRACTION_METRICS_DIR = os.environ.setdefault("EXTRACTION_METRICS_DIR", os.path.join(BASE_DIR, "metrics"))
+# /api/metrics/ answers staff users and, without a token, scrapers connecting from these networks
+EXTRACTION_METRICS_ALLOWED_NETWORKS = [
+    network.strip()
+    for network in os.getenv("EXTRACTION_METRICS_ALLOWED_NETWORKS", "127.0.0.1/32,::1/128").split(",")
+    if network.strip()
+]
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "extraction": {"format": "%(asctime)s %(levelname)s %(processName)s %(name)s: %(message)s"},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "extraction"},
+    },
+    "loggers": {
+        "module_data_extraction": {
+            "handlers": ["console"],
+            "level": os.getenv("EXTRACTION_LOG_LEVEL", "INFO"),
+        },
+    },
+}
+
+# Uploads are hashed and size-checked while they stream to disk
+UPLOAD_MAX_BYTES = int(os.getenv("UPLOAD_MAX_BYTES", 200 * 1024 * 1024))
+UPLOAD_MAX_CHUNK_BYTES = int(os.getenv("UPLOAD_MAX_CHUNK_BYTES", 16 * 1024 * 1024))
+CHUNKED_UPLOAD_DIR = os.path.join(MEDIA_ROOT, "uploads", "partial")
+FILE_UPLOAD_HANDLERS = [
+    "api.uploads.HashingMemoryFileUploadHandler",
+    "api.uploads.HashingTemporaryFileUploadHandler",
+]
+
 SIMPLE_JWT = {
     "ACCESS_TOKEN_LIFETIME": timedelta(minutes=30),
     "REFRESH_TOKEN_LIFETIME": timedelta(days=1),
@@ -102,6 +163,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Take the write lock when a transaction begins, so quota checks and job inserts serialise
+        'OPTIONS': {'transaction_mode': 'IMMEDIATE'},
     }
 }
 
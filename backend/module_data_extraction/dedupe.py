@@ -0,0 +1,135 @@
+"""
+Fingerprints for spotting re-sent invoices before they are extracted again.
+
+Four keys are used, from cheapest to most forgiving:
+- the SHA-256 of the file bytes (identical re-uploads),
+- a 256-bit difference hash of the printed area of the first page, which
+  survives re-scanning, re-compression and small shifts (near duplicates),
+- a digest of the first page's text layer, when the file has one, which
+  tells apart invoices printed from the same template,
+- a normalized (vendor, invoice number, total) key built from an extracted
+  result, which catches the same invoice arriving as a different file.
+
+The page is cropped to the bounding box of its ink before hashing. Hashing
+the whole page mostly captures the margins, so every invoice from one
+template hashed alike. For indexed candidate lookups the hash is folded
+(XOR) to 64 bits and split into PHASH_BANDS 16-bit bands. Folding never
+increases the distance between two hashes, so any pair within
+MAX_BANDED_DISTANCE bits shares at least one band exactly. Pairs a few
+bits further apart usually do too.
+"""
+import hashlib
+import re
+from PIL import Image
+from module_data_extraction.normalize import parse_amount
+from module_data_extraction.documents import PDF, document_kind, open_pdf
+from module_data_extraction.rasterizer import iter_pdf_pages
+
+HASH_SIZE = 16
+HASH_BITS = HASH_SIZE * HASH_SIZE
+PHASH_BANDS = 4
+FOLDED_BITS = 64
+BAND_BITS = FOLDED_BITS // PHASH_BANDS
+# With 4 bands, any pair of hashes differing in at most 3 bits has an identical band
+MAX_BANDED_DISTANCE = PHASH_BANDS - 1
+# A low resolution render is plenty for a 17x16 thumbnail of the printed area
+FINGERPRINT_DPI = 36
+# Grey levels darker than this (0-255) count as ink when finding the printed area
+INK_THRESHOLD = 192
+
+VENDOR_SUFFIXES = {'inc', 'incorporated', 'llc', 'ltd', 'limited', 'gmbh', 'corp', 'corporation', 'co', 'company', 'plc', 'sa', 'ag', 'bv'}
+
+
+def content_crop(image):
+    """Crop a page to the bounding box of its ink, so margins do not dominate the hash"""
+    gray = image.convert('L')
+    box = gray.point(lambda value: 255 if value < INK_THRESHOLD else 0).getbbox()
+    return gray.crop(box) if box else gray
+
+
+def perceptual_hash(image):
+    """Return the 256-bit difference hash (dHash) of a PIL image's printed area as an int"""
+    thumbnail = content_crop(image).resize((HASH_SIZE + 1, HASH_SIZE), Image.LANCZOS)
+    pixels = list(thumbnail.tobytes())
+    value = 0
+    for row in range(HASH_SIZE):
+        offset = row * (HASH_SIZE + 1)
+        for col in range(HASH_SIZE):
+            value = (value << 1) | (pixels[offset + col] > pixels[offset + col + 1])
+    return value
+
+
+def file_perceptual_hash(file_path):
+    """Hash the first page of a PDF or image file, or return None if it cannot be rendered"""
+    try:
+        if document_kind(file_path) == PDF:
+            for _, image in iter_pdf_pages(file_path, dpi=FINGERPRINT_DPI, page_numbers=[1]):
+                return perceptual_hash(image)
+            return None
+        with Image.open(file_path) as image:
+            return perceptual_hash(image)
+    except Exception:
+        return None
+
+
+def text_fingerprint(text):
+    """SHA-1 of the letters and digits in text, or '' when there are none"""
+    normalized = re.sub(r'[^0-9a-z]', '', str(text or '').lower())
+    return hashlib.sha1(normalized.encode('utf-8')).hexdigest() if normalized else ''
+
+
+def file_text_fingerprint(file_path):
+    """text_fingerprint of a PDF's first-page text layer; '' for images, scans and unreadable files"""
+    try:
+        if document_kind(file_path) != PDF:
+            return ''
+        with open_pdf(file_path) as pdf:
+            return text_fingerprint(pdf.pages[0].extract_text()) if pdf.pages else ''
+    except Exception:
+        return ''
+
+
+def fold_hash(value):
+    """XOR the 64-bit words of a perceptual hash together"""
+    folded = 0
+    for word in range(HASH_BITS // FOLDED_BITS):
+        folded ^= (value >> (word * FOLDED_BITS)) & ((1 << FOLDED_BITS) - 1)
+    return folded
+
+
+def hash_bands(value):
+    """Split a folded perceptual hash into PHASH_BANDS integers for indexed candidate lookups"""
+    folded = fold_hash(value)
+    mask = (1 << BAND_BITS) - 1
+    return [(folded >> (band * BAND_BITS)) & mask for band in range(PHASH_BANDS)]
+
+
+def hamming_distance(a, b):
+    return (a ^ b).bit_count()
+
+
+def normalize_vendor(name):
+    """Lower-case a vendor name and drop punctuation and legal suffixes ('ACME, Inc.' -> 'acme')"""
+    words = re.sub(r'[^\w\s]', ' ', str(name or '').lower()).split()
+    while words and words[-1] in VENDOR_SUFFIXES:
+        words.pop()
+    return ' '.join(words)
+
+
+def normalize_invoice_number(number):
+    """Keep only letters and digits, upper-cased, so 'inv-0042' matches 'INV 0042'"""
+    return re.sub(r'[^0-9A-Za-z]', '', str(number or '')).upper()
+
+
+def invoice_key(vendor, invoice_number, total):
+    """
+    Return a stable key for (vendor, invoice number, total), or '' when there is
+    too little to tell invoices apart (an invoice number plus a vendor or a total).
+    """
+    number = normalize_invoice_number(invoice_number)
+    vendor = normalize_vendor(vendor)
+    amount = parse_amount(total)
+    total_text = f"{amount:.2f}" if amount is not None else ''
+    if not number or not (vendor or total_text):
+        return ''
+    return hashlib.sha1(f"{vendor}|{number}|{total_text}".encode('utf-8')).hexdigest()
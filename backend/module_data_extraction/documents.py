@@ -0,0 +1,173 @@
+"""
+One read-only, memory-mapped view of an uploaded file shared by every engine.
+
+``DocumentHandle`` maps the file once and sniffs its MIME type from the
+first bytes; the SHA-256 is computed from the mapping the first time it is
+asked for, so callers that never look it up do not read the whole file for
+it. Consumers read from the mapping instead of opening
+the path again. ``stream()`` returns a seekable file object that pdfplumber
+and PIL accept. ``buffer`` is a memoryview that numpy and cv2 can decode
+from without copying. ``read_bytes()`` is the single copy that a remote
+payload (a protobuf field, base64) needs. Tools that run in another process,
+such as poppler and tesseract, still take ``path``: the OS page cache
+already holds the mapped pages, so they do not go back to disk.
+
+Inside a ``sharing(path)`` block, ``open_document(path)`` returns the same
+handle, so the cascade router's engines and the result cache all reuse one
+mapping and one hash. Outside such a block it opens and closes a private
+handle, so the extractors keep working on plain paths.
+"""
+import hashlib
+import io
+import mimetypes
+import mmap
+import os
+from contextlib import closing, contextmanager
+from contextvars import ContextVar
+from functools import cached_property
+
+HASH_BLOCK_SIZE = 1024 * 1024
+# Leading bytes of the file types the engines accept
+SIGNATURES = [
+    (b'%PDF-', 'application/pdf'),
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'II*\x00', 'image/tiff'),
+    (b'MM\x00*', 'image/tiff'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+    (b'BM', 'image/bmp'),
+]
+
+PDF = 'pdf'
+IMAGE = 'image'
+
+_shared = ContextVar('shared_documents', default=None)
+
+
+def sniff_mime(header):
+    """MIME type from a file's first bytes, or None when the signature is unknown"""
+    header = bytes(header[:16])
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return 'image/webp'
+    # A PDF may carry a little junk before its header
+    if b'%PDF-' in header:
+        return 'application/pdf'
+    for signature, mime_type in SIGNATURES:
+        if header.startswith(signature):
+            return mime_type
+    return None
+
+
+def sniff_path(path):
+    """MIME type of a file from its leading bytes, falling back to its extension; None if neither is known"""
+    handle = active(path)
+    if handle is not None:
+        return handle.mime_type
+    with open(path, 'rb') as f:
+        header = f.read(16)
+    return sniff_mime(header) or mimetypes.guess_type(path)[0]
+
+
+def document_kind(path):
+    """PDF, IMAGE or None, decided by content so misnamed and extensionless files route correctly"""
+    mime_type = sniff_path(path) or ''
+    if mime_type == 'application/pdf':
+        return PDF
+    if mime_type.startswith('image/'):
+        return IMAGE
+    return None
+
+
+class DocumentHandle:
+    """A read-only mapping of one file with its size, SHA-256 and MIME type"""
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'rb')
+        self.size = os.fstat(self._file.fileno()).st_size
+        # Empty files cannot be mapped
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if self.size else None
+        self.buffer = memoryview(self._map) if self._map is not None else memoryview(b'')
+        self.mime_type = (
+            sniff_mime(self.buffer[:16])
+            or mimetypes.guess_type(path)[0]
+            or 'application/octet-stream'
+        )
+
+    @cached_property
+    def sha256(self):
+        """Hex SHA-256 of the file, hashed from the mapping on first access"""
+        digest = hashlib.sha256()
+        for offset in range(0, self.size, HASH_BLOCK_SIZE):
+            digest.update(self.buffer[offset:offset + HASH_BLOCK_SIZE])
+        return digest.hexdigest()
+
+    def stream(self):
+        """A new seekable file object over the mapping, with its own position"""
+        if self._map is None:
+            return io.BytesIO()
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def read_bytes(self):
+        """The whole file as bytes, for APIs that insist on owning a copy"""
+        return self.buffer.tobytes()
+
+    def close(self):
+        try:
+            self.buffer.release()
+            if self._map is not None:
+                self._map.close()
+        except BufferError:
+            # A numpy array still views the mapping; it is unmapped when that is collected
+            pass
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def _key(path):
+    return os.path.realpath(path)
+
+
+def active(path):
+    """The handle shared for path in the current context, or None"""
+    handles = _shared.get()
+    return handles.get(_key(path)) if handles else None
+
+
+@contextmanager
+def sharing(path):
+    """Map path once and hand the same handle to every open_document() call inside this block"""
+    handle = DocumentHandle(path)
+    handles = dict(_shared.get() or {})
+    handles[_key(path)] = handle
+    token = _shared.set(handles)
+    try:
+        yield handle
+    finally:
+        _shared.reset(token)
+        handle.close()
+
+
+@contextmanager
+def open_document(path):
+    """The shared handle for path if there is one, otherwise a private handle closed on exit"""
+    handle = active(path)
+    if handle is not None:
+        yield handle
+        return
+    with DocumentHandle(path) as handle:
+        yield handle
+
+
+@contextmanager
+def open_pdf(path):
+    """A pdfplumber PDF parsed from the document's mapping"""
+    import pdfplumber
+    with open_document(path) as handle, closing(handle.stream()) as stream, pdfplumber.open(stream) as pdf:
+        yield pdf
@@ -1,77 +1,238 @@
-import cv2
-import pytesseract
-import pandas as pd
-from PIL import Image
-import pdfplumber
-from pdf2image import convert_from_path
+# cv2, pdfplumber and pandas (and the Tesseract bindings, via ocr_pool) are imported where
+# they are used, so a process that never runs OCR does not pay for loading them
+from module_data_extraction import progress
+from module_data_extraction.documents import PDF, IMAGE, document_kind, open_document, open_pdf
+from module_data_extraction.rasterizer import frame_dpi, image_frame_count, iter_pages, pdf_page_count
+from module_data_extraction.preprocess import ImagePreprocessor
+from module_data_extraction.tables import extract_page_table
+from module_data_extraction.telemetry import logger, telemetry, span, incr
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+import contextvars
 import os
+import time
+
+# Per-page preprocessing and OCR timings of the current process_file call
+_page_timings = contextvars.ContextVar('page_timings', default=None)
+
+
+@contextmanager
+def collecting_page_timings(timings):
+    """Append one entry per page OCRed inside this block to the caller's timings list"""
+    token = _page_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        _page_timings.reset(token)
+
+
+def _record_timings(page_num, timings):
+    collected = _page_timings.get()
+    if collected is not None:
+        collected.append({'page': page_num, **timings})
+
+
+def _pdf_errors():
+    """Errors pdfplumber and pdfminer raise on PDFs they cannot parse"""
+    from pdfminer.psparser import PSException
+    from pdfplumber.utils.exceptions import MalformedPDFException, PdfminerException
+    return (PSException, MalformedPDFException, PdfminerException)
+
+
+def _ocr_engine():
+    """This process's Tesseract pool (see ocr_pool.py)"""
+    from module_data_extraction import registry
+    return registry.get('tesseract')
+
+
+def _preprocess(image, preprocessor=None, source_dpi=None):
+    """Run the preprocessor over one image, returning (image, timing dict)"""
+    timings = {}
+    if preprocessor:
+        with span('preprocess'):
+            image, timings['preprocess'] = preprocessor.process(image, source_dpi=source_dpi)
+    return image, timings
+
+
+def _ocr_images(images):
+    """OCR preprocessed images in one call to the pool, returning (texts, seconds per page)"""
+    start = time.perf_counter()
+    with span('ocr'):
+        texts = _ocr_engine().ocr_many(images)
+    incr('pages_total', len(texts), source='ocr')
+    return texts, round((time.perf_counter() - start) / max(1, len(texts)), 4)
+
+
+def _ocr_image(image, preprocessor=None, source_dpi=None):
+    """Preprocess and OCR one image, returning (text, timing dict)"""
+    image, timings = _preprocess(image, preprocessor, source_dpi)
+    texts, timings['ocr_seconds'] = _ocr_images([image])
+    return texts[0], timings
+
+
+def _ocr_page_range(file_path, first_page, last_page, dpi, max_memory_mb=None, preprocessor=None):
+    """Rasterize a range of PDF pages (or decode image frames) and OCR them as one batch (runs in worker processes)"""
+    page_nums, images, page_timings = [], [], []
+    is_pdf = document_kind(file_path) == PDF
+    pages = iter_pages(file_path, dpi=dpi, page_numbers=range(first_page, last_page + 1), max_memory_mb=max_memory_mb)
+    for page_num, image in pages:
+        # Preprocessed pages are binarized greyscale, so a chunk of them is small to hold
+        image, timings = _preprocess(image, preprocessor, source_dpi=dpi if is_pdf else frame_dpi(image))
+        page_nums.append(page_num)
+        images.append(image)
+        page_timings.append(timings)
+    texts, seconds = _ocr_images(images) if images else ([], 0.0)
+    results = []
+    for page_num, text, timings in zip(page_nums, texts, page_timings):
+        timings['ocr_seconds'] = seconds
+        results.append((page_num, text, timings))
+    # Pool workers have their own registry, so publish it before handing results back
+    telemetry.flush()
+    return results
+
 
 class DocumentExtractor:
-    def __init__(self):  # Fixed: double underscores
+    def __init__(self, ocr_workers=1, ocr_chunk_size=4, ocr_dpi=200, min_text_chars=20,
+                 max_raster_memory_mb=256, preprocessor=None, extract_tables=False):  # Fixed: double underscores
         # Set tesseract path if needed (Windows)
         # pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
-        pass
+        # ocr_workers=None uses every core; 1 keeps OCR in the calling process
+        self.ocr_workers = ocr_workers or os.cpu_count() or 1
+        self.ocr_chunk_size = max(1, ocr_chunk_size)
+        self.ocr_dpi = ocr_dpi
+        # Pages whose text layer is shorter than this are treated as scans
+        self.min_text_chars = min_text_chars
+        # Ceiling for page bitmaps held at once, shared between OCR workers
+        self.max_raster_memory_mb = max_raster_memory_mb
+        # Clean-up applied to every image before OCR; pass False to OCR raw images
+        self.preprocessor = ImagePreprocessor() if preprocessor is None else preprocessor
+        # Also recover line items ('costs') and the totals block from text-layer pages
+        self.extract_tables = extract_tables
+    
+    def _page_ranges(self, page_numbers):
+        """Group page numbers into consecutive (first_page, last_page) chunks"""
+        ranges = []
+        for page_num in sorted(page_numbers):
+            if ranges and page_num == ranges[-1][1] + 1 and page_num - ranges[-1][0] < self.ocr_chunk_size:
+                ranges[-1] = (ranges[-1][0], page_num)
+            else:
+                ranges.append((page_num, page_num))
+        return ranges
+    
+    def _ocr_pages(self, file_path, page_numbers, page_count=None):
+        """OCR the given PDF pages or image frames in chunks, optionally across a process pool"""
+        ranges = self._page_ranges(page_numbers)
+        workers = min(self.ocr_workers, len(ranges))
+        memory_per_worker = self.max_raster_memory_mb / workers if self.max_raster_memory_mb else None
+        args = [(file_path, first, last, self.ocr_dpi, memory_per_worker, self.preprocessor) for first, last in ranges]
+        
+        text_data = []
+        pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+        try:
+            # Chunks are consumed as they finish so progress events go out page by page
+            chunks = pool.map(_ocr_page_range, *zip(*args)) if pool else (_ocr_page_range(*chunk_args) for chunk_args in args)
+            for chunk in chunks:
+                for page_num, text, timings in chunk:
+                    _record_timings(page_num, timings)
+                    page = {
+                        'page': page_num,
+                        'text': text.strip(),
+                        'source': 'ocr'
+                    }
+                    if page['text']:
+                        text_data.append(page)
+                    progress.page_done(page_num, page_count, page, source='ocr')
+        finally:
+            if pool:
+                pool.shutdown()
+        return text_data
     
     def extract_from_pdf(self, pdf_path):
-        """Extract text from PDF"""
+        """Extract text from PDF, running OCR only on pages without a usable text layer"""
         text_data = []
+        ocr_pages = []
+        page_count = None
+        emitted = set()
         
-        # First try direct text extraction
+        # First try direct text extraction, page by page
         try:
-            with pdfplumber.open(pdf_path) as pdf:
-                for page_num, page in enumerate(pdf.pages):
-                    text = page.extract_text()
-                    if text:
+            with open_pdf(pdf_path) as pdf:
+                page_count = len(pdf.pages)
+                for page_num, page in enumerate(pdf.pages, 1):
+                    with span('text_layer', page=page_num):
+                        text = (page.extract_text() or '').strip()
+                    if len(text) >= self.min_text_chars:
+                        incr('pages_total', source='text')
                         text_data.append({
-                            'page': page_num + 1,
-                            'text': text.strip()
+                            'page': page_num,
+                            'text': text,
+                            'source': 'text'
                         })
-        except:
-            pass
+                        if self.extract_tables:
+                            text_data[-1].update(extract_page_table(page))
+                        progress.page_done(page_num, page_count, text_data[-1], source='text')
+                        emitted.add(page_num)
+                    else:
+                        ocr_pages.append(page_num)
+        except _pdf_errors() as e:
+            # Pages already read from the text layer (and reported) are kept; everything else is OCRed
+            logger.warning("Text layer of %s unreadable, falling back to OCR: %s", pdf_path, e)
+            page_count = page_count or pdf_page_count(pdf_path)
+            ocr_pages = [page_num for page_num in range(1, page_count + 1) if page_num not in emitted]
         
-        # If no text found, use OCR
-        if not text_data:  # Fixed: syntax error here
-            images = convert_from_path(pdf_path)  # Fixed: missing variable declaration
-            for i, image in enumerate(images):
-                text = pytesseract.image_to_string(image)
-                if text.strip():
-                    text_data.append({
-                        'page': i + 1,
-                        'text': text.strip()
-                    })
+        # Rasterize and OCR only the pages that need it
+        if ocr_pages:
+            text_data.extend(self._ocr_pages(pdf_path, ocr_pages, page_count))
+            text_data.sort(key=lambda item: item['page'])
         
         return text_data
     
     def extract_from_image(self, image_path):
-        """Extract text from image"""
-        # Preprocess image for better OCR
-        image = cv2.imread(image_path)
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Apply some preprocessing (you can enhance this)
-        gray = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]
+        """Extract text from image; every frame of a multi-page TIFF, GIF or WebP goes through the PDF page pipeline"""
+        import cv2
+        import numpy as np
+        frame_count = image_frame_count(image_path)
+        image = None
+        if frame_count == 1:
+            # Decoded straight from the mapped file rather than a second read of the path
+            with open_document(image_path) as handle:
+                image = cv2.imdecode(np.frombuffer(handle.buffer, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if image is None:
+            # Multi-frame files, and formats OpenCV cannot decode (GIF), are read frame by frame with PIL
+            return self._ocr_pages(image_path, range(1, frame_count + 1), frame_count)
         
-        # Extract text
-        text = pytesseract.image_to_string(gray)
+        # Preprocess (resize, denoise, deskew, binarize) and extract text
+        text, timings = _ocr_image(image, self.preprocessor)
+        _record_timings(1, timings)
         
-        return [{
+        page = {
             'page': 1,
-            'text': text.strip()
-        }]
+            'text': text.strip(),
+            'source': 'ocr'
+        }
+        progress.page_done(1, 1, page, source='ocr')
+        return [page]
     
-    def process_file(self, file_path):
-        """Process file based on extension"""
-        file_ext = os.path.splitext(file_path)[1].lower()
+    def process_file(self, file_path, page_timings=None):
+        """
+        Process file based on its content (magic bytes), so misnamed files are
+        read correctly. Pass a list as page_timings to receive the preprocessing
+        and OCR timings of every OCRed page; it belongs to this call, so the
+        shared extractor keeps no per-call state.
+        """
+        kind = document_kind(file_path)
         
-        if file_ext == '.pdf':
-            return self.extract_from_pdf(file_path)
-        elif file_ext in ['.png', '.jpg', '.jpeg', '.bmp', '.tiff']:
-            return self.extract_from_image(file_path)
-        else:
-            raise ValueError(f"Unsupported file type: {file_ext}")
+        with collecting_page_timings(page_timings):
+            if kind == PDF:
+                return self.extract_from_pdf(file_path)
+            elif kind == IMAGE:
+                return self.extract_from_image(file_path)
+            else:
+                raise ValueError(f"Unsupported file type: {os.path.splitext(file_path)[1].lower() or file_path}")
     
     def to_csv(self, extracted_data, output_path):
         """Convert extracted data to CSV"""
+        import pandas as pd
         df = pd.DataFrame(extracted_data)
         df.to_csv(output_path, index=False)
         return output_path
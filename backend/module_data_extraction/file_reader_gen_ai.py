@@ -1,17 +1,128 @@
 import os
+import logging
 import base64
-import pandas as pd
+import asyncio
+import contextvars
 import json
-from pdf2image import convert_from_path
-from PIL import Image
+from module_data_extraction import progress
+from module_data_extraction.documents import open_document
+from module_data_extraction.documents import PDF, IMAGE, document_kind
+from module_data_extraction.rasterizer import document_page_count, image_frame_count, iter_pages
+from module_data_extraction.rate_limit import AsyncRateLimiter, backoff_delay, retry_after_delay
+from module_data_extraction.result_cache import file_sha256
+from module_data_extraction.telemetry import logger, span, incr
+from PIL import Image, ImageOps
 from dotenv import load_dotenv
-import openai
 from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing, contextmanager
+
+MODEL = "gpt-4o"
+MAX_TOKENS = 2000
+# Bump whenever the prompt or expected JSON shape changes so cached results are not reused
+PROMPT_VERSION = "1"
+CACHE_ENGINE = "openai-vision"
+# Rough prompt + high-detail page image cost, reserved against the tokens/minute limit before each call
+ESTIMATED_INPUT_TOKENS = 1200
+# Largest image the model looks at in high detail; anything bigger is wasted upload
+MAX_LONG_SIDE = 2048
+MAX_SHORT_SIDE = 768
+# Images this small fit in a single low-detail tile
+LOW_DETAIL_SIDE = 512
+# Pages with at most this many colours are treated as text/line art and sent as PNG
+PNG_MAX_COLORS = 64
+# Mean per-pixel channel spread below which a page is encoded as single-channel greyscale
+GRAYSCALE_TOLERANCE = 8
+JPEG_QUALITY = 85
+# Document mode packs continuation pages several to a request at this short side:
+# two 512px high-detail tiles per portrait page instead of four
+CONTINUATION_SHORT_SIDE = 512
+# Pages sent with the full prompt while the vendor or invoice number is still missing
+MAX_HEADER_PAGES = 2
+
+# Encoded size of every image sent to the model during the current extract_key_info call
+_payload_stats = contextvars.ContextVar('payload_stats', default=None)
+
+
+@contextmanager
+def collecting_payload_stats(stats):
+    """Append one entry per image encoded inside this block to the caller's stats list"""
+    token = _payload_stats.set(stats)
+    try:
+        yield stats
+    finally:
+        _payload_stats.reset(token)
+
+
+def retryable_errors():
+    """Errors worth retrying: 429s, 5xx responses, timeouts and dropped connections"""
+    # openai is imported on first use so that importing this module stays cheap
+    import openai
+    return (openai.RateLimitError, openai.InternalServerError, openai.APIConnectionError)
+
+
+KEY_INFO_PROMPT = """Analyze this document image and extract ONLY the following key information in JSON format:
+                                Required fields:
+                                - date: Any date found in the document (invoice date, due date, etc.)
+                                - total_amount: The total cost/amount (look for "Total", "Amount Due", "Grand Total", etc.)
+                                - costs: List of individual line items with descriptions and amounts
+                                - vendor_name: Company/vendor name
+                                - invoice_number: Invoice or reference number
+                                - currency: Currency used (USD, EUR, etc.)
+                                For costs, structure as:
+                                "costs": [
+                                    {"description": "item description", "amount": "XX.XX"},
+                                    {"description": "item description", "amount": "XX.XX"}
+                                ]
+                                Return ONLY a valid JSON object. If a field cannot be found, use null.
+                                Do not include any explanatory text, just the JSON."""
+
+LINE_ITEMS_PROMPT = """These images are continuation pages {pages} of one invoice whose header was already read.
+                                Extract ONLY the line items and any totals shown on these pages, in JSON format:
+                                {{
+                                    "costs": [
+                                        {{"description": "item description", "amount": "XX.XX"}}
+                                    ],
+                                    "total_amount": "the final total/amount due if it appears on these pages, else null",
+                                    "currency": "currency of that total if shown, else null"
+                                }}
+                                List items in page order. Do not repeat the vendor, dates or invoice number.
+                                Return ONLY a valid JSON object, no explanatory text."""
 
 class DocumentExtractor:
-    def __init__(self):
+    def __init__(self, max_raster_memory_mb=256, cache=None, max_concurrency=None,
+                 requests_per_minute=None, tokens_per_minute=None, max_retries=5, crop_to_content=False,
+                 document_mode=None, pages_per_request=None):
+        # Ceiling for page bitmaps held at once while rasterizing PDFs
+        self.max_raster_memory_mb = max_raster_memory_mb
+        # Optional ResultCache; results are keyed by file hash, page and prompt version
+        self.cache = cache
+        self.cache_version = f"{MODEL}:{PROMPT_VERSION}"
+        # Concurrent page requests for PDFs; 1 keeps the sequential client
+        self.max_concurrency = max_concurrency or int(os.getenv('OPENAI_MAX_CONCURRENCY', 4))
+        self.requests_per_minute = requests_per_minute or int(os.getenv('OPENAI_REQUESTS_PER_MINUTE', 500))
+        self.tokens_per_minute = tokens_per_minute or int(os.getenv('OPENAI_TOKENS_PER_MINUTE', 30000))
+        self.max_retries = max_retries
+        # Crop page images to the bounding box of their content before upload
+        self.crop_to_content = crop_to_content
+        # Read a PDF as one invoice: header page(s) in full, continuation pages packed for line items only
+        self.document_mode = document_mode if document_mode is not None else os.getenv('OPENAI_DOCUMENT_MODE', '0') == '1'
+        self.pages_per_request = pages_per_request or int(os.getenv('OPENAI_PAGES_PER_REQUEST', 4))
         self._load_openai_api_key()
-        self.client = openai.OpenAI(api_key=self.openai_api_key)
+        self._client = None
+    
+    @property
+    def client(self):
+        """Synchronous OpenAI client, built on first use and reused afterwards"""
+        if self._client is None:
+            import openai
+            # Both clients honour OPENAI_BASE_URL, which is how tests point them at a local stub server
+            self._client = openai.OpenAI(api_key=self.openai_api_key)
+        return self._client
+    
+    @client.setter
+    def client(self, client):
+        self._client = client
     
     def _load_openai_api_key(self):
         """Load OPENAI_API_KEY from project-level .env and expose it."""
@@ -26,180 +137,427 @@ class DocumentExtractor:
             )
         os.environ['OPENAI_API_KEY'] = self.openai_api_key
     
-    def _encode_image_to_base64(self, image):
-        """Convert PIL image to base64 string"""
+    def _encode_image_to_base64(self, image, page_num=1):
+        """
+        Encode a PIL image or image file for the vision model.
+        The image is optionally cropped to its content, then shrunk to the
+        resolution the model actually uses. Text-like images with few colours
+        are sent as PNG, and photos and scans as JPEG. Grey pages are sent as a
+        single channel. Images that fit the low-detail tile are sent with
+        detail "low".
+        """
         if isinstance(image, str):  # If it's a file path
-            with open(image, "rb") as image_file:
-                return base64.b64encode(image_file.read()).decode('utf-8')
-        else:  # If it's a PIL image
-            buffer = BytesIO()
-            if image.mode != 'RGB':
-                image = image.convert('RGB')
-            image.save(buffer, format='JPEG', quality=95)
-            return base64.b64encode(buffer.getvalue()).decode('utf-8')
+            with open_document(image) as handle, closing(handle.stream()) as stream, Image.open(stream) as file_image:
+                file_image.load()
+                image = file_image.copy()
+        
+        if self.crop_to_content:
+            bbox = ImageOps.invert(image.convert('L')).getbbox()
+            if bbox:
+                image = image.crop(bbox)
+        
+        # Classify on a nearest-neighbour sample so resampling does not invent grey levels
+        sample = image.convert('RGB').resize((256, 256), Image.NEAREST)
+        few_colors = sample.getcolors(maxcolors=PNG_MAX_COLORS) is not None
+        import numpy as np
+        channels = np.asarray(sample, dtype=np.int16)
+        grayscale = int((channels.max(axis=2) - channels.min(axis=2)).mean()) <= GRAYSCALE_TOLERANCE
+        
+        # The model scales high-detail images to fit 2048x2048 and then to 768px on the short side
+        scale = min(1.0, MAX_LONG_SIDE / max(image.size), MAX_SHORT_SIDE / min(image.size))
+        if scale < 1.0:
+            image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+        
+        buffer = BytesIO()
+        image = image.convert('L' if grayscale else 'RGB')
+        if few_colors:
+            # Line art and clean digital text compress best losslessly
+            image_format = 'PNG'
+            image.save(buffer, format='PNG', optimize=True)
+        else:
+            image_format = 'JPEG'
+            image.save(buffer, format='JPEG', quality=JPEG_QUALITY, optimize=True)
+        
+        data = buffer.getvalue()
+        stats = _payload_stats.get()
+        if stats is not None:
+            stats.append({
+                'page': page_num,
+                'format': image_format,
+                'width': image.width,
+                'height': image.height,
+                'bytes': len(data)
+            })
+        return {
+            'base64': base64.b64encode(data).decode('utf-8'),
+            'mime_type': f"image/{image_format.lower()}",
+            'detail': 'low' if max(image.size) <= LOW_DETAIL_SIDE else 'high'
+        }
+    
+    def _build_request(self, payload, prompt=KEY_INFO_PROMPT):
+        """Build the chat completion arguments for one page image, or a list of them sharing one prompt"""
+        payloads = payload if isinstance(payload, list) else [payload]
+        return {
+            "model": MODEL,
+            "messages": [
+                {
+                    "role": "user",
+                    "content": [
+                        {
+                            "type": "text",
+                            "text": prompt
+                        }
+                    ] + [
+                        {
+                            "type": "image_url",
+                            "image_url": {
+                                "url": f"data:{payload['mime_type']};base64,{payload['base64']}",
+                                "detail": payload['detail']
+                            }
+                        }
+                        for payload in payloads
+                    ]
+                }
+            ],
+            "max_tokens": MAX_TOKENS,
+            "temperature": 0
+        }
+    
+    def _parse_response(self, response, page_num, pages=1):
+        """Turn a chat completion into a page result, keeping raw text if it is not JSON"""
+        incr('pages_total', pages, source='vision')
+        if response.usage:
+            incr('tokens_total', response.usage.total_tokens, engine='vision')
+        extracted_data = response.choices[0].message.content.strip()
+        
+        # Try to parse as JSON to validate
+        try:
+            json_data = json.loads(extracted_data)
+            return {
+                'page': page_num,
+                'extracted_info': json_data
+            }
+        except json.JSONDecodeError:
+            # If JSON parsing fails, return raw text
+            incr('parse_failures_total', engine='vision')
+            return {
+                'page': page_num,
+                'extracted_info': extracted_data,
+                'note': 'Failed to parse as JSON'
+            }
     
     def _extract_key_info_directly(self, image, page_num=1):
         """Extract only key information directly from image using OpenAI Vision"""
         try:
-            base64_image = self._encode_image_to_base64(image)
-            
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": """Analyze this document image and extract ONLY the following key information in JSON format:
-                                Required fields:
-                                - date: Any date found in the document (invoice date, due date, etc.)
-                                - total_amount: The total cost/amount (look for "Total", "Amount Due", "Grand Total", etc.)
-                                - costs: List of individual line items with descriptions and amounts
-                                - vendor_name: Company/vendor name
-                                - invoice_number: Invoice or reference number
-                                - currency: Currency used (USD, EUR, etc.)
-                                For costs, structure as:
-                                "costs": [
-                                    {"description": "item description", "amount": "XX.XX"},
-                                    {"description": "item description", "amount": "XX.XX"}
-                                ]
-                                Return ONLY a valid JSON object. If a field cannot be found, use null.
-                                Do not include any explanatory text, just the JSON."""
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}",
-                                    "detail": "high"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=2000,
-                temperature=0
-            )
-            
-            extracted_data = response.choices[0].message.content.strip()
-            
-            # Try to parse as JSON to validate
+            with span('encode', page=page_num):
+                payload = self._encode_image_to_base64(image, page_num)
+        except Exception as e:
+            incr('errors_total', engine='vision')
+            logger.warning("Error extracting key info from page %s: %s", page_num, e)
+            return None
+        return self._call(payload, page_num)
+    
+    async def _extract_key_info_async(self, client, payload, page_num, limiter):
+        """Async page extraction with rate limiting and jittered retries on 429/5xx"""
+        estimated_tokens = ESTIMATED_INPUT_TOKENS + MAX_TOKENS
+        for attempt in range(self.max_retries + 1):
+            await limiter.acquire(estimated_tokens)
             try:
-                json_data = json.loads(extracted_data)
-                return {
-                    'page': page_num,
-                    'extracted_info': json_data
-                }
-            except json.JSONDecodeError:
-                # If JSON parsing fails, return raw text
-                return {
-                    'page': page_num,
-                    'extracted_info': extracted_data,
-                    'note': 'Failed to parse as JSON'
-                }
+                with span('model_call', engine='vision', page=page_num):
+                    response = await client.chat.completions.create(**self._build_request(payload))
+            except retryable_errors() as e:
+                limiter.settle(estimated_tokens, 0)
+                if attempt == self.max_retries:
+                    incr('errors_total', engine='vision')
+                    logger.warning("Error extracting key info from page %s: %s", page_num, e)
+                    return None
+                retry_after = getattr(getattr(e, 'response', None), 'headers', {}).get('retry-after')
+                delay = retry_after_delay(retry_after)
+                if delay is None:
+                    delay = backoff_delay(attempt)
+                incr('retries_total', engine='vision', reason=e.__class__.__name__)
+                logger.info("Retrying page %s in %.1fs (%s)", page_num, delay, e.__class__.__name__)
+                await asyncio.sleep(delay)
+                continue
+            except Exception as e:
+                incr('errors_total', engine='vision')
+                logger.warning("Error extracting key info from page %s: %s", page_num, e)
+                return None
             
-        except Exception as e:
-            print(f"Error extracting key info from page {page_num}: {e}")
+            # Without usage figures the reservation is the best guess of what the call cost
+            limiter.settle(estimated_tokens, response.usage.total_tokens if response.usage else estimated_tokens)
+            with span('parse', engine='vision', page=page_num):
+                return self._parse_response(response, page_num)
+    
+    def _cache_get(self, file_hash, page=None):
+        if not self.cache:
             return None
+        return self.cache.get(file_hash, CACHE_ENGINE, self.cache_version, page=page)
+    
+    def _cache_set(self, file_hash, result, page=None):
+        # Unparseable responses are not cached so the next upload retries them
+        if self.cache and 'note' not in result:
+            self.cache.set(file_hash, CACHE_ENGINE, self.cache_version, result, page=page)
+    
+    def _cached_pages(self, pdf_path):
+        """Return (page_count, file_hash, cached results by page, pages still to extract)"""
+        page_count = document_page_count(pdf_path)
+        file_hash = file_sha256(pdf_path) if self.cache else None
+        results = {}
+        for page_num in range(1, page_count + 1):
+            cached = self._cache_get(file_hash, page=page_num)
+            if cached:
+                results[page_num] = cached
+        missing_pages = [page_num for page_num in range(1, page_count + 1) if page_num not in results]
+        return page_count, file_hash, results, missing_pages
     
     def extract_key_info_from_pdf(self, pdf_path):
-        """Extract key information from PDF"""
-        key_data = []
+        """Extract key information from a PDF (or multi-frame image), skipping pages already in the cache"""
+        if self.document_mode:
+            return self.extract_document_from_pdf(pdf_path)
+        if self.max_concurrency > 1:
+            return self._run_async(self.aextract_key_info_from_pdf(pdf_path))
+        
+        results = {}
         
         try:
-            images = convert_from_path(pdf_path, dpi=200, fmt='JPEG')
+            page_count, file_hash, results, missing_pages = self._cached_pages(pdf_path)
+            for page_num in sorted(results):
+                progress.page_done(page_num, page_count, results[page_num], source='cache')
+            pages = iter_pages(pdf_path, dpi=200, fmt='JPEG', page_numbers=missing_pages,
+                                   max_memory_mb=self.max_raster_memory_mb)
             
-            for i, image in enumerate(images):
-                print(f"Extracting key information from page {i + 1}/{len(images)}...")
-                result = self._extract_key_info_directly(image, i + 1)
+            for page_num, image in pages:
+                logger.debug("Extracting key information from page %s/%s", page_num, page_count)
+                result = self._extract_key_info_directly(image, page_num)
                 if result:
-                    key_data.append(result)
+                    results[page_num] = result
+                    self._cache_set(file_hash, result, page=page_num)
+                progress.page_done(page_num, page_count, result, source='vision')
                     
         except Exception as e:
-            print(f"Error processing PDF: {e}")
+            logger.error("Error processing PDF %s: %s", pdf_path, e)
             
-        return key_data
+        return [results[page_num] for page_num in sorted(results)]
+    
+    def _run_async(self, coroutine):
+        """
+        Run a coroutine to completion from synchronous code. Called from inside a
+        running event loop (an async view, a notebook), it cannot block that loop,
+        so it runs on a fresh loop in a helper thread that shares this context.
+        Async callers should await aextract_key_info_from_pdf instead.
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(coroutine)
+        context = contextvars.copy_context()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            return executor.submit(context.run, asyncio.run, coroutine).result()
+    
+    async def aextract_key_info_from_pdf(self, pdf_path):
+        """
+        Extract key information from PDF pages concurrently with the async client.
+        At most max_concurrency requests are in flight, requests and tokens per
+        minute are throttled with token buckets, and results come back in page order.
+        """
+        results = {}
+        # The async client is tied to the running event loop, so each run builds and closes its own
+        import openai
+        client = openai.AsyncOpenAI(api_key=self.openai_api_key, max_retries=0)
+        limiter = AsyncRateLimiter(self.requests_per_minute, self.tokens_per_minute)
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        
+        async def extract_page(payload, page_num):
+            try:
+                result = await self._extract_key_info_async(client, payload, page_num, limiter)
+                if result:
+                    results[page_num] = result
+                    await asyncio.to_thread(self._cache_set, file_hash, result, page_num)
+                progress.page_done(page_num, page_count, result, source='vision')
+            finally:
+                semaphore.release()
+        
+        tasks = []
+        try:
+            page_count, file_hash, cached, missing_pages = await asyncio.to_thread(self._cached_pages, pdf_path)
+            results.update(cached)
+            for page_num in sorted(cached):
+                progress.page_done(page_num, page_count, cached[page_num], source='cache')
+            pages = iter_pages(pdf_path, dpi=200, fmt='JPEG', page_numbers=missing_pages,
+                                   max_memory_mb=self.max_raster_memory_mb)
+            
+            while True:
+                # Only rasterize the next page once a request slot is free, so memory stays bounded
+                await semaphore.acquire()
+                page = await asyncio.to_thread(next, pages, None)
+                if page is None:
+                    semaphore.release()
+                    break
+                page_num, image = page
+                logger.debug("Extracting key information from page %s/%s", page_num, page_count)
+                with span('encode', page=page_num):
+                    payload = self._encode_image_to_base64(image, page_num)
+                tasks.append(asyncio.create_task(extract_page(payload, page_num)))
+            
+            await asyncio.gather(*tasks)
+            
+        except Exception as e:
+            logger.error("Error processing PDF %s: %s", pdf_path, e)
+        finally:
+            # Pages still in flight after a failure must not outlive the client they call
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            await client.close()
+            
+        return [results[page_num] for page_num in sorted(results)]
+    
+    def _call(self, payload, page_num, prompt=KEY_INFO_PROMPT, pages=1):
+        """One synchronous model call; returns the parsed result or None on error"""
+        try:
+            with span('model_call', engine='vision', page=page_num):
+                response = self.client.chat.completions.create(**self._build_request(payload, prompt))
+            with span('parse', engine='vision', page=page_num):
+                return self._parse_response(response, page_num, pages)
+        except Exception as e:
+            incr('errors_total', engine='vision')
+            logger.warning("Error extracting key info from page %s: %s", page_num, e)
+            return None
+    
+    def _continuation_payload(self, image, page_num):
+        """Shrink a continuation page before encoding so several fit one request"""
+        scale = CONTINUATION_SHORT_SIDE / min(image.size)
+        if scale < 1.0:
+            image = image.resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))), Image.LANCZOS)
+        with span('encode', page=page_num):
+            return self._encode_image_to_base64(image, page_num)
+    
+    def _extract_line_items(self, group, page_count=None):
+        """Line items (and any total) from a group of (page_num, payload) continuation pages"""
+        page_nums = [page_num for page_num, _ in group]
+        prompt = LINE_ITEMS_PROMPT.format(pages=', '.join(str(page_num) for page_num in page_nums))
+        result = self._call([payload for _, payload in group], page_nums[0], prompt, pages=len(group))
+        for page_num in page_nums:
+            progress.page_done(page_num, page_count, result, source='vision')
+        return result
+    
+    def extract_document_from_pdf(self, pdf_path):
+        """
+        Read a multi-page PDF as one invoice. The first page (and the second, if
+        the vendor or invoice number is still missing) goes out alone with the
+        full prompt. The rest are downscaled and sent pages_per_request at a
+        time, asking only for line items and a total. The pages are merged into
+        a single record: header fields from the header pages, costs in page
+        order, and the last total found, since totals close an invoice.
+        """
+        file_hash = file_sha256(pdf_path) if self.cache else None
+        cache_page = f"document:{self.pages_per_request}"
+        cached = self._cache_get(file_hash, page=cache_page)
+        if cached:
+            progress.page_done(1, cached.get('pages'), cached, source='cache')
+            return [cached]
+        
+        record = {'date': None, 'total_amount': None, 'currency': None, 'vendor_name': None, 'invoice_number': None, 'costs': []}
+        requests, complete, group = 0, True, []
+        page_count = None
+        
+        def merge(info, header):
+            if not isinstance(info, dict):
+                return
+            for field in ('date', 'vendor_name', 'invoice_number'):
+                if header and not record[field] and info.get(field):
+                    record[field] = info[field]
+            if info.get('total_amount'):
+                record['total_amount'] = info['total_amount']
+                record['currency'] = info.get('currency') or record['currency']
+            elif not record['currency'] and info.get('currency'):
+                record['currency'] = info['currency']
+            record['costs'].extend(cost for cost in info.get('costs') or [] if isinstance(cost, dict))
+        
+        def flush():
+            nonlocal requests, complete
+            if not group:
+                return
+            result = self._extract_line_items(group, page_count)
+            requests += 1
+            complete = complete and bool(result) and 'note' not in result
+            merge(result and result.get('extracted_info'), header=False)
+            group.clear()
+        
+        try:
+            page_count = document_page_count(pdf_path)
+            pages = iter_pages(pdf_path, dpi=200, fmt='JPEG', max_memory_mb=self.max_raster_memory_mb)
+            for page_num, image in pages:
+                header = page_num == 1 or (page_num <= MAX_HEADER_PAGES and not (record['vendor_name'] and record['invoice_number']))
+                if header:
+                    logger.debug("Extracting header from page %s/%s", page_num, page_count)
+                    result = self._extract_key_info_directly(image, page_num)
+                    requests += 1
+                    complete = complete and bool(result) and 'note' not in result
+                    merge(result and result.get('extracted_info'), header=True)
+                    progress.page_done(page_num, page_count, result, source='vision')
+                    continue
+                group.append((page_num, self._continuation_payload(image, page_num)))
+                if len(group) == self.pages_per_request:
+                    flush()
+            flush()
+        except Exception as e:
+            logger.error("Error processing PDF %s: %s", pdf_path, e)
+        
+        if not requests:
+            return []
+        incr('vision_requests_total', requests, mode='document')
+        result = {'page': 1, 'pages': page_count, 'requests': requests, 'extracted_info': record}
+        if complete:
+            self._cache_set(file_hash, result, page=cache_page)
+        return [result]
     
     def extract_key_info_from_image(self, image_path):
         """Extract key information from image"""
-        result = self._extract_key_info_directly(image_path, 1)
+        file_hash = file_sha256(image_path) if self.cache else None
+        result = self._cache_get(file_hash)
+        if not result:
+            result = self._extract_key_info_directly(image_path, 1)
+            if result:
+                self._cache_set(file_hash, result)
+        progress.page_done(1, 1, result)
         return [result] if result else []
     
-    def extract_key_info(self, file_path):
-        """Extract key information based on file type"""
+    def extract_key_info(self, file_path, payload_stats=None):
+        """
+        Extract key information based on file content. Pass a list as
+        payload_stats to receive the encoded format, size and bytes of every
+        image sent; it belongs to this call, so the shared extractor keeps no
+        per-call state.
+        """
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"File not found: {file_path}")
             
-        file_ext = os.path.splitext(file_path)[1].lower()
+        # Routed on the file's magic bytes, so a misnamed PDF or a .dat fax still takes the right path
+        kind = document_kind(file_path)
         
-        if file_ext == '.pdf':
-            return self.extract_key_info_from_pdf(file_path)
-        elif file_ext in ['.png', '.jpg', '.jpeg', '.bmp', '.tiff', '.webp']:
-            return self.extract_key_info_from_image(file_path)
-        else:
-            raise ValueError(f"Unsupported file type: {file_ext}")
+        with collecting_payload_stats(payload_stats):
+            if kind == PDF or (kind == IMAGE and image_frame_count(file_path) > 1):
+                # Multi-page TIFFs and animated GIF/WebP frames go through the same per-page pipeline as PDF pages
+                return self.extract_key_info_from_pdf(file_path)
+            elif kind == IMAGE:
+                return self.extract_key_info_from_image(file_path)
+            else:
+                raise ValueError(f"Unsupported file type: {os.path.splitext(file_path)[1].lower() or file_path}")
     
     def save_key_info_to_csv(self, key_data, output_path="key_info_extracted.csv"):
-        """Save extracted key information to CSV in a clean format"""
+        """Save extracted key information to CSV (or Parquet for a .parquet path), one row per line item"""
         if not key_data:
-            print("No data to save.")
+            logger.warning("No data to save.")
             return None
-            
-        # Flatten the data for CSV
-        flattened_data = []
         
-        for item in key_data:
-            page = item['page']
-            info = item['extracted_info']
-            
-            if isinstance(info, dict):
-                # Create a base record
-                base_record = {
-                    'page': page,
-                    'date': info.get('date'),
-                    'vendor_name': info.get('vendor_name'),
-                    'invoice_number': info.get('invoice_number'),
-                    'total_amount': info.get('total_amount'),
-                    'currency': info.get('currency')
-                }
-                
-                # Handle costs - if there are line items, create separate rows
-                costs = info.get('costs', [])
-                if costs and isinstance(costs, list):
-                    for cost_item in costs:
-                        if isinstance(cost_item, dict):
-                            record = base_record.copy()
-                            record['cost_description'] = cost_item.get('description')
-                            record['cost_amount'] = cost_item.get('amount')
-                            flattened_data.append(record)
-                    
-                    # If no costs were added (empty or invalid costs), add base record
-                    if not any(record for record in flattened_data if record['page'] == page):
-                        base_record['cost_description'] = None
-                        base_record['cost_amount'] = None
-                        flattened_data.append(base_record)
-                else:
-                    # No costs found, just add base record
-                    base_record['cost_description'] = None
-                    base_record['cost_amount'] = None
-                    flattened_data.append(base_record)
-            else:
-                # Fallback for non-JSON data
-                flattened_data.append({
-                    'page': page,
-                    'raw_extracted_info': str(info),
-                    'date': None,
-                    'vendor_name': None,
-                    'invoice_number': None,
-                    'total_amount': None,
-                    'currency': None,
-                    'cost_description': None,
-                    'cost_amount': None
-                })
-        
-        df = pd.DataFrame(flattened_data)
-        df.to_csv(output_path, index=False)
-        return output_path
+        from module_data_extraction.postprocess import normalize_key_info, save_normalized
+        return save_normalized(normalize_key_info(key_data), output_path)
+    
+    def save_key_info_to_parquet(self, key_data, output_path="key_info_extracted.parquet"):
+        """Save extracted key information to Parquet with typed amount, date and currency columns"""
+        return self.save_key_info_to_csv(key_data, output_path)
     
     def print_key_info(self, key_data):
         """Print extracted key information in a readable format"""
@@ -228,6 +586,7 @@ class DocumentExtractor:
 
 # Usage
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     extractor = DocumentExtractor()
     
     file_path = "/Users/sonma/Desktop/Projects/blink_ai_project/blinkAI/backend/module_data_extraction/sales_invoice_test.pdf"
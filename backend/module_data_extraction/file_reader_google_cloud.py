@@ -1,16 +1,51 @@
 import os
+import logging
 import json
+import csv
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from dotenv import load_dotenv
-from google.cloud import documentai
+from module_data_extraction.documents import document_kind, open_document
+from module_data_extraction.telemetry import logger, span, incr
 import mimetypes
 
+# Bump whenever the extracted fields change so cached results are not reused
+SCHEMA_VERSION = "1"
+CACHE_ENGINE = "documentai-invoice"
+
+MIME_TYPES = {
+    '.pdf': 'application/pdf',
+    '.png': 'image/png',
+    '.jpg': 'image/jpeg',
+    '.jpeg': 'image/jpeg',
+    '.tiff': 'image/tiff',
+    '.gif': 'image/gif',
+    '.bmp': 'image/bmp'
+}
+
+BATCH_FIELDS = ["file", "total_cost", "invoice_id", "invoice_date", "supplier_name", "extraction_status", "error_message"]
+
 class InvoiceExtractor:
-    def __init__(self):
-        self._load_google_cloud_credentials()
-        self._initialize_document_ai_client()
+    def __init__(self, cache=None, client=None, processor_name=None):
+        # Optional ResultCache; results are keyed by file hash, processor and schema version
+        self.cache = cache
+        # Full processor resource name; built from the .env settings when not given
+        self.processor_name = processor_name
+        self._client = client
+        if client is None:
+            self._load_google_cloud_credentials()
+        else:
+            # An injected client (e.g. a fake processor in tests) needs no credentials file
+            self._load_processor_config()
     
-    def _load_google_cloud_credentials(self):
-        """Load Google Cloud credentials and configuration from .env file."""
+    @property
+    def client(self):
+        """Document AI client, built on first use and reused (with its gRPC channel) afterwards"""
+        if self._client is None:
+            self._initialize_document_ai_client()
+        return self._client
+    
+    def _load_processor_config(self):
+        """Load the Document AI project, location and processor from .env file."""
         project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..'))
         env_path = os.path.join(project_root, '.env')
         load_dotenv(env_path)
@@ -19,6 +54,11 @@ class InvoiceExtractor:
         self.project_id = os.getenv('GOOGLE_CLOUD_PROJECT_ID')
         self.location = os.getenv('DOCUMENT_AI_LOCATION')
         self.processor_invoice = os.getenv('DOCUMENT_AI_PROCESSOR_ID_INVOICE')
+        return project_root
+    
+    def _load_google_cloud_credentials(self):
+        """Load Google Cloud credentials and configuration from .env file."""
+        project_root = self._load_processor_config()
         credentials_path_from_env = os.getenv('GOOGLE_APPLICATION_CREDENTIALS')
         
         # Handle credentials path - make it absolute if it's relative
@@ -35,42 +75,33 @@ class InvoiceExtractor:
         
         # Set the credentials environment variable for Google Cloud (use absolute path)
         os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = self.credentials_path
-        print(f"✅ Using credentials file: {self.credentials_path}")
+        logger.info("Using credentials file: %s", self.credentials_path)
     
     def _initialize_document_ai_client(self):
         """Initialize the Document AI client."""
+        # google.cloud.documentai is slow to import, so it is only loaded once a client is needed
+        from google.cloud import documentai
         try:
-            self.client = documentai.DocumentProcessorServiceClient()
+            self._client = documentai.DocumentProcessorServiceClient()
         except Exception as e:
             raise Exception(f"Failed to initialize Document AI client: {e}")
     
     def _get_processor_name(self):
         """Get the full processor name for Document AI invoice processor."""
+        if self.processor_name:
+            return self.processor_name
         if not self.processor_invoice:
             raise ValueError("Invoice processor ID not found in environment variables")
         
         return self.client.processor_path(self.project_id, self.location, self.processor_invoice)
     
-    def _read_file_content(self, file_path):
-        """Read file content and determine MIME type."""
-        with open(file_path, 'rb') as f:
-            content = f.read()
-        
-        mime_type, _ = mimetypes.guess_type(file_path)
-        if not mime_type:
-            ext = os.path.splitext(file_path)[1].lower()
-            mime_map = {
-                '.pdf': 'application/pdf',
-                '.png': 'image/png',
-                '.jpg': 'image/jpeg',
-                '.jpeg': 'image/jpeg',
-                '.tiff': 'image/tiff',
-                '.gif': 'image/gif',
-                '.bmp': 'image/bmp'
-            }
-            mime_type = mime_map.get(ext, 'application/octet-stream')
-        
-        return content, mime_type
+    def _mime_type(self, handle):
+        """MIME type from the file's leading bytes, falling back to its extension"""
+        if handle.mime_type != 'application/octet-stream':
+            return handle.mime_type
+        mime_type, _ = mimetypes.guess_type(handle.path)
+        ext = os.path.splitext(handle.path)[1].lower()
+        return mime_type or MIME_TYPES.get(ext, 'application/octet-stream')
     
     def extract_key_invoice_data(self, file_path):
         """
@@ -78,15 +109,28 @@ class InvoiceExtractor:
         Trust Document AI to give us the right entity types directly.
         """
         try:
-            content, mime_type = self._read_file_content(file_path)
             processor_name = self._get_processor_name()
             
+            # Hash and MIME come from the one mapping of the file; bytes are only copied for a real request
+            with open_document(file_path) as handle:
+                file_hash = handle.sha256 if self.cache else None
+                cache_version = f"{processor_name}:{SCHEMA_VERSION}"
+                if self.cache:
+                    cached = self.cache.get(file_hash, CACHE_ENGINE, cache_version)
+                    if cached:
+                        logger.debug("Using cached result for %s", file_path)
+                        return cached
+                content, mime_type = handle.read_bytes(), self._mime_type(handle)
+            
+            from google.cloud import documentai
             raw_document = documentai.RawDocument(content=content, mime_type=mime_type)
             request = documentai.ProcessRequest(name=processor_name, raw_document=raw_document)
             
-            print("🤖 Processing invoice...")
-            result = self.client.process_document(request=request)
+            logger.debug("Processing invoice %s", file_path)
+            with span('model_call', engine='documentai'):
+                result = self.client.process_document(request=request)
             document = result.document
+            incr('pages_total', len(getattr(document, 'pages', None) or ()) or 1, source='documentai')
             
             # Initialize the data we want (only supplier name now)
             invoice_data = {
@@ -97,35 +141,40 @@ class InvoiceExtractor:
                 "extraction_status": "success"
             }
             
-            print(f"📋 Found {len(document.entities)} entities")
+            logger.debug("Found %d entities", len(document.entities))
             
             # Just look for the entities directly as Document AI provides them
-            for entity in document.entities:
-                entity_type = entity.type_
-                entity_value = entity.mention_text.strip() if entity.mention_text else ""
-                
-                print(f"Found entity: {entity_type} = {entity_value}")  # Debug line
-                
-                # Direct matching - let's see what Document AI actually gives us
-                if entity_type == "total_amount" and invoice_data["total_cost"] is None:
-                    invoice_data["total_cost"] = entity_value
-                elif entity_type == "invoice_id" and invoice_data["invoice_id"] is None:
-                    invoice_data["invoice_id"] = entity_value
-                elif entity_type == "invoice_date" and invoice_data["invoice_date"] is None:
-                    invoice_data["invoice_date"] = entity_value
-                elif entity_type == "supplier_name" and invoice_data["supplier_name"] is None:
-                    invoice_data["supplier_name"] = entity_value
+            with span('parse', engine='documentai'):
+                for entity in document.entities:
+                    entity_type = entity.type_
+                    entity_value = entity.mention_text.strip() if entity.mention_text else ""
+                    
+                    logger.debug("Found entity: %s = %s", entity_type, entity_value)
+                    
+                    # Direct matching - let's see what Document AI actually gives us
+                    if entity_type == "total_amount" and invoice_data["total_cost"] is None:
+                        invoice_data["total_cost"] = entity_value
+                    elif entity_type == "invoice_id" and invoice_data["invoice_id"] is None:
+                        invoice_data["invoice_id"] = entity_value
+                    elif entity_type == "invoice_date" and invoice_data["invoice_date"] is None:
+                        invoice_data["invoice_date"] = entity_value
+                    elif entity_type == "supplier_name" and invoice_data["supplier_name"] is None:
+                        invoice_data["supplier_name"] = entity_value
             
             # Count successful extractions
             found_count = sum(1 for value in [invoice_data["total_cost"], invoice_data["invoice_id"], 
                                             invoice_data["invoice_date"], invoice_data["supplier_name"]] if value is not None)
             
-            print(f"🎯 Successfully extracted {found_count}/4 key pieces of information")
+            logger.debug("Extracted %d/4 key pieces of information", found_count)
+            
+            if self.cache:
+                self.cache.set(file_hash, CACHE_ENGINE, cache_version, invoice_data)
             
             return invoice_data
             
         except Exception as e:
-            print(f"❌ Error: {e}")
+            incr('errors_total', engine='documentai')
+            logger.warning("Error extracting invoice data from %s: %s", file_path, e)
             return {
                 "total_cost": None,
                 "invoice_id": None,
@@ -137,16 +186,68 @@ class InvoiceExtractor:
     
     def process_invoice(self, file_path):
         """Process invoice and extract key information."""
-        print(f"🔍 Processing invoice: {os.path.basename(file_path)}")
-        print(f"📄 File type: {os.path.splitext(file_path)[1]}")
-        print("🎯 Extracting: Total Cost, Invoice ID, Invoice Date, Supplier Name")
-        print("-" * 80)
+        logger.info("Processing invoice: %s", os.path.basename(file_path))
         
         # Extract key information
         result = self.extract_key_invoice_data(file_path)
         
         return result
     
+    def _collect_files(self, files):
+        """Expand a directory (recursively) or a list of paths into supported invoice files."""
+        if isinstance(files, (str, os.PathLike)) and os.path.isdir(files):
+            collected = []
+            for root, _, names in os.walk(files):
+                collected.extend(os.path.join(root, name) for name in names)
+            files = sorted(collected)
+        elif isinstance(files, (str, os.PathLike)):
+            files = [files]
+        # Sniffed rather than matched on extension, so misnamed scans are not skipped
+        return [path for path in files if self._is_supported(path)]
+    
+    def _is_supported(self, path):
+        try:
+            return document_kind(path) is not None
+        except OSError as e:
+            # Kept so the batch reports it as an error row instead of stopping before any file is processed
+            logger.warning("Cannot read %s: %s", path, e)
+            return True
+    
+    def iter_batch(self, files, max_workers=8):
+        """
+        Process many invoices on a thread pool and yield (file_path, result) as each one completes.
+        All threads share this extractor's single Document AI client and its gRPC channel.
+        """
+        file_paths = self._collect_files(files)
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {pool.submit(self.extract_key_invoice_data, path): path for path in file_paths}
+            for future in as_completed(futures):
+                yield futures[future], future.result()
+    
+    def process_batch(self, files, output_path="key_invoice_data.jsonl", max_workers=8):
+        """Process a directory or list of invoices, appending each result to a JSONL or CSV file as it completes."""
+        summary = {"processed": 0, "success": 0, "error": 0}
+        as_csv = output_path.lower().endswith('.csv')
+        
+        with open(output_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=BATCH_FIELDS, extrasaction='ignore') if as_csv else None
+            if writer:
+                writer.writeheader()
+            
+            for file_path, result in self.iter_batch(files, max_workers=max_workers):
+                record = {"file": file_path, **result}
+                if writer:
+                    writer.writerow(record)
+                else:
+                    f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                
+                summary["processed"] += 1
+                summary["success" if result.get("extraction_status") == "success" else "error"] += 1
+        
+        summary["output_path"] = output_path
+        return summary
+    
     def save_invoice_results(self, result, output_path="key_invoice_data.json"):
         """Save the extracted key invoice information to JSON."""
         try:
@@ -154,7 +255,7 @@ class InvoiceExtractor:
                 json.dump(result, f, indent=2, ensure_ascii=False)
             return output_path
         except Exception as e:
-            print(f"Error saving JSON: {e}")
+            logger.error("Error saving JSON: %s", e)
             return None
     
     def display_results(self, result):
@@ -185,6 +286,7 @@ class InvoiceExtractor:
 
 # Usage
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
     extractor = InvoiceExtractor()
     
     file_path = "/Users/sonma/Desktop/Projects/blink_ai_project/blinkAI/backend/module_data_extraction/invoice_template.png"
@@ -0,0 +1,105 @@
+"""
+Regex and layout heuristics that pull key invoice fields out of plain text.
+
+This is the free first step of the cascade: it works on the pdfplumber text
+layer (or local OCR output) and reports a confidence per field, so the
+router can decide whether a paid engine is needed.
+"""
+import re
+from module_data_extraction.normalize import parse_amount, parse_date, parse_currency
+
+# Field found next to its label ('Invoice No: 123') vs. guessed from position or shape
+LABELLED = 0.9
+GUESSED = 0.6
+WEAK_GUESS = 0.4
+
+DATE_TOKEN = (
+    r'(\d{4}[-/]\d{1,2}[-/]\d{1,2}'
+    r'|\d{1,2}[/.]\d{1,2}[/.]\d{2,4}'
+    r'|[A-Z][a-z]{2,8}\.? \d{1,2}, \d{4}'
+    r'|\d{1,2} [A-Z][a-z]{2,8} \d{4})'
+)
+# Digits grouped in threes (by comma, dot, space or thin space) or ungrouped, then optional decimals;
+# a stray number after the amount ('100.00 5') is not part of it
+AMOUNT_TOKEN = r'([A-Z]{3} ?)?([$€£¥₹] ?)?(-?(?:\d{1,3}(?:[ ,.\u00a0\u2009\u202f]\d{3})+|\d+)(?:[.,]\d+)?(?!\d))'
+
+INVOICE_NUMBER_RE = re.compile(
+    r'\b(?:invoice|inv)\.?\s*(?:no\.?|number|num\.?|#|id)?\s*[:#]?\s*([A-Z0-9][A-Z0-9\-/_.]*\d[A-Z0-9\-/_.]*)',
+    re.IGNORECASE,
+)
+DATE_LABEL_RE = re.compile(r'\b(?:invoice\s+date|date\s+of\s+issue|issue\s+date|date)\s*[:.]?\s*' + DATE_TOKEN, re.IGNORECASE)
+DATE_RE = re.compile(DATE_TOKEN)
+# Most specific labels first; a plain "Total" line can also be a subtotal or tax total
+TOTAL_LABELS = [
+    r'grand\s+total',
+    r'amount\s+due',
+    r'balance\s+due',
+    r'total\s+due',
+    r'total\s+amount',
+    r'(?<!sub)(?<!sub )total',
+]
+VENDOR_LABEL_RE = re.compile(r'^\s*(?:vendor|supplier|from|bill\s+from|seller)\s*[:]\s*(.+)$', re.IGNORECASE | re.MULTILINE)
+COMPANY_SUFFIX_RE = re.compile(r'\b(?:inc|llc|ltd|limited|gmbh|corp|corporation|co|company|plc|s\.?a|ag|b\.?v)\b\.?', re.IGNORECASE)
+
+
+def _find_total(text):
+    for label in TOTAL_LABELS:
+        matches = list(re.finditer(label + r'\s*[:]?\s*' + AMOUNT_TOKEN, text, re.IGNORECASE))
+        for match in reversed(matches):
+            if parse_amount(match.group(3)) is not None:
+                # Keep the currency code or symbol with the amount so the currency can be read from it
+                start = next(match.start(group) for group in (1, 2, 3) if match.group(group))
+                return text[start:match.end()].strip(), LABELLED
+    return None, 0.0
+
+
+def _find_vendor(text):
+    match = VENDOR_LABEL_RE.search(text)
+    if match:
+        return match.group(1).strip(), LABELLED
+    # Otherwise the letterhead: the first line that is not the word "Invoice" or a date/amount
+    for line in text.splitlines()[:8]:
+        # Two-column letterheads put "Invoice No: ..." on the vendor's line; keep what comes before it
+        line = re.split(r'\b(?:invoice|inv\.?\s*(?:no|#))\b', line, maxsplit=1, flags=re.IGNORECASE)[0].strip()
+        if len(line) < 3 or not re.search(r'[A-Za-z]{2}', line):
+            continue
+        return line, GUESSED if COMPANY_SUFFIX_RE.search(line) else WEAK_GUESS
+    return None, 0.0
+
+
+def extract_fields(text):
+    """
+    Return (fields, confidence) for the vision-style key fields found in text.
+    fields uses the same keys as the vision engine (date, total_amount, currency,
+    vendor_name, invoice_number, costs); confidence maps each key to 0..1.
+    """
+    fields = {'date': None, 'total_amount': None, 'currency': None, 'vendor_name': None, 'invoice_number': None, 'costs': []}
+    confidence = {}
+    text = text or ''
+
+    match = INVOICE_NUMBER_RE.search(text)
+    if match:
+        fields['invoice_number'] = match.group(1).rstrip('.')
+        confidence['invoice_number'] = LABELLED
+
+    match = DATE_LABEL_RE.search(text)
+    if match and parse_date(match.group(1)):
+        fields['date'], confidence['date'] = match.group(1), LABELLED
+    else:
+        for match in DATE_RE.finditer(text):
+            if parse_date(match.group(1)):
+                fields['date'], confidence['date'] = match.group(1), GUESSED
+                break
+
+    fields['total_amount'], total_confidence = _find_total(text)
+    if fields['total_amount']:
+        confidence['total_amount'] = total_confidence
+        fields['currency'] = parse_currency(None, fields['total_amount'])
+        if fields['currency']:
+            confidence['currency'] = total_confidence
+
+    fields['vendor_name'], vendor_confidence = _find_vendor(text)
+    if fields['vendor_name']:
+        confidence['vendor_name'] = vendor_confidence
+
+    return fields, confidence
@@ -0,0 +1,76 @@
+import re
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+CURRENCY_SYMBOLS = {
+    '$': 'USD',
+    '€': 'EUR',
+    '£': 'GBP',
+    '¥': 'JPY',
+    '₹': 'INR',
+}
+
+# Tried in order; US month-first layouts win over day-first ones for ambiguous dates
+DATE_FORMATS = [
+    '%Y-%m-%d',
+    '%m/%d/%Y',
+    '%d/%m/%Y',
+    '%m/%d/%y',
+    '%d.%m.%Y',
+    '%Y/%m/%d',
+    '%B %d, %Y',
+    '%b %d, %Y',
+    '%d %B %Y',
+    '%d %b %Y',
+]
+
+
+def parse_amount(value):
+    """Parse '1,234.56', '$1 234,56' or 154.06 into a Decimal, or None if it is not a number"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float, Decimal)):
+        return Decimal(str(value))
+
+    text = re.sub(r'[^\d,.\-]', '', str(value))
+    if not re.search(r'\d', text):
+        return None
+    # A trailing ",dd" means the comma is the decimal separator (1.234,56)
+    if re.search(r',\d{1,2}$', text):
+        text = text.replace('.', '').replace(',', '.')
+    else:
+        text = text.replace(',', '')
+    try:
+        return Decimal(text)
+    except InvalidOperation:
+        return None
+
+
+def parse_date(value):
+    """Parse a date string in one of DATE_FORMATS, or return None"""
+    if not value:
+        return None
+    text = str(value).strip()
+    for date_format in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, date_format).date()
+        except ValueError:
+            continue
+    return None
+
+
+def parse_currency(value, amount_text=None):
+    """Return an ISO currency code from a code/symbol, falling back to a symbol in the amount text"""
+    for text in (value, amount_text):
+        if not text:
+            continue
+        text = str(text).strip()
+        if re.fullmatch(r'[A-Za-z]{3}', text):
+            return text.upper()
+        for symbol, code in CURRENCY_SYMBOLS.items():
+            if symbol in text:
+                return code
+        match = re.search(r'\b([A-Z]{3})\b', text)
+        if match:
+            return match.group(1)
+    return None
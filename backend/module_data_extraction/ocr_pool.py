@@ -0,0 +1,197 @@
+"""
+A pool of Tesseract engines that OCR page images held in memory.
+
+pytesseract.image_to_string writes every page to a temp file, starts a new
+``tesseract`` process, and reads the text back from another temp file. On
+small receipts that start-up and disk round-trip costs more than the
+recognition itself. This module offers three backends:
+
+- ``tesserocr``: each worker is a ``PyTessBaseAPI`` that loads the language
+  data once and is handed PIL images directly through the C API. These are
+  the only long-lived engines, and the only backend for which
+  ``OCR_POOL_SIZE`` (default 1, engines per process) means anything.
+  tesserocr is in requirements.txt; its wheels bundle libtesseract but not
+  the language data, which is found through ``TESSDATA_PREFIX`` or, failing
+  that, the ``tesseract`` command.
+- ``pytesseract``: one ``tesseract`` process per page.
+- ``pipe``: a batch of pages is encoded as one multi-page TIFF in memory and
+  piped to a single ``tesseract stdin stdout`` process, so a chunk of pages
+  costs one process start and no temp files. It still starts a process per
+  batch (and per receipt image), so it is opt-in until the benchmark shows
+  a gain on real hardware (``benchmark --ocr-backend pipe``).
+
+``OCR_BACKEND=auto`` (the default) uses tesserocr, falling back to
+pytesseract where it is not installed. Queue workers and OCR worker processes each build
+their own pool through the registry, which is cleared on fork. Inside one
+process the pool is safe to use from several threads: each call checks an
+engine out and returns it.
+"""
+import os
+import queue
+import re
+import subprocess
+from contextlib import contextmanager
+from io import BytesIO
+from PIL import Image
+
+BACKENDS = ['auto', 'tesserocr', 'pipe', 'pytesseract']
+PAGE_SEPARATOR = '\f'
+
+
+def to_pil(image):
+    """PIL image from a PIL image or a numpy array (as pytesseract accepts)"""
+    if isinstance(image, Image.Image):
+        return image
+    return Image.fromarray(image)
+
+
+def tessdata_path(tesseract_cmd=None):
+    """Language data directory: TESSDATA_PREFIX, else the one the tesseract command reports, else None"""
+    if os.getenv('TESSDATA_PREFIX'):
+        return os.environ['TESSDATA_PREFIX']
+    command = [tesseract_cmd or os.getenv('TESSERACT_CMD', 'tesseract'), '--list-langs']
+    try:
+        completed = subprocess.run(command, capture_output=True, text=True, timeout=30)
+    except (OSError, subprocess.SubprocessError):
+        return None
+    # 'List of available languages in "/usr/share/tesseract-ocr/5/tessdata/" (2):'
+    match = re.search(r'"([^"]+)"', completed.stdout + completed.stderr)
+    return match.group(1) if match else None
+
+
+class TesserocrWorker:
+    """One PyTessBaseAPI instance; language data is loaded once"""
+    name = 'tesserocr'
+
+    def __init__(self, lang='eng'):
+        import tesserocr
+        path = tessdata_path()
+        self.api = tesserocr.PyTessBaseAPI(path=path, lang=lang) if path else tesserocr.PyTessBaseAPI(lang=lang)
+
+    def ocr_many(self, images):
+        texts = []
+        for image in images:
+            self.api.SetImage(to_pil(image))
+            texts.append(self.api.GetUTF8Text())
+        return texts
+
+    def close(self):
+        self.api.End()
+
+
+class PipeWorker:
+    """Runs one tesseract process per batch, fed a multi-page TIFF on stdin"""
+    name = 'pipe'
+
+    def __init__(self, lang='eng', tesseract_cmd=None, single_thread=True):
+        self.command = [tesseract_cmd or os.getenv('TESSERACT_CMD', 'tesseract'), 'stdin', 'stdout', '-l', lang]
+        self.env = dict(os.environ)
+        if single_thread:
+            # Tesseract's OpenMP threads fight each other when several engines share the cores
+            self.env.setdefault('OMP_THREAD_LIMIT', '1')
+
+    def ocr_many(self, images):
+        if not images:
+            return []
+        pages = [to_pil(image) for image in images]
+        buffer = BytesIO()
+        pages[0].save(buffer, format='TIFF', save_all=True, append_images=pages[1:], compression='tiff_lzw')
+        completed = subprocess.run(self.command, input=buffer.getvalue(), capture_output=True, env=self.env)
+        if completed.returncode != 0:
+            raise RuntimeError(f"tesseract failed: {completed.stderr.decode('utf-8', 'replace').strip()}")
+        texts = completed.stdout.decode('utf-8', 'replace').split(PAGE_SEPARATOR)
+        # A trailing separator follows the last page
+        return (texts + [''] * len(pages))[:len(pages)]
+
+    def close(self):
+        pass
+
+
+class PytesseractWorker:
+    """pytesseract.image_to_string per page"""
+    name = 'pytesseract'
+
+    def __init__(self, lang='eng'):
+        self.lang = lang
+
+    def ocr_many(self, images):
+        import pytesseract
+        return [pytesseract.image_to_string(image, lang=self.lang) for image in images]
+
+    def close(self):
+        pass
+
+
+def _tesserocr_available():
+    try:
+        import tesserocr  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def resolve_backend(backend=None):
+    backend = backend or os.getenv('OCR_BACKEND', 'auto')
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown OCR backend: {backend}")
+    if backend == 'auto':
+        return 'tesserocr' if _tesserocr_available() else 'pytesseract'
+    return backend
+
+
+WORKER_CLASSES = {
+    'tesserocr': TesserocrWorker,
+    'pipe': PipeWorker,
+    'pytesseract': PytesseractWorker,
+}
+
+
+class TesseractPool:
+    """A fixed number of Tesseract engines, built on first use and checked out one call at a time"""
+
+    def __init__(self, size=None, backend=None, lang=None):
+        self.size = max(1, size or int(os.getenv('OCR_POOL_SIZE', 1)))
+        self.backend = resolve_backend(backend)
+        self.lang = lang or os.getenv('OCR_LANG', 'eng')
+        self._idle = queue.LifoQueue()
+        self._created = 0
+        self._workers = []
+
+    @contextmanager
+    def _worker(self):
+        try:
+            worker = self._idle.get_nowait()
+        except queue.Empty:
+            worker = None
+            with self._idle.mutex:
+                create = self._created < self.size
+                if create:
+                    self._created += 1
+            if create:
+                try:
+                    worker = WORKER_CLASSES[self.backend](lang=self.lang)
+                except Exception:
+                    with self._idle.mutex:
+                        self._created -= 1
+                    raise
+                self._workers.append(worker)
+            else:
+                worker = self._idle.get()
+        try:
+            yield worker
+        finally:
+            self._idle.put(worker)
+
+    def ocr_many(self, images):
+        """Text for each image, in order"""
+        with self._worker() as worker:
+            return worker.ocr_many(list(images))
+
+    def ocr(self, image):
+        return self.ocr_many([image])[0]
+
+    def close(self):
+        for worker in self._workers:
+            worker.close()
+        self._workers, self._created = [], 0
+        self._idle = queue.LifoQueue()
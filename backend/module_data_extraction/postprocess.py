@@ -0,0 +1,123 @@
+"""
+Columnar normalization of extracted key information.
+
+Results from any number of documents are flattened in a single linear pass,
+then amounts, currencies and dates are parsed with vectorized pandas string
+operations, line items are exploded into one row each, and every invoice is
+checked against the sum of its line items. The scalar helpers in
+normalize.py follow the same rules for single values.
+"""
+import re
+import pandas as pd
+from module_data_extraction.normalize import CURRENCY_SYMBOLS, DATE_FORMATS
+
+INVOICE_FIELDS = ['date', 'vendor_name', 'invoice_number', 'total_amount', 'currency']
+# Rounding slack allowed between the stated total and the sum of line items
+TOTAL_TOLERANCE = 0.01
+
+_SYMBOL_PATTERN = '([' + re.escape(''.join(CURRENCY_SYMBOLS)) + '])'
+
+
+def parse_amounts(series):
+    """Vectorized parse_amount: '1,234.56', '$1 234,56' or 154.06 -> float, NaN when not a number"""
+    text = series.astype('string').str.replace(r'[^\d,.\-]', '', regex=True)
+    # A trailing ",dd" means the comma is the decimal separator (1.234,56)
+    comma_decimal = text.str.contains(r',\d{1,2}$', regex=True).fillna(False).astype(bool)
+    text = text.where(
+        ~comma_decimal,
+        text.str.replace('.', '', regex=False).str.replace(',', '.', regex=False),
+    ).where(comma_decimal, text.str.replace(',', '', regex=False))
+    return pd.to_numeric(text, errors='coerce').astype('float64')
+
+
+def _currency_from(text):
+    text = text.astype('string').str.strip()
+    code = text.str.upper().where(text.str.fullmatch(r'[A-Za-z]{3}').fillna(False).astype(bool))
+    symbol = text.str.extract(_SYMBOL_PATTERN, expand=False).map(CURRENCY_SYMBOLS)
+    iso = text.str.extract(r'\b([A-Z]{3})\b', expand=False)
+    return code.fillna(symbol).fillna(iso)
+
+
+def parse_currencies(currency, amount_text):
+    """Vectorized parse_currency: ISO code from the currency column, else from a symbol or code in the amount"""
+    return _currency_from(currency).fillna(_currency_from(amount_text)).astype('string')
+
+
+def parse_dates(series):
+    """Vectorized parse_date: try each of DATE_FORMATS in order on the rows still unparsed"""
+    text = series.astype('string').str.strip()
+    parsed = pd.Series(pd.NaT, index=series.index, dtype='datetime64[ns]')
+    for date_format in DATE_FORMATS:
+        missing = parsed.isna() & text.notna()
+        if not missing.any():
+            break
+        parsed[missing] = pd.to_datetime(text[missing], format=date_format, errors='coerce')
+    return parsed
+
+
+def invoices_frame(key_data):
+    """One row per extracted page/document, with the raw fields and the unparsed line items"""
+    rows = []
+    for record, item in enumerate(key_data):
+        info = item.get('extracted_info', item)
+        row = {'record': record, 'file': item.get('file'), 'page': item.get('page')}
+        if isinstance(info, dict):
+            row.update({field: info.get(field) for field in INVOICE_FIELDS})
+            costs = info.get('costs')
+            row['costs'] = [cost for cost in costs if isinstance(cost, dict)] if isinstance(costs, list) else []
+            row['raw_extracted_info'] = None
+        else:
+            # Fallback for non-JSON data
+            row.update({field: None for field in INVOICE_FIELDS})
+            row['costs'] = []
+            row['raw_extracted_info'] = str(info)
+        rows.append(row)
+    return pd.DataFrame(rows, columns=['record', 'file', 'page'] + INVOICE_FIELDS + ['costs', 'raw_extracted_info'])
+
+
+def normalize_key_info(key_data):
+    """
+    Flatten and normalize key information into one row per line item (or one row
+    per invoice without line items). Adds total_amount_value, currency_code,
+    invoice_date, cost_amount_value, line_items_total and totals_match columns;
+    totals_match is empty when there is nothing to compare.
+    """
+    invoices = invoices_frame(key_data)
+    invoices['total_amount_value'] = parse_amounts(invoices['total_amount'])
+    invoices['currency_code'] = parse_currencies(invoices['currency'], invoices['total_amount'])
+    invoices['invoice_date'] = parse_dates(invoices['date'])
+
+    # Empty lists explode to a single NaN row, which keeps invoices without line items
+    rows = invoices.explode('costs', ignore_index=True)
+    has_cost = rows['costs'].notna()
+    costs = pd.DataFrame(rows.loc[has_cost, 'costs'].tolist(), index=rows.index[has_cost])
+    rows['cost_description'] = costs['description'] if 'description' in costs else None
+    rows['cost_amount'] = costs['amount'] if 'amount' in costs else None
+    rows['cost_amount_value'] = parse_amounts(rows['cost_amount'])
+
+    line_totals = rows.groupby('record')['cost_amount_value'].sum(min_count=1)
+    rows['line_items_total'] = rows['record'].map(line_totals).round(2)
+    comparable = rows['line_items_total'].notna() & rows['total_amount_value'].notna()
+    matches = (rows['line_items_total'] - rows['total_amount_value']).abs() <= TOTAL_TOLERANCE
+    rows['totals_match'] = matches.astype('boolean').where(comparable)
+
+    columns = ['file', 'page'] + INVOICE_FIELDS + [
+        'cost_description', 'cost_amount', 'raw_extracted_info', 'total_amount_value', 'currency_code',
+        'invoice_date', 'cost_amount_value', 'line_items_total', 'totals_match',
+    ]
+    # Raw values arrive as strings or numbers; a uniform string dtype keeps Parquet happy
+    raw_columns = INVOICE_FIELDS + ['cost_description', 'cost_amount', 'raw_extracted_info']
+    rows[raw_columns] = rows[raw_columns].astype('string')
+    if rows['file'].isna().all():
+        columns.remove('file')
+    return rows[columns]
+
+
+def save_normalized(frame, output_path):
+    """Write a normalized frame to CSV, or to Parquet when the path ends in .parquet"""
+    if output_path.lower().endswith('.parquet'):
+        # Parquet needs pyarrow (or fastparquet) installed
+        frame.to_parquet(output_path, index=False)
+    else:
+        frame.to_csv(output_path, index=False)
+    return output_path
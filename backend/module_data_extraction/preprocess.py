@@ -0,0 +1,103 @@
+import time
+
+# cv2 and numpy are imported inside the methods that use them, so importing this module
+# (and file_reader) does not load OpenCV in processes that never preprocess an image
+
+# Letter-size long edge in inches, used to guess the DPI of images that do not say
+ASSUMED_PAGE_HEIGHT_IN = 11.0
+
+
+class ImagePreprocessor:
+    """
+    OpenCV clean-up applied to page images before OCR.
+    Stages run in order: grayscale, resize to target_dpi (downscale only),
+    denoise, deskew, crop to the content bounding box and Otsu binarization.
+    Every stage works on whole arrays, and process() reports the time each took.
+    """
+
+    def __init__(self, target_dpi=300, deskew=True, denoise=True, crop=False, binarize=True,
+                 max_skew_angle=10.0, crop_margin=10):
+        self.target_dpi = target_dpi
+        self.deskew = deskew
+        self.denoise = denoise
+        self.crop = crop
+        self.binarize = binarize
+        self.max_skew_angle = max_skew_angle
+        self.crop_margin = crop_margin
+
+    def _to_gray(self, image):
+        """Accept a PIL image or a BGR/grayscale array and return a grayscale array"""
+        import cv2
+        import numpy as np
+        if not isinstance(image, np.ndarray):
+            image = np.asarray(image.convert('RGB'))
+            return cv2.cvtColor(image, cv2.COLOR_RGB2GRAY)
+        if image.ndim == 3:
+            return cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        return image
+
+    def _resize(self, gray, source_dpi):
+        import cv2
+        if not self.target_dpi:
+            return gray
+        source_dpi = source_dpi or max(gray.shape) / ASSUMED_PAGE_HEIGHT_IN
+        scale = self.target_dpi / source_dpi
+        if scale >= 1:
+            return gray
+        return cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    def _ink_mask(self, gray):
+        import cv2
+        return cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
+
+    def _skew_angle(self, gray):
+        """Estimate text skew in degrees from the minimum-area rectangle around the ink"""
+        import cv2
+        coords = cv2.findNonZero(self._ink_mask(gray))
+        if coords is None:
+            return 0.0
+        angle = cv2.minAreaRect(coords)[-1]
+        if angle > 45:
+            angle -= 90
+        elif angle < -45:
+            angle += 90
+        return angle
+
+    def _deskew(self, gray):
+        import cv2
+        angle = self._skew_angle(gray)
+        if abs(angle) < 0.1 or abs(angle) > self.max_skew_angle:
+            return gray
+        height, width = gray.shape
+        matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+        return cv2.warpAffine(gray, matrix, (width, height), flags=cv2.INTER_LINEAR,
+                              borderMode=cv2.BORDER_CONSTANT, borderValue=255)
+
+    def _crop(self, gray):
+        import cv2
+        coords = cv2.findNonZero(self._ink_mask(gray))
+        if coords is None:
+            return gray
+        x, y, width, height = cv2.boundingRect(coords)
+        margin = self.crop_margin
+        return gray[max(0, y - margin):y + height + margin, max(0, x - margin):x + width + margin]
+
+    def process(self, image, source_dpi=None):
+        """Run the enabled stages and return (processed array, {stage: seconds})"""
+        import cv2
+        timings = {}
+        stages = [('grayscale', self._to_gray), ('resize', lambda img: self._resize(img, source_dpi))]
+        if self.denoise:
+            stages.append(('denoise', lambda img: cv2.medianBlur(img, 3)))
+        if self.deskew:
+            stages.append(('deskew', self._deskew))
+        if self.crop:
+            stages.append(('crop', self._crop))
+        if self.binarize:
+            stages.append(('binarize', lambda img: cv2.threshold(img, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)[1]))
+
+        for name, stage in stages:
+            start = time.perf_counter()
+            image = stage(image)
+            timings[name] = round(time.perf_counter() - start, 4)
+        return image, timings
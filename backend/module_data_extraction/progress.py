@@ -0,0 +1,103 @@
+"""
+Per-page progress events for long-running extractions.
+
+Extractors call ``page_done()`` as each page finishes. Outside a
+``reporting()`` block that is a no-op; inside one, events are appended as
+JSON lines to ``<EXTRACTION_PROGRESS_DIR>/job-<id>.jsonl``. A file is used
+because pages finish in queue worker processes while the events are
+streamed to the browser from the web process. The active reporter lives in
+a context variable, so it follows asyncio tasks and ``asyncio.to_thread``.
+"""
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_current = ContextVar('extraction_progress', default=None)
+
+
+def progress_dir(directory=None):
+    return directory or os.getenv('EXTRACTION_PROGRESS_DIR')
+
+
+def progress_path(job_id, directory=None):
+    directory = progress_dir(directory)
+    return os.path.join(directory, f"job-{job_id}.jsonl") if directory else None
+
+
+class ProgressLog:
+    """Append-only JSON lines file of events for one job"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # A retried job starts a fresh log; readers notice the file shrinking and start over
+        open(path, 'w').close()
+
+    def emit(self, event_type, **data):
+        line = json.dumps({'type': event_type, 'time': round(time.time(), 3), **data}, default=str)
+        with self._lock, open(self.path, 'a', encoding='utf-8') as f:
+            f.write(line + '\n')
+
+
+@contextmanager
+def reporting(job_id, directory=None):
+    """Send page events emitted inside this block to the job's progress file"""
+    path = progress_path(job_id, directory) if job_id is not None else None
+    log = ProgressLog(path) if path else None
+    token = _current.set(log)
+    try:
+        yield log
+    finally:
+        _current.reset(token)
+
+
+def emit(event_type, **data):
+    log = _current.get()
+    if log is not None:
+        log.emit(event_type, **data)
+
+
+def page_done(page, pages=None, result=None, source=None):
+    """Report one finished page with its partial result"""
+    emit('page', page=page, pages=pages, source=source, result=result)
+
+
+def read_events(job_id, offset=0, directory=None):
+    """
+    Return (events, new_offset) for complete lines written after byte offset.
+    A file shorter than offset (a retried job) is read again from the start.
+    """
+    path = progress_path(job_id, directory)
+    if not path or not os.path.exists(path):
+        return [], offset
+    if os.path.getsize(path) < offset:
+        offset = 0
+    events = []
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        for line in f:
+            # A line without its newline is still being written
+            if not line.endswith(b'\n'):
+                break
+            offset += len(line)
+            events.append(json.loads(line))
+    return events, offset
+
+
+def prune(max_age_seconds, directory=None):
+    """Delete progress files that have not been written to for max_age_seconds"""
+    directory = progress_dir(directory)
+    if not directory or not os.path.isdir(directory):
+        return 0
+    cutoff = time.time() - max_age_seconds
+    removed = 0
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if name.startswith('job-') and os.path.getmtime(path) < cutoff:
+            os.remove(path)
+            removed += 1
+    return removed
@@ -0,0 +1,121 @@
+import re
+from pdf2image import convert_from_path, pdfinfo_from_path
+from PIL import Image
+from module_data_extraction.documents import PDF, IMAGE, document_kind
+from module_data_extraction.telemetry import span
+
+# Hard cap on pages rasterized in one poppler call, whatever the memory budget allows
+MAX_WINDOW = 8
+
+
+def pdf_page_count(pdf_path):
+    """Return the number of pages in a PDF"""
+    return pdfinfo_from_path(pdf_path)['Pages']
+
+
+def image_frame_count(image_path):
+    """Frames in an image file: pages of a multi-page TIFF, or frames of an animated GIF or WebP"""
+    with Image.open(image_path) as image:
+        return getattr(image, 'n_frames', 1)
+
+
+def document_page_count(file_path):
+    """Pages in a PDF or frames in an image, going by the file's content rather than its name"""
+    kind = document_kind(file_path)
+    if kind == PDF:
+        return pdf_page_count(file_path)
+    if kind == IMAGE:
+        return image_frame_count(file_path)
+    raise ValueError(f"Unsupported file type: {file_path}")
+
+
+def file_page_count(file_path):
+    """document_page_count(), or 1 when the file cannot be inspected"""
+    try:
+        return document_page_count(file_path)
+    except Exception:
+        return 1
+
+
+def frame_dpi(image):
+    """Resolution recorded in an image frame (fax TIFFs say 204x196), or None"""
+    dpi = image.info.get('dpi')
+    return float(dpi[1]) if dpi and dpi[1] else None
+
+
+def iter_image_frames(image_path, frame_numbers=None):
+    """
+    Yield (frame_num, image) for the frames of a TIFF, GIF or WebP, decoding one frame at a time.
+    Like iter_pdf_pages, each image is closed once the consumer moves on.
+    """
+    with Image.open(image_path) as source:
+        count = getattr(source, 'n_frames', 1)
+        for frame_num in sorted(frame_numbers) if frame_numbers is not None else range(1, count + 1):
+            if frame_num > count:
+                break
+            source.seek(frame_num - 1)
+            # Bilevel fax frames become greyscale and palette frames RGB, so every consumer sees L or RGB
+            image = source.copy() if source.mode in ('L', 'RGB') else source.convert('L' if source.mode == '1' else 'RGB')
+            try:
+                yield frame_num, image
+            finally:
+                image.close()
+
+
+def iter_pages(file_path, dpi=200, page_numbers=None, max_memory_mb=None, fmt='ppm'):
+    """iter_pdf_pages for PDFs and iter_image_frames for images, so one pipeline serves both"""
+    if document_kind(file_path) == PDF:
+        return iter_pdf_pages(file_path, dpi=dpi, page_numbers=page_numbers, max_memory_mb=max_memory_mb, fmt=fmt)
+    return iter_image_frames(file_path, page_numbers)
+
+
+def estimate_page_bytes(pdf_path, dpi):
+    """Estimate the RGB bitmap size of one rasterized page at the given DPI"""
+    info = pdfinfo_from_path(pdf_path)
+    match = re.match(r'([\d.]+) x ([\d.]+)', info.get('Page size', ''))
+    # Fall back to US Letter when pdfinfo does not report a size
+    width_pt, height_pt = (float(match.group(1)), float(match.group(2))) if match else (612.0, 792.0)
+    return int((width_pt * dpi / 72) * (height_pt * dpi / 72) * 3)
+
+
+def window_size(pdf_path, dpi, max_memory_mb=None):
+    """How many pages to rasterize at once so a window stays under max_memory_mb"""
+    if not max_memory_mb:
+        return 1
+    page_bytes = estimate_page_bytes(pdf_path, dpi)
+    return max(1, min(MAX_WINDOW, int(max_memory_mb * 1024 * 1024 // page_bytes)))
+
+
+def iter_pdf_pages(pdf_path, dpi=200, page_numbers=None, max_memory_mb=None, fmt='ppm'):
+    """
+    Yield (page_num, image) pairs, rasterizing a small window of pages at a time.
+    Each image is closed as soon as the consumer asks for the next page, so do
+    not keep references to yielded images; peak memory is bounded by the window.
+    """
+    if page_numbers is None:
+        page_numbers = range(1, pdf_page_count(pdf_path) + 1)
+    page_numbers = sorted(page_numbers)
+    if not page_numbers:
+        return
+    window = window_size(pdf_path, dpi, max_memory_mb)
+
+    index = 0
+    while index < len(page_numbers):
+        # A window only spans consecutive pages so poppler renders nothing extra
+        first_page = last_page = page_numbers[index]
+        index += 1
+        while index < len(page_numbers) and page_numbers[index] == last_page + 1 and last_page - first_page + 1 < window:
+            last_page = page_numbers[index]
+            index += 1
+
+        with span('rasterize', first_page=first_page, last_page=last_page):
+            images = convert_from_path(pdf_path, dpi=dpi, first_page=first_page, last_page=last_page, fmt=fmt)
+        images.reverse()
+        page_num = first_page
+        while images:
+            image = images.pop()
+            try:
+                yield page_num, image
+            finally:
+                image.close()
+            page_num += 1
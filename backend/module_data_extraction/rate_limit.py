@@ -0,0 +1,97 @@
+import asyncio
+import math
+import random
+import time
+from datetime import timezone
+from email.utils import parsedate_to_datetime
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at rate_per_minute, holding at most capacity tokens"""
+
+    def __init__(self, rate_per_minute, capacity=None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity or rate_per_minute
+        self.tokens = float(self.capacity)
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until amount tokens are available (0 if they already are)"""
+        self._refill()
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount):
+        self._refill()
+        self.tokens -= min(amount, self.capacity)
+
+    def refund(self, amount):
+        """Give back tokens that were reserved but not used"""
+        self._refill()
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class AsyncRateLimiter:
+    """Keep concurrent coroutines under both a requests/minute and a tokens/minute limit"""
+
+    def __init__(self, requests_per_minute, tokens_per_minute):
+        self.requests = TokenBucket(requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute)
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, estimated_tokens):
+        """Wait until one request and estimated_tokens fit within both limits, then reserve them"""
+        async with self._lock:
+            while True:
+                delay = max(self.requests.wait_time(1), self.tokens.wait_time(estimated_tokens))
+                if delay <= 0:
+                    self.requests.consume(1)
+                    self.tokens.consume(estimated_tokens)
+                    return
+                await asyncio.sleep(delay)
+
+    def settle(self, estimated_tokens, used_tokens):
+        """Correct the token reservation once the real usage is known"""
+        if used_tokens < estimated_tokens:
+            self.tokens.refund(estimated_tokens - used_tokens)
+        elif used_tokens > estimated_tokens:
+            self.tokens.consume(used_tokens - estimated_tokens)
+
+
+MAX_BACKOFF_SECONDS = 60.0
+
+
+def backoff_delay(attempt, base=1.0, cap=MAX_BACKOFF_SECONDS):
+    """Exponential backoff with full jitter for the given retry attempt (0-based)"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def retry_after_delay(value, cap=MAX_BACKOFF_SECONDS):
+    """
+    Seconds to wait as asked by a Retry-After header, given either in seconds or
+    as an HTTP date, and never more than cap. None if the header is missing or unreadable.
+    """
+    if not value:
+        return None
+    try:
+        delay = float(value)
+    except ValueError:
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            return None
+        if when is None:
+            return None
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        delay = when.timestamp() - time.time()
+    if math.isnan(delay):
+        return None
+    return min(cap, max(0.0, delay))
@@ -0,0 +1,165 @@
+"""
+Process-wide registry of extractors.
+
+Building an extractor loads .env, validates credentials and (on first use)
+opens an API client with its connection pool or gRPC channel. get() builds
+each extractor once per process and hands the same instance to every later
+caller, so a queue worker pays that cost on its first job only. The
+registry is cleared in forked children, which must not share sockets with
+their parent.
+
+Extractors keep no per-call state: page timings and payload stats go to
+lists the caller passes in (through context variables), so one shared
+instance can serve several extractions at once.
+
+Run ``python -m module_data_extraction.registry`` for an import-time report:
+each module is imported in a fresh interpreter and the heavy libraries it
+pulled in are listed.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+# Libraries that dominate start-up time when imported eagerly
+HEAVY_MODULES = ['cv2', 'numpy', 'pandas', 'pyarrow', 'pdfplumber', 'pytesseract', 'tesserocr', 'openai', 'google.cloud.documentai']
+REPORT_MODULES = [
+    'module_data_extraction.telemetry',
+    'module_data_extraction.registry',
+    'module_data_extraction.router',
+    'module_data_extraction.file_reader',
+    'module_data_extraction.file_reader_gen_ai',
+    'module_data_extraction.file_reader_google_cloud',
+    'module_data_extraction.postprocess',
+    'api.engines',
+]
+
+
+def _build_cache():
+    from module_data_extraction.result_cache import ResultCache
+    return ResultCache()
+
+
+def _build_tesseract():
+    from module_data_extraction.ocr_pool import TesseractPool
+    return TesseractPool()
+
+
+def _build_ocr():
+    from module_data_extraction.file_reader import DocumentExtractor
+    return DocumentExtractor()
+
+
+def _build_vision():
+    from module_data_extraction.file_reader_gen_ai import DocumentExtractor
+    return DocumentExtractor(cache=get('cache'))
+
+
+def _build_document_ai():
+    from module_data_extraction.file_reader_google_cloud import InvoiceExtractor
+    return InvoiceExtractor(cache=get('cache'))
+
+
+def _build_router():
+    from module_data_extraction.router import CascadeRouter
+    return CascadeRouter()
+
+
+BUILDERS = {
+    'cache': _build_cache,
+    'tesseract': _build_tesseract,
+    'ocr': _build_ocr,
+    'vision': _build_vision,
+    'documentai': _build_document_ai,
+    'router': _build_router,
+}
+
+_instances = {}
+_lock = threading.RLock()
+
+
+def get(name):
+    """Return the shared instance for name, building it on first use"""
+    instance = _instances.get(name)
+    if instance is None:
+        with _lock:
+            instance = _instances.get(name)
+            if instance is None:
+                instance = BUILDERS[name]()
+                _instances[name] = instance
+    return instance
+
+
+def reset():
+    """Forget every shared instance; the next get() builds a fresh one"""
+    with _lock:
+        _instances.clear()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset)
+
+
+def _measure_import(module, cwd):
+    script = (
+        'import json, sys, time\n'
+        'start = time.perf_counter()\n'
+        f'import {module}\n'
+        'elapsed = time.perf_counter() - start\n'
+        f'print(json.dumps({{"seconds": elapsed, "heavy": [name for name in {HEAVY_MODULES!r} if name in sys.modules]}}))\n'
+    )
+    completed = subprocess.run([sys.executable, '-c', script], cwd=cwd, capture_output=True, text=True)
+    if completed.returncode != 0:
+        error = (completed.stderr.strip().splitlines() or ['import failed'])[-1]
+        return {'module': module, 'seconds': None, 'heavy': [], 'error': error}
+    return {'module': module, **json.loads(completed.stdout.strip().splitlines()[-1])}
+
+
+def import_report(modules=None, build=False):
+    """
+    Import each module in a fresh interpreter and report its import time and the
+    heavy libraries it loaded. With build=True also time building each registry entry here.
+    """
+    cwd = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+    report = {'imports': [_measure_import(module, cwd) for module in modules or REPORT_MODULES]}
+    if build:
+        report['builds'] = []
+        for name in BUILDERS:
+            start = time.perf_counter()
+            try:
+                get(name)
+                report['builds'].append({'name': name, 'seconds': round(time.perf_counter() - start, 4)})
+            except Exception as e:
+                report['builds'].append({'name': name, 'seconds': None, 'error': str(e)})
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Report import and start-up cost of the extraction modules.')
+    parser.add_argument('modules', nargs='*', help='Modules to import (default: the extraction entry points)')
+    parser.add_argument('--build', action='store_true', help='Also time building each registry entry')
+    parser.add_argument('--json', action='store_true', help='Print the report as JSON')
+    args = parser.parse_args(argv)
+
+    report = import_report(args.modules or None, build=args.build)
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return report
+
+    print(f"{'module':<50} {'import ms':>10}  heavy libraries")
+    for row in report['imports']:
+        if row['seconds'] is None:
+            print(f"{row['module']:<50} {'failed':>10}  {row['error']}")
+        else:
+            print(f"{row['module']:<50} {row['seconds'] * 1000:>10.1f}  {', '.join(row['heavy']) or '-'}")
+    for row in report.get('builds', []):
+        seconds = f"{row['seconds'] * 1000:.1f} ms" if row['seconds'] is not None else f"failed: {row['error']}"
+        print(f"build {row['name']:<20} {seconds}")
+    return report
+
+
+if __name__ == '__main__':
+    main()
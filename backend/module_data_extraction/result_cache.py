@@ -0,0 +1,135 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from module_data_extraction import documents
+from module_data_extraction.telemetry import incr
+
+DEFAULT_CACHE_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'extraction_cache.sqlite3'))
+
+
+def file_sha256(file_path, chunk_size=1024 * 1024):
+    """Return the SHA-256 hex digest of a file, reading it in chunks"""
+    # A document mapped for the current extraction was hashed when it was opened
+    handle = documents.active(file_path)
+    if handle is not None:
+        return handle.sha256
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ResultCache:
+    """
+    Persistent cache of extraction results in a local SQLite file.
+    Entries are keyed by file content hash, engine name, prompt/schema version
+    and optionally a page number, so re-uploads of the same document skip the
+    paid remote call. Stale entries expire after ttl_seconds, and the least
+    recently used ones are evicted beyond max_entries.
+    """
+
+    def __init__(self, path=None, ttl_seconds=None, max_entries=None):
+        self.path = path or os.getenv('EXTRACTION_CACHE_PATH', DEFAULT_CACHE_PATH)
+        self.ttl_seconds = ttl_seconds if ttl_seconds is not None else int(os.getenv('EXTRACTION_CACHE_TTL', 60 * 60 * 24 * 30))
+        self.max_entries = max_entries if max_entries is not None else int(os.getenv('EXTRACTION_CACHE_MAX_ENTRIES', 100000))
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._create_table()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30)
+
+    def _create_table(self):
+        with closing(self._connect()) as conn, conn:
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS results (
+                    key TEXT PRIMARY KEY,
+                    file_hash TEXT NOT NULL,
+                    engine TEXT NOT NULL,
+                    value TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            conn.execute('CREATE INDEX IF NOT EXISTS results_file_hash ON results (file_hash)')
+            conn.execute('CREATE INDEX IF NOT EXISTS results_accessed_at ON results (accessed_at)')
+
+    @staticmethod
+    def _key(file_hash, engine, version, page=None):
+        return f"{engine}:{version}:{file_hash}:{page or 0}"
+
+    def _count(self, hit, engine):
+        with self._lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+        incr('cache_hits_total' if hit else 'cache_misses_total', engine=engine)
+
+    def get(self, file_hash, engine, version, page=None):
+        """Return the cached result, or None on a miss or expired entry"""
+        key = self._key(file_hash, engine, version, page)
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            row = conn.execute('SELECT value, created_at FROM results WHERE key = ?', (key,)).fetchone()
+            if row and self.ttl_seconds and now - row[1] > self.ttl_seconds:
+                conn.execute('DELETE FROM results WHERE key = ?', (key,))
+                row = None
+            if row:
+                conn.execute('UPDATE results SET accessed_at = ? WHERE key = ?', (now, key))
+        self._count(row is not None, engine)
+        return json.loads(row[0]) if row else None
+
+    def set(self, file_hash, engine, version, value, page=None):
+        """Store a JSON-serialisable result and evict old entries if needed"""
+        key = self._key(file_hash, engine, version, page)
+        now = time.time()
+        with closing(self._connect()) as conn, conn:
+            conn.execute(
+                'INSERT OR REPLACE INTO results (key, file_hash, engine, value, created_at, accessed_at) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (key, file_hash, engine, json.dumps(value), now, now)
+            )
+            self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        if self.ttl_seconds:
+            conn.execute('DELETE FROM results WHERE created_at < ?', (now - self.ttl_seconds,))
+        if self.max_entries:
+            conn.execute(
+                'DELETE FROM results WHERE key IN ('
+                'SELECT key FROM results ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+
+    def invalidate(self, file_hash=None, engine=None):
+        """Delete entries for a file and/or engine; with no arguments clears the cache"""
+        clauses, params = [], []
+        if file_hash:
+            clauses.append('file_hash = ?')
+            params.append(file_hash)
+        if engine:
+            clauses.append('engine = ?')
+            params.append(engine)
+        where = f" WHERE {' AND '.join(clauses)}" if clauses else ''
+        with closing(self._connect()) as conn, conn:
+            return conn.execute(f'DELETE FROM results{where}', params).rowcount
+
+    def stats(self):
+        """Return hit/miss counters for this instance and the current cache size"""
+        with closing(self._connect()) as conn:
+            entries = conn.execute('SELECT COUNT(*) FROM results').fetchone()[0]
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            'entries': entries
+        }
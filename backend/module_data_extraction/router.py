@@ -0,0 +1,242 @@
+"""
+A common interface over the extraction engines and a cascade router.
+
+Every engine returns the same record shape as the vision model's
+extracted_info (date, total_amount, currency, vendor_name, invoice_number,
+costs) plus a per-field confidence. The router runs the free local engine
+first and only escalates to Document AI or the vision model while required
+fields are missing or below their minimum confidence, and while the
+per-document cost and latency budgets allow another call.
+"""
+import abc
+import os
+import time
+from module_data_extraction.documents import PDF, document_kind, open_pdf
+from module_data_extraction.heuristics import GUESSED, LABELLED, extract_fields
+from module_data_extraction.rasterizer import file_page_count
+from module_data_extraction.tables import extract_page_table
+from module_data_extraction.telemetry import logger, span, incr
+
+KEY_FIELDS = ['date', 'total_amount', 'currency', 'vendor_name', 'invoice_number']
+REQUIRED_FIELDS = ['vendor_name', 'invoice_number', 'date', 'total_amount']
+# Confidence given to any field a remote model returns; they are trusted over the local heuristics
+REMOTE_CONFIDENCE = 0.95
+# Fields held to a lower bar than min_confidence. A letterhead line with a company suffix is as sure
+# as the heuristics get about the vendor without a "Vendor:" label, and rarely wrong on a text layer
+FIELD_MIN_CONFIDENCE = {'vendor_name': GUESSED}
+
+
+def _env_float(name, default=None):
+    value = os.getenv(name)
+    return float(value) if value not in (None, '') else default
+
+
+def _env_thresholds(name, default):
+    """Parse 'field=0.6,field=0.7' into a dict, starting from default"""
+    thresholds = dict(default)
+    for item in os.getenv(name, '').split(','):
+        if '=' in item:
+            field, value = item.split('=', 1)
+            thresholds[field.strip()] = float(value)
+    return thresholds
+
+
+class Engine(abc.ABC):
+    """Base class: extract(file_path) returns (record, confidence by field)"""
+    name = None
+    cost_per_page = 0.0
+
+    def estimate_cost(self, page_count):
+        return self.cost_per_page * page_count
+
+    @abc.abstractmethod
+    def extract(self, file_path):
+        """Return (record, confidence by field) for file_path"""
+
+
+class LocalEngine(Engine):
+    """
+    pdfplumber text layer (local OCR for scans and images) plus regex field
+    extraction, and line items from the text layer's table geometry; free
+    """
+    name = 'local'
+
+    def __init__(self, ocr=True):
+        self.ocr = ocr
+
+    def _text_layer(self, file_path):
+        """Return (text, table) from a PDF's text layer; table is None for scans"""
+        texts, costs, totals = [], [], {}
+        with open_pdf(file_path) as pdf:
+            for page in pdf.pages:
+                texts.append(page.extract_text() or '')
+                table = extract_page_table(page)
+                costs.extend(table['costs'])
+                totals = table['totals'] or totals
+        text = '\n'.join(texts)
+        return text, {'costs': costs, 'totals': totals} if text.strip() else None
+
+    def extract(self, file_path):
+        text, table = '', None
+        if document_kind(file_path) == PDF:
+            text, table = self._text_layer(file_path)
+        if table is None and self.ocr:
+            from module_data_extraction import registry
+            text = '\n'.join(page['text'] for page in registry.get('ocr').process_file(file_path))
+
+        fields, confidence = extract_fields(text)
+        if table:
+            fields['costs'] = table['costs']
+            if not fields['total_amount'] and table['totals'].get('total'):
+                fields['total_amount'], confidence['total_amount'] = table['totals']['total'], LABELLED
+        return fields, confidence
+
+
+class DocumentAIEngine(Engine):
+    """Google Document AI invoice parser"""
+    name = 'documentai'
+
+    def __init__(self, extractor=None, cost_per_page=None):
+        self.extractor = extractor
+        self.cost_per_page = cost_per_page if cost_per_page is not None else _env_float('DOCUMENTAI_COST_PER_PAGE', 0.01)
+
+    def extract(self, file_path):
+        if self.extractor is None:
+            from module_data_extraction import registry
+            self.extractor = registry.get('documentai')
+        result = self.extractor.extract_key_invoice_data(file_path)
+        if result.get('extraction_status') == 'error':
+            raise RuntimeError(result.get('error_message') or 'Document AI extraction failed')
+        record = {
+            'date': result.get('invoice_date'),
+            'total_amount': result.get('total_cost'),
+            'currency': None,
+            'vendor_name': result.get('supplier_name'),
+            'invoice_number': result.get('invoice_id'),
+            'costs': [],
+        }
+        return record, {field: REMOTE_CONFIDENCE for field, value in record.items() if value}
+
+
+class VisionEngine(Engine):
+    """OpenAI vision model, one request per page; header fields come from the first page that has them"""
+    name = 'vision'
+
+    def __init__(self, extractor=None, cost_per_page=None):
+        self.extractor = extractor
+        self.cost_per_page = cost_per_page if cost_per_page is not None else _env_float('OPENAI_COST_PER_PAGE', 0.01)
+
+    def extract(self, file_path):
+        if self.extractor is None:
+            from module_data_extraction import registry
+            self.extractor = registry.get('vision')
+        record = {field: None for field in KEY_FIELDS}
+        record['costs'] = []
+        for page in self.extractor.extract_key_info(file_path):
+            info = page.get('extracted_info')
+            if not isinstance(info, dict):
+                continue
+            for field in KEY_FIELDS:
+                if record[field] is None and info.get(field):
+                    record[field] = info[field]
+            record['costs'].extend(cost for cost in info.get('costs') or [] if isinstance(cost, dict))
+        return record, {field: REMOTE_CONFIDENCE for field, value in record.items() if value}
+
+
+ENGINE_CLASSES = {
+    'local': LocalEngine,
+    'documentai': DocumentAIEngine,
+    'vision': VisionEngine,
+}
+
+
+class CascadeRouter:
+    """
+    Run engines cheapest first and stop as soon as every required field is
+    found with at least its minimum confidence: field_min_confidence for the
+    fields listed there (EXTRACTION_FIELD_MIN_CONFIDENCE, e.g.
+    'vendor_name=0.6'), min_confidence for the rest. A paid engine is skipped when its
+    estimated cost would exceed max_cost for the document, or once
+    max_latency seconds have been spent. Later (more capable) engines
+    overwrite fields they return; fields they miss keep earlier values.
+    """
+
+    def __init__(self, engines=None, required_fields=None, min_confidence=None, max_cost=None, max_latency=None,
+                 field_min_confidence=None):
+        if engines is None:
+            names = os.getenv('EXTRACTION_CASCADE', 'local,documentai,vision').split(',')
+            engines = [ENGINE_CLASSES[name.strip()]() for name in names if name.strip()]
+        self.engines = engines
+        self.required_fields = required_fields or REQUIRED_FIELDS
+        self.min_confidence = min_confidence if min_confidence is not None else _env_float('EXTRACTION_MIN_CONFIDENCE', 0.8)
+        self.field_min_confidence = (
+            field_min_confidence if field_min_confidence is not None
+            else _env_thresholds('EXTRACTION_FIELD_MIN_CONFIDENCE', FIELD_MIN_CONFIDENCE)
+        )
+        # None means no budget
+        self.max_cost = max_cost if max_cost is not None else _env_float('EXTRACTION_MAX_COST_PER_DOCUMENT')
+        self.max_latency = max_latency if max_latency is not None else _env_float('EXTRACTION_MAX_LATENCY_SECONDS')
+
+    def threshold(self, field):
+        return self.field_min_confidence.get(field, self.min_confidence)
+
+    def missing_fields(self, confidence):
+        return [field for field in self.required_fields if confidence.get(field, 0.0) < self.threshold(field)]
+
+    def extract(self, file_path):
+        """Return the merged record with engine, engines_tried, confidence, missing_fields, cost and elapsed_seconds"""
+        start = time.perf_counter()
+        record = {field: None for field in KEY_FIELDS}
+        record['costs'] = []
+        confidence = {}
+        tried, cost, page_count, engine_used = [], 0.0, None, None
+
+        for engine in self.engines:
+            if tried and not self.missing_fields(confidence):
+                break
+            if engine.cost_per_page:
+                if page_count is None:
+                    page_count = file_page_count(file_path)
+                estimate = engine.estimate_cost(page_count)
+                if self.max_cost is not None and cost + estimate > self.max_cost:
+                    logger.info("Skipping %s for %s: cost budget exceeded", engine.name, file_path)
+                    incr('cascade_skipped_total', engine=engine.name, reason='cost')
+                    continue
+                if self.max_latency is not None and time.perf_counter() - start >= self.max_latency:
+                    logger.info("Skipping %s for %s: latency budget exceeded", engine.name, file_path)
+                    incr('cascade_skipped_total', engine=engine.name, reason='latency')
+                    continue
+
+            tried.append(engine.name)
+            # A paid call is billed whether or not its answer is usable
+            cost += engine.estimate_cost(page_count) if engine.cost_per_page else 0.0
+            try:
+                with span('engine', engine=engine.name):
+                    fields, field_confidence = engine.extract(file_path)
+            except Exception as e:
+                logger.warning("%s failed on %s: %s", engine.name, file_path, e)
+                incr('errors_total', engine=engine.name)
+                continue
+            engine_used = engine.name
+
+            for field, value in fields.items():
+                if field == 'costs':
+                    if value:
+                        record['costs'] = value
+                elif value and field_confidence.get(field, 0.0) >= confidence.get(field, 0.0):
+                    record[field] = value
+                    confidence[field] = field_confidence.get(field, 0.0)
+
+        if engine_used:
+            incr('cascade_documents_total', engine=engine_used)
+        record.update({
+            'engine': engine_used,
+            'engines_tried': tried,
+            'confidence': confidence,
+            'missing_fields': self.missing_fields(confidence),
+            'cost': round(cost, 6),
+            'elapsed_seconds': round(time.perf_counter() - start, 4),
+        })
+        if not engine_used:
+            raise RuntimeError(f"No extraction engine succeeded for {file_path}")
+        return record
@@ -0,0 +1,174 @@
+"""
+Line-item tables and totals from a PDF text layer, without OCR or model calls.
+
+Words from pdfplumber are grouped into visual rows by their vertical
+position. A header row (Description / Qty / Unit price / Amount) fixes the
+column positions, and each row below it is split into cells by where its
+words sit horizontally. Rows without numbers continue the previous item's
+description. Without a recognisable header, rows that end in one to three
+numbers are read as description followed by qty, unit price and amount.
+Rows labelled Subtotal, Tax, Total and so on form the totals block.
+
+Items use the same schema as the vision engine's ``costs`` field
+(description, amount), plus quantity and unit_price when present.
+"""
+import re
+from module_data_extraction.normalize import parse_amount
+
+# Words whose vertical midpoints are this close (in points) share a row
+ROW_TOLERANCE = 3.0
+
+HEADER_KEYWORDS = {
+    'description': {'description', 'item', 'items', 'product', 'service', 'services', 'details', 'particulars'},
+    'quantity': {'qty', 'qty.', 'quantity', 'units', 'hours', 'hrs'},
+    'unit_price': {'price', 'rate', 'unit', 'each'},
+    'amount': {'amount', 'total', 'line', 'subtotal', 'value'},
+}
+TOTALS_LABELS = [
+    ('subtotal', r'sub\s*-?\s*total'),
+    ('discount', r'discount'),
+    ('shipping', r'shipping|freight|delivery'),
+    ('tax', r'tax|vat|gst|hst'),
+    ('total', r'grand\s+total|total\s+due|amount\s+due|balance\s+due|total'),
+]
+NUMBER_RE = re.compile(r'^[(\-]?[$€£¥₹]?\s?-?\d[\d,.]*\)?%?$')
+
+
+def _is_number(text):
+    return bool(NUMBER_RE.match(text)) and parse_amount(text) is not None
+
+
+def group_rows(words, tolerance=ROW_TOLERANCE):
+    """Group pdfplumber words into rows (lists sorted left to right), top to bottom"""
+    rows = []
+    for word in sorted(words, key=lambda word: ((word['top'] + word['bottom']) / 2, word['x0'])):
+        middle = (word['top'] + word['bottom']) / 2
+        if rows and abs(rows[-1]['middle'] - middle) <= tolerance:
+            rows[-1]['words'].append(word)
+        else:
+            rows.append({'middle': middle, 'words': [word]})
+    return [sorted(row['words'], key=lambda word: word['x0']) for row in rows]
+
+
+def _totals_label(row):
+    """Return the totals key for a row such as 'Subtotal: 100.00', or None"""
+    label = ' '.join(word['text'] for word in row if not _is_number(word['text'])).lower().strip(' :')
+    if not label or len(label) > 30:
+        return None
+    for key, pattern in TOTALS_LABELS:
+        if re.fullmatch(rf'(?:{pattern})(?:\s*\(.*\))?(?:\s*[\w%]*)?', label):
+            return key
+    return None
+
+
+def _find_header(rows):
+    """Return (row index, {column: (x0, x1)}) for the first row that looks like a table header"""
+    for index, row in enumerate(rows):
+        columns = {}
+        for word in row:
+            text = word['text'].lower().strip(':')
+            for column, keywords in HEADER_KEYWORDS.items():
+                if text in keywords and column not in columns:
+                    columns[column] = (word['x0'], word['x1'])
+                    break
+                if text in keywords and column in columns:
+                    # "Unit Price", "Line Total": widen the column to cover both words
+                    x0, x1 = columns[column]
+                    columns[column] = (min(x0, word['x0']), max(x1, word['x1']))
+                    break
+        if 'amount' in columns and ('description' in columns or len(columns) >= 3):
+            return index, columns
+    return None, None
+
+
+def _assign_cells(row, columns):
+    """Split a row's words into cells by the nearest header column"""
+    numeric_columns = [column for column in ('quantity', 'unit_price', 'amount') if column in columns]
+    cells = {}
+    for word in row:
+        if _is_number(word['text']) and numeric_columns:
+            # Numbers are usually right-aligned under their header, so compare right edges
+            column = min(numeric_columns, key=lambda column: abs(columns[column][1] - word['x1']))
+            if word['x1'] < min(columns[column][0] for column in numeric_columns) - 5:
+                column = 'description'
+        else:
+            column = 'description'
+        cells.setdefault(column, []).append(word['text'])
+    return {column: ' '.join(words) for column, words in cells.items()}
+
+
+def _item(description, quantity=None, unit_price=None, amount=None):
+    item = {'description': description.strip() or None, 'amount': amount}
+    if quantity is not None:
+        item['quantity'] = quantity
+    if unit_price is not None:
+        item['unit_price'] = unit_price
+    return item
+
+
+def _trailing_numbers_item(row):
+    """Read 'Widget A  2  10.00  20.00' as description, qty, unit price, amount"""
+    numbers = []
+    for word in reversed(row):
+        if not _is_number(word['text']) or len(numbers) == 3:
+            break
+        numbers.insert(0, word['text'])
+    # Without a header, only trust rows that end in a money amount (20.00), not zip codes or ids
+    if not numbers or len(numbers) == len(row) or not re.search(r'[.,]\d{2}\)?$', numbers[-1]):
+        return None
+    description = ' '.join(word['text'] for word in row[:len(row) - len(numbers)])
+    if len(numbers) == 3:
+        return _item(description, numbers[0], numbers[1], numbers[2])
+    if len(numbers) == 2:
+        return _item(description, numbers[0], None, numbers[1])
+    return _item(description, amount=numbers[0])
+
+
+def extract_table(words):
+    """Return {'costs': [...], 'totals': {...}} from one page's pdfplumber words"""
+    rows = group_rows(words)
+    header_index, columns = _find_header(rows)
+    body = rows[header_index + 1:] if header_index is not None else rows
+    costs, totals = [], {}
+
+    for row in body:
+        key = _totals_label(row)
+        numbers = [word['text'] for word in row if _is_number(word['text'])]
+        if key:
+            if numbers and key not in totals:
+                totals[key] = numbers[-1]
+            continue
+        if totals:
+            # Anything after the totals block (notes, bank details) is not a line item
+            continue
+
+        if columns:
+            cells = _assign_cells(row, columns)
+            if cells.get('amount'):
+                costs.append(_item(cells.get('description', ''), cells.get('quantity'), cells.get('unit_price'), cells['amount']))
+            elif costs and cells.get('description') and not numbers:
+                # A wrapped description line
+                costs[-1]['description'] = f"{costs[-1]['description'] or ''} {cells['description']}".strip()
+        else:
+            item = _trailing_numbers_item(row)
+            if item and item['description'] and not re.search(r'\b(?:invoice|date|page|phone|tel|fax)\b', item['description'], re.IGNORECASE):
+                costs.append(item)
+
+    return {'costs': costs, 'totals': totals}
+
+
+def extract_page_table(page):
+    """Line items and totals for one pdfplumber page"""
+    return extract_table(page.extract_words(keep_blank_chars=False, use_text_flow=False))
+
+
+def extract_pdf_tables(pdf_path):
+    """Line items from every page of a text-layer PDF, and the totals block of the last page that has one"""
+    from module_data_extraction.documents import open_pdf
+    costs, totals = [], {}
+    with open_pdf(pdf_path) as pdf:
+        for page in pdf.pages:
+            table = extract_page_table(page)
+            costs.extend(table['costs'])
+            totals = table['totals'] or totals
+    return {'costs': costs, 'totals': totals}
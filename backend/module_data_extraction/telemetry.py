@@ -0,0 +1,224 @@
+"""
+Lightweight tracing and metrics for the extraction pipeline.
+
+Stages (rasterize, preprocess, ocr, model_call, parse, save, ...) are timed
+with ``span()`` and recorded as latency histograms; ``incr()`` bumps
+counters such as pages, retries, cache hits and tokens used. Each process
+keeps its own registry and ``flush()`` writes a snapshot to
+EXTRACTION_METRICS_DIR, where ``collect()`` merges all processes
+(web, queue runner and pool workers) for the Prometheus endpoint.
+
+Snapshot files are named by pid plus a random token, so a recycled pid never
+overwrites another process's counters. When ``collect()`` finds a file whose
+process has exited, it folds those counters into ``metrics-retired.json``
+and deletes the file. Short-lived pool workers therefore do not pile up, and
+the totals never go backwards.
+"""
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+logger = logging.getLogger('module_data_extraction')
+
+PREFIX = 'blinkai_extraction'
+# Upper bounds (seconds) of the stage latency histogram buckets
+BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+RETIRED_FILE = 'metrics-retired.json'
+LOCK_FILE = '.metrics.lock'
+
+
+def _series(name, labels):
+    if not labels:
+        return name
+    rendered = ','.join(f'{key}="{value}"' for key, value in sorted(labels.items()))
+    return f"{name}{{{rendered}}}"
+
+
+class Telemetry:
+    """Process-wide registry of counters and stage latency histograms"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._token = None
+        self.reset()
+
+    def _after_fork(self):
+        # A forked child starts from zero, or it would report its parent's counters a second time
+        self._lock = threading.Lock()
+        self._token = None
+        self.counters = {}
+        self.stages = {}
+
+    def reset(self):
+        with self._lock:
+            self.counters = {}
+            self.stages = {}
+
+    def incr(self, name, amount=1, **labels):
+        """Add amount to a counter, e.g. incr('pages_total', source='ocr')"""
+        series = _series(name, labels)
+        with self._lock:
+            self.counters[series] = self.counters.get(series, 0) + amount
+
+    def observe(self, stage, seconds):
+        """Record one stage duration in the latency histogram"""
+        with self._lock:
+            histogram = self.stages.setdefault(stage, {'count': 0, 'sum': 0.0, 'buckets': [0] * len(BUCKETS)})
+            histogram['count'] += 1
+            histogram['sum'] += seconds
+            for index, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    histogram['buckets'][index] += 1
+
+    @contextmanager
+    def span(self, stage, **attributes):
+        """Time a pipeline stage; extra attributes only go to the debug log"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.observe(stage, elapsed)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%s took %.4fs %s", stage, elapsed, attributes or '')
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'counters': dict(self.counters),
+                'stages': {stage: {**data, 'buckets': list(data['buckets'])} for stage, data in self.stages.items()},
+            }
+
+    def flush(self, directory=None):
+        """Write this process's snapshot to the shared metrics directory, if one is configured"""
+        directory = directory or os.getenv('EXTRACTION_METRICS_DIR')
+        if not directory:
+            return None
+        os.makedirs(directory, exist_ok=True)
+        if self._token is None:
+            self._token = uuid.uuid4().hex[:12]
+        path = os.path.join(directory, f"metrics-{os.getpid()}-{self._token}.json")
+        _write(path, self.snapshot())
+        return path
+
+
+telemetry = Telemetry()
+span = telemetry.span
+incr = telemetry.incr
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=telemetry._after_fork)
+
+
+def merge(snapshots):
+    """Sum counters and histograms from several snapshots"""
+    merged = {'counters': {}, 'stages': {}}
+    for snapshot in snapshots:
+        for series, value in snapshot.get('counters', {}).items():
+            merged['counters'][series] = merged['counters'].get(series, 0) + value
+        for stage, data in snapshot.get('stages', {}).items():
+            target = merged['stages'].setdefault(stage, {'count': 0, 'sum': 0.0, 'buckets': [0] * len(BUCKETS)})
+            target['count'] += data['count']
+            target['sum'] += data['sum']
+            target['buckets'] = [a + b for a, b in zip(target['buckets'], data['buckets'])]
+    return merged
+
+
+def _process_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _snapshot_pid(name):
+    """pid encoded in a metrics-<pid>[-<token>].json name, or None for other files"""
+    if not (name.startswith('metrics-') and name.endswith('.json')):
+        return None
+    pid = name[len('metrics-'):-len('.json')].split('-')[0]
+    return int(pid) if pid.isdigit() else None
+
+
+def _read(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _write(path, snapshot):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+
+def retire_exited(directory):
+    """Fold the snapshots of processes that have exited into the retired totals and delete them"""
+    with open(os.path.join(directory, LOCK_FILE), 'w') as lock:
+        # Several web workers may collect at once; only one may move a file into the totals
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        retired_path = os.path.join(directory, RETIRED_FILE)
+        exited = [
+            name for name in os.listdir(directory)
+            if (pid := _snapshot_pid(name)) is not None and pid != os.getpid() and not _process_alive(pid)
+        ]
+        if not exited:
+            return 0
+        snapshots = [_read(retired_path) or {}]
+        snapshots += [_read(os.path.join(directory, name)) or {} for name in exited]
+        _write(retired_path, merge(snapshots))
+        for name in exited:
+            try:
+                os.remove(os.path.join(directory, name))
+            except FileNotFoundError:
+                pass
+        return len(exited)
+
+
+def collect(directory=None):
+    """Merge the snapshots flushed by every process, including this one and those that have exited"""
+    directory = directory or os.getenv('EXTRACTION_METRICS_DIR')
+    own_file = telemetry.flush(directory)
+    snapshots = [] if own_file else [telemetry.snapshot()]
+    if directory and os.path.isdir(directory):
+        retire_exited(directory)
+        for name in os.listdir(directory):
+            if _snapshot_pid(name) is None and name != RETIRED_FILE:
+                continue
+            snapshot = _read(os.path.join(directory, name))
+            if snapshot is not None:
+                snapshots.append(snapshot)
+    return merge(snapshots)
+
+
+def render_prometheus(snapshot):
+    """Render a snapshot in the Prometheus text exposition format"""
+    lines = []
+    counter_names = sorted({series.split('{')[0] for series in snapshot['counters']})
+    for name in counter_names:
+        lines.append(f"# TYPE {PREFIX}_{name} counter")
+        for series, value in sorted(snapshot['counters'].items()):
+            if series.split('{')[0] == name:
+                lines.append(f"{PREFIX}_{series} {value}")
+
+    if snapshot['stages']:
+        metric = f"{PREFIX}_stage_seconds"
+        lines.append(f"# TYPE {metric} histogram")
+        for stage, data in sorted(snapshot['stages'].items()):
+            # Buckets are stored per-bound; Prometheus expects cumulative counts, which observe() already keeps
+            for bound, count in zip(BUCKETS, data['buckets']):
+                lines.append(f'{metric}_bucket{{stage="{stage}",le="{bound}"}} {count}')
+            lines.append(f'{metric}_bucket{{stage="{stage}",le="+Inf"}} {data["count"]}')
+            lines.append(f'{metric}_sum{{stage="{stage}"}} {round(data["sum"], 6)}')
+            lines.append(f'{metric}_count{{stage="{stage}"}} {data["count"]}')
+    return '\n'.join(lines) + '\n'
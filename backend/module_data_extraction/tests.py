@@ -0,0 +1,1189 @@
+import asyncio
+import base64
+import hashlib
+import json
+import os
+import random
+import shutil
+import stat
+import sys
+import tempfile
+import threading
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+from types import SimpleNamespace
+from unittest import mock
+
+from PIL import Image
+from django.conf import settings
+from django.test import SimpleTestCase, override_settings
+
+from module_data_extraction import (
+    benchmark, dedupe, documents, file_reader, file_reader_gen_ai, heuristics, ocr_pool, postprocess, rasterizer,
+    rate_limit, registry, result_cache, router, tables, telemetry,
+)
+from module_data_extraction.file_reader_gen_ai import DocumentExtractor
+from module_data_extraction.file_reader_google_cloud import InvoiceExtractor
+from module_data_extraction.preprocess import ImagePreprocessor
+
+
+class TempDirMixin:
+    """A scratch directory per test; the metrics, progress and result cache files the code writes land in it too"""
+
+    def setUp(self):
+        super().setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp, ignore_errors=True)
+        outputs = {
+            "EXTRACTION_METRICS_DIR": os.path.join(self.tmp, "metrics"),
+            "EXTRACTION_PROGRESS_DIR": os.path.join(self.tmp, "progress"),
+        }
+        # The extractors read these from the environment, the API from settings
+        environ = mock.patch.dict(os.environ, outputs, EXTRACTION_CACHE_PATH=os.path.join(self.tmp, "cache.sqlite3"))
+        environ.start()
+        self.addCleanup(environ.stop)
+        # Shared extractors built during the test hold the temporary cache path
+        self.addCleanup(registry.reset)
+        override = override_settings(**outputs)
+        override.enable()
+        self.addCleanup(override.disable)
+
+
+class BenchmarkTests(TempDirMixin, SimpleTestCase):
+    def test_documentai_stub_scores_every_field(self):
+        manifest = benchmark.generate_corpus(self.tmp, documents=3, pages=1)
+        metrics = benchmark.run_engine_benchmark("documentai", manifest)
+        self.assertEqual(metrics["errors"], 0)
+        self.assertEqual(metrics["field_accuracy"], {field: 1.0 for field in benchmark.FIELDS})
+
+    def test_error_results_count_as_errors(self):
+        manifest = benchmark.generate_corpus(self.tmp, documents=2, pages=1)
+        broken = SimpleNamespace(process_document=mock.Mock(side_effect=RuntimeError("quota exceeded")))
+        with mock.patch.object(benchmark, "RecordedDocumentAIClient", return_value=broken):
+            with self.assertLogs("module_data_extraction", "WARNING") as logs:
+                metrics = benchmark.run_engine_benchmark("documentai", manifest)
+        self.assertEqual(metrics["errors"], 2)
+        self.assertIn("quota exceeded", logs.output[0])
+
+    def test_empty_results_count_as_errors(self):
+        manifest = benchmark.generate_corpus(self.tmp, documents=3, pages=2)
+        results = iter([[], {"extraction_status": "success", "invoice_id": "x"}, {}])
+        with mock.patch.object(benchmark, "_extract", side_effect=lambda *args: next(results)):
+            with self.assertLogs("module_data_extraction", "WARNING") as logs:
+                metrics = benchmark.run_engine_benchmark("documentai", manifest)
+        self.assertEqual((metrics["errors"], metrics["pages"]), (2, 2))
+        self.assertIn("no pages extracted", logs.output[0])
+        self.assertEqual(metrics["field_accuracy"]["invoice_number"], 0.0)
+
+    def test_regressions_against_an_older_report(self):
+        metrics = benchmark.run_engine_benchmark("documentai", benchmark.generate_corpus(self.tmp, documents=2))
+        p50 = metrics["avg_page_seconds"]["p50"]
+        before = {**metrics, "page_latency_seconds": {"p50": p50 / 2}, "field_accuracy": dict.fromkeys(benchmark.FIELDS, 1.0)}
+        del before["avg_page_seconds"]
+        regressions = benchmark.compare_reports({"engines": {"documentai": before}}, {"engines": {"documentai": metrics}})
+        self.assertEqual(regressions, [f"documentai: p50 average seconds per page {p50 / 2}s -> {p50}s"])
+
+
+class TelemetryTests(TempDirMixin, SimpleTestCase):
+    def _write_snapshot(self, name, counters):
+        with open(os.path.join(self.tmp, name), "w", encoding="utf-8") as f:
+            json.dump({"counters": counters, "stages": {}}, f)
+
+    def test_snapshots_of_exited_processes_are_folded_into_retired_totals(self):
+        self._write_snapshot("metrics-999991-aaaa.json", {"retire_test_total": 3})
+        self._write_snapshot("metrics-999992-bbbb.json", {"retire_test_total": 4})
+        with mock.patch.object(telemetry, "_process_alive", return_value=False):
+            first = telemetry.collect(self.tmp)
+            self._write_snapshot("metrics-999993-cccc.json", {"retire_test_total": 5})
+            second = telemetry.collect(self.tmp)
+
+        self.assertEqual(first["counters"].get("retire_test_total"), 7)
+        self.assertEqual(second["counters"].get("retire_test_total"), 12)
+        remaining = sorted(name for name in os.listdir(self.tmp) if name.endswith(".json"))
+        own = [name for name in remaining if name.startswith(f"metrics-{os.getpid()}-")]
+        self.assertEqual(sorted(set(remaining) - set(own)), [telemetry.RETIRED_FILE])
+
+    def test_live_processes_keep_their_own_file(self):
+        self._write_snapshot("metrics-999994-dddd.json", {"retire_test_total": 2})
+        with mock.patch.object(telemetry, "_process_alive", return_value=True):
+            snapshot = telemetry.collect(self.tmp)
+        self.assertEqual(snapshot["counters"].get("retire_test_total"), 2)
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, "metrics-999994-dddd.json")))
+
+    def test_flush_names_the_file_after_pid_and_token(self):
+        name = os.path.basename(telemetry.telemetry.flush(self.tmp))
+        self.assertEqual(telemetry._snapshot_pid(name), os.getpid())
+        self.assertNotEqual(name, f"metrics-{os.getpid()}.json")
+
+
+def _invoice(number, total, vendor="Acme Office Goods"):
+    return {
+        "vendor_name": vendor,
+        "invoice_number": number,
+        "date": "2024-03-01",
+        "total_amount": total,
+        "currency": "USD",
+        "costs": [
+            {"description": "Printer paper A4", "quantity": 2, "unit_price": "4.50", "amount": "9.00"},
+            {"description": "Toner cartridge", "quantity": 1, "unit_price": "61.00", "amount": "61.00"},
+        ],
+    }
+
+
+class DedupeTests(TempDirMixin, SimpleTestCase):
+    def _render(self, truth, seed=0):
+        return benchmark.render_page(benchmark._invoice_lines(truth), random.Random(seed))
+
+    def test_invoices_from_one_template_do_not_collide(self):
+        hashes = [
+            dedupe.perceptual_hash(self._render(_invoice(number, total), seed))
+            for seed, (number, total) in enumerate([("INV-10231", "70.00"), ("INV-58812", "912.40"), ("INV-77120", "13.99")])
+        ]
+        self.assertEqual(len(set(hashes)), 3)
+        for i in range(3):
+            for j in range(i + 1, 3):
+                self.assertGreater(dedupe.hamming_distance(hashes[i], hashes[j]), settings.EXTRACTION_NEAR_DUPLICATE_DISTANCE)
+
+    def test_recompressed_copy_stays_close(self):
+        page = self._render(_invoice("INV-10231", "70.00"))
+        path = os.path.join(self.tmp, "copy.jpg")
+        page.save(path, quality=60)
+        distance = dedupe.hamming_distance(dedupe.perceptual_hash(page), dedupe.file_perceptual_hash(path))
+        self.assertLessEqual(distance, settings.EXTRACTION_NEAR_DUPLICATE_DISTANCE)
+
+    def test_hash_ignores_blank_margins(self):
+        page = self._render(_invoice("INV-10231", "70.00"))
+        cropped = dedupe.content_crop(page)
+        self.assertLess(cropped.width, page.width)
+        self.assertEqual(dedupe.perceptual_hash(page), dedupe.perceptual_hash(cropped))
+
+    def test_close_hashes_share_a_band(self):
+        rng = random.Random(7)
+        for _ in range(200):
+            value = rng.getrandbits(dedupe.HASH_BITS)
+            flipped = value
+            for bit in rng.sample(range(dedupe.HASH_BITS), dedupe.MAX_BANDED_DISTANCE):
+                flipped ^= 1 << bit
+            shared = set(enumerate(dedupe.hash_bands(value))) & set(enumerate(dedupe.hash_bands(flipped)))
+            self.assertTrue(shared)
+
+    def test_text_fingerprint_of_pdf_text_layer(self):
+        first, second, copy = (os.path.join(self.tmp, name) for name in ("a.pdf", "b.pdf", "c.pdf"))
+        benchmark.write_text_pdf(first, [benchmark._invoice_lines(_invoice("INV-10231", "70.00"))])
+        benchmark.write_text_pdf(second, [benchmark._invoice_lines(_invoice("INV-58812", "70.00"))])
+        benchmark.write_text_pdf(copy, [benchmark._invoice_lines(_invoice("INV-10231", "70.00"))])
+        self.assertTrue(dedupe.file_text_fingerprint(first))
+        self.assertEqual(dedupe.file_text_fingerprint(first), dedupe.file_text_fingerprint(copy))
+        self.assertNotEqual(dedupe.file_text_fingerprint(first), dedupe.file_text_fingerprint(second))
+
+    def test_images_have_no_text_fingerprint(self):
+        path = os.path.join(self.tmp, "scan.png")
+        self._render(_invoice("INV-10231", "70.00")).save(path)
+        self.assertEqual(dedupe.file_text_fingerprint(path), "")
+
+    def test_invoice_key_normalizes_vendor_number_and_total(self):
+        self.assertEqual(
+            dedupe.invoice_key("ACME, Inc.", "inv-0042", "1,250.00"),
+            dedupe.invoice_key("Acme", "INV 0042", "1250"),
+        )
+        self.assertNotEqual(dedupe.invoice_key("Acme", "INV-0042", "10"), dedupe.invoice_key("Acme", "INV-0043", "10"))
+        self.assertEqual(dedupe.invoice_key("Acme", "", "10"), "")
+        self.assertEqual(dedupe.invoice_key("", "INV-0042", None), "")
+
+
+class PaidEngine(router.Engine):
+    name = "paid"
+    cost_per_page = 0.01
+
+    def __init__(self):
+        self.calls = 0
+
+    def extract(self, file_path):
+        self.calls += 1
+        record = {"vendor_name": "Northwind Traders", "invoice_number": "INV-1", "date": "2024-03-01",
+                  "total_amount": "70.00", "currency": "USD", "costs": []}
+        return record, {field: router.REMOTE_CONFIDENCE for field, value in record.items() if value}
+
+
+class CascadeRouterTests(TempDirMixin, SimpleTestCase):
+    def _text_pdf(self, vendor):
+        path = os.path.join(self.tmp, "invoice.pdf")
+        benchmark.write_text_pdf(path, [benchmark._invoice_lines(_invoice("INV-10231", "70.00", vendor=vendor))])
+        return path
+
+    def _router(self, **options):
+        self.paid = PaidEngine()
+        return router.CascadeRouter(engines=[router.LocalEngine(ocr=False), self.paid], **options)
+
+    def test_clean_text_pdf_finishes_locally(self):
+        with mock.patch.dict(os.environ, {"EXTRACTION_FIELD_MIN_CONFIDENCE": ""}):
+            record = self._router().extract(self._text_pdf("East Repair Inc."))
+        self.assertEqual(record["engines_tried"], ["local"])
+        self.assertEqual(record["missing_fields"], [])
+        self.assertEqual(record["vendor_name"], "East Repair Inc.")
+        self.assertEqual(self.paid.calls, 0)
+
+    def test_unsure_vendor_escalates(self):
+        record = self._router().extract(self._text_pdf("Northwind Traders"))
+        self.assertEqual(record["engines_tried"], ["local", "paid"])
+        self.assertEqual(record["engine"], "paid")
+        self.assertEqual(record["vendor_name"], "Northwind Traders")
+
+    def test_field_thresholds_can_be_raised(self):
+        record = self._router(field_min_confidence={}).extract(self._text_pdf("East Repair Inc."))
+        self.assertEqual(record["engines_tried"], ["local", "paid"])
+
+    def test_thresholds_from_environment(self):
+        with mock.patch.dict(os.environ, {"EXTRACTION_FIELD_MIN_CONFIDENCE": "vendor_name=0.9, date=0.5"}):
+            cascade = self._router()
+        self.assertEqual(cascade.threshold("vendor_name"), 0.9)
+        self.assertEqual(cascade.threshold("date"), 0.5)
+        self.assertEqual(cascade.threshold("total_amount"), cascade.min_confidence)
+
+    def test_failed_paid_call_is_still_charged(self):
+        cascade = self._router()
+        with mock.patch.object(self.paid, "extract", side_effect=TimeoutError("slow")), \
+                self.assertLogs("module_data_extraction", "WARNING"):
+            record = cascade.extract(self._text_pdf("Northwind Traders"))
+        self.assertEqual(record["engines_tried"], ["local", "paid"])
+        self.assertEqual(record["engine"], "local")
+        self.assertEqual(record["cost"], 0.01)
+
+    def test_total_stops_at_the_amount(self):
+        for text, total in [("Total: 100.00 5", "100.00"), ("Total: 1,234.56", "1,234.56"),
+                            ("Amount due EUR 1.234,56", "EUR 1.234,56"), ("Total: 1\u202f234,56", "1\u202f234,56"),
+                            ("Grand Total: $ 1234.5 (3 items)", "$ 1234.5")]:
+            with self.subTest(text=text):
+                self.assertEqual(heuristics.extract_fields(text)[0]["total_amount"], total)
+
+    def test_engines_must_implement_extract(self):
+        class Incomplete(router.Engine):
+            name = "incomplete"
+
+        with self.assertRaises(TypeError):
+            Incomplete()
+
+
+# Stands in for `tesseract stdin stdout`: reports each TIFF frame's size, form-feed separated as tesseract does
+FAKE_TESSERACT = """#!{python}
+import sys
+from io import BytesIO
+from PIL import Image, ImageSequence
+with Image.open(BytesIO(sys.stdin.buffer.read())) as tiff:
+    for frame in ImageSequence.Iterator(tiff):
+        sys.stdout.write("%dx%d\\f" % frame.size)
+"""
+
+
+class RecordingWorker:
+    created = 0
+
+    def __init__(self, lang="eng"):
+        RecordingWorker.created += 1
+
+    def ocr_many(self, images):
+        return [f"{image.width}x{image.height}" for image in images]
+
+    def close(self):
+        pass
+
+
+class FakeTessBaseAPI:
+    """Stands in for tesserocr.PyTessBaseAPI; reads an image as its size"""
+    instances = []
+
+    def __init__(self, lang, path=None):
+        self.lang, self.path, self.ended = lang, path, False
+        self.instances.append(self)
+
+    def SetImage(self, image):
+        self.image = image
+
+    def GetUTF8Text(self):
+        return "%dx%d" % self.image.size
+
+    def End(self):
+        self.ended = True
+
+class OcrPoolTests(TempDirMixin, SimpleTestCase):
+    def test_auto_prefers_tesserocr_and_falls_back_to_pytesseract(self):
+        with mock.patch.dict(os.environ, {"OCR_BACKEND": "auto"}):
+            with mock.patch.object(ocr_pool, "_tesserocr_available", return_value=True):
+                self.assertEqual(ocr_pool.resolve_backend(), "tesserocr")
+            with mock.patch.object(ocr_pool, "_tesserocr_available", return_value=False):
+                self.assertEqual(ocr_pool.resolve_backend(), "pytesseract")
+        self.assertEqual(ocr_pool.resolve_backend("pipe"), "pipe")
+        with self.assertRaises(ValueError):
+            ocr_pool.resolve_backend("cuneiform")
+
+    def test_default_backend_keeps_one_engine_loaded(self):
+        FakeTessBaseAPI.instances = []
+        fake_tesserocr = SimpleNamespace(PyTessBaseAPI=FakeTessBaseAPI)
+        environ = {"OCR_BACKEND": "auto", "OCR_POOL_SIZE": "1", "TESSDATA_PREFIX": "/opt/tessdata"}
+        with mock.patch.dict(sys.modules, {"tesserocr": fake_tesserocr}), mock.patch.dict(os.environ, environ):
+            pool = ocr_pool.TesseractPool()
+            self.assertEqual(pool.backend, "tesserocr")
+            self.assertEqual(pool.ocr_many([Image.new("L", (30, 40)), Image.new("L", (50, 60))]), ["30x40", "50x60"])
+            self.assertEqual(pool.ocr(Image.new("L", (70, 80))), "70x80")
+            pool.close()
+        engine, = FakeTessBaseAPI.instances
+        self.assertEqual((engine.lang, engine.path, engine.ended), ("eng", "/opt/tessdata", True))
+
+    def test_tessdata_is_found_through_the_tesseract_command(self):
+        command = os.path.join(self.tmp, "tesseract")
+        with open(command, "w", encoding="utf-8") as f:
+            f.write(f'#!{sys.executable}\nprint(\'List of available languages in "/usr/share/tessdata/" (2):\')\n')
+        os.chmod(command, os.stat(command).st_mode | stat.S_IEXEC)
+        with mock.patch.dict(os.environ):
+            os.environ.pop("TESSDATA_PREFIX", None)
+            self.assertEqual(ocr_pool.tessdata_path(command), "/usr/share/tessdata/")
+            self.assertIsNone(ocr_pool.tessdata_path(os.path.join(self.tmp, "missing")))
+
+    def test_pool_never_builds_more_than_size_engines(self):
+        RecordingWorker.created = 0
+        with mock.patch.dict(ocr_pool.WORKER_CLASSES, {"pytesseract": RecordingWorker}):
+            pool = ocr_pool.TesseractPool(size=2, backend="pytesseract")
+            images = [Image.new("L", (10 + n, 20)) for n in range(3)]
+            threads = [threading.Thread(target=pool.ocr_many, args=(images,)) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(pool.ocr_many(images), ["10x20", "11x20", "12x20"])
+        self.assertLessEqual(RecordingWorker.created, 2)
+
+    def test_pipe_worker_splits_pages_on_form_feeds(self):
+        command = os.path.join(self.tmp, "tesseract")
+        with open(command, "w", encoding="utf-8") as f:
+            f.write(FAKE_TESSERACT.format(python=sys.executable))
+        os.chmod(command, os.stat(command).st_mode | stat.S_IEXEC)
+
+        worker = ocr_pool.PipeWorker(tesseract_cmd=command)
+        pages = [Image.new("L", (30, 40), 255), Image.new("L", (50, 60), 255)]
+        self.assertEqual(worker.ocr_many(pages), ["30x40", "50x60"])
+        self.assertEqual(worker.ocr_many([]), [])
+
+
+def _words(*rows):
+    """pdfplumber-style words from (top, [(x0, text), ...]) rows; each character is 5pt wide"""
+    return [
+        {"text": text, "x0": x0, "x1": x0 + 5 * len(text), "top": top, "bottom": top + 10}
+        for top, cells in rows
+        for x0, text in cells
+    ]
+
+
+def _image_size(image):
+    """WxH of a PIL image or an OpenCV array"""
+    if isinstance(image, Image.Image):
+        return "%dx%d" % image.size
+    return "%dx%d" % (image.shape[1], image.shape[0])
+
+
+class OcrExtractorTests(TempDirMixin, SimpleTestCase):
+    """The OCR extractor with the Tesseract pool replaced by one that reads every image as its size"""
+
+    def setUp(self):
+        super().setUp()
+        self.ocr_batches = []
+
+        def ocr_many(images):
+            self.ocr_batches.append(len(images))
+            return [_image_size(image) for image in images]
+
+        patcher = mock.patch.object(file_reader, "_ocr_engine", lambda: SimpleNamespace(ocr_many=ocr_many))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.extractor = file_reader.DocumentExtractor(preprocessor=False)
+
+    def image(self, name, size):
+        path = os.path.join(self.tmp, name)
+        Image.new("RGB", size, "white").save(path)
+        return path
+
+    def fake_pdf(self, texts):
+        """A PDF whose text layer reads as texts (an exception is raised by that page), with blank 100x(100+n) scans"""
+        path = os.path.join(self.tmp, "scan.pdf")
+        with open(path, "wb") as handle:
+            handle.write(b"%PDF-1.4\n%%EOF\n")
+
+        def extract_text(text):
+            if isinstance(text, Exception):
+                raise text
+            return text
+
+        pdf = SimpleNamespace(pages=[SimpleNamespace(extract_text=lambda text=text: extract_text(text)) for text in texts])
+
+        @contextmanager
+        def open_pdf(pdf_path):
+            yield pdf
+
+        def iter_pages(pdf_path, dpi=200, page_numbers=None, max_memory_mb=None):
+            for page_num in page_numbers:
+                yield page_num, Image.new("L", (100, 100 + page_num), 255)
+
+        for name, replacement in [("open_pdf", open_pdf), ("iter_pages", iter_pages)]:
+            patcher = mock.patch.object(file_reader, name, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        events = mock.patch.object(file_reader.progress, "page_done")
+        self.page_done = events.start()
+        self.addCleanup(events.stop)
+        return path
+
+    def test_only_pages_without_enough_text_are_ocred(self):
+        path = self.fake_pdf(["Invoice 42 from Example Ltd", "", "short", "Total due 100.00 EUR, thank you"])
+        pages = file_reader.DocumentExtractor(preprocessor=False, min_text_chars=20).process_file(path)
+        self.assertEqual([(page["page"], page["source"]) for page in pages],
+                         [(1, "text"), (2, "ocr"), (3, "ocr"), (4, "text")])
+        self.assertEqual(pages[1]["text"], "100x102")
+        # Pages 2 and 3 are consecutive, so they are OCRed as one batch
+        self.assertEqual(self.ocr_batches, [2])
+        self.assertEqual(sorted(call.args[0] for call in self.page_done.call_args_list), [1, 2, 3, 4])
+
+    def test_unreadable_text_layer_falls_back_only_for_pages_not_yet_reported(self):
+        from pdfminer.pdfparser import PDFSyntaxError
+        path = self.fake_pdf(["Invoice 42 from Example Ltd", "", PDFSyntaxError("broken xref"), "Total due 100.00 EUR"])
+        with self.assertLogs("module_data_extraction", "WARNING"):
+            pages = file_reader.DocumentExtractor(preprocessor=False).process_file(path)
+        self.assertEqual([(page["page"], page["source"]) for page in pages],
+                         [(1, "text"), (2, "ocr"), (3, "ocr"), (4, "ocr")])
+        # Every page is reported exactly once
+        self.assertEqual(sorted(call.args[0] for call in self.page_done.call_args_list), [1, 2, 3, 4])
+
+    def test_other_errors_are_not_mistaken_for_a_bad_text_layer(self):
+        path = self.fake_pdf([KeyError("bug")])
+        with self.assertRaises(KeyError):
+            file_reader.DocumentExtractor(preprocessor=False).process_file(path)
+
+    def test_page_ranges_group_consecutive_pages_up_to_the_chunk_size(self):
+        extractor = file_reader.DocumentExtractor(ocr_chunk_size=2)
+        self.assertEqual(extractor._page_ranges([9, 1, 2, 3, 5, 6]), [(1, 2), (3, 3), (5, 6), (9, 9)])
+        self.assertEqual(file_reader.DocumentExtractor(ocr_chunk_size=0)._page_ranges([1, 2]), [(1, 1), (2, 2)])
+        self.assertEqual(extractor._page_ranges([]), [])
+
+    def test_every_tiff_frame_is_read_in_order(self):
+        path = os.path.join(self.tmp, "fax.tiff")
+        frames = [Image.new("L", (300 + page, 400), 255) for page in range(1, 4)]
+        frames[0].save(path, save_all=True, append_images=frames[1:], dpi=(200, 200))
+        timings = []
+        pages = file_reader.DocumentExtractor(preprocessor=False, ocr_chunk_size=2).process_file(path, page_timings=timings)
+        self.assertEqual(pages, [{"page": page, "text": f"{300 + page}x400", "source": "ocr"} for page in (1, 2, 3)])
+        self.assertEqual(self.ocr_batches, [2, 1])
+        self.assertEqual([entry["page"] for entry in timings], [1, 2, 3])
+
+    def test_page_timings_belong_to_the_call(self):
+        timings = {"small": [], "large": []}
+        threads = [
+            threading.Thread(target=self.extractor.process_file, args=(self.image("small.png", (300, 200)),),
+                             kwargs={"page_timings": timings["small"]}),
+            threading.Thread(target=self.extractor.process_file, args=(self.image("large.png", (600, 400)),),
+                             kwargs={"page_timings": timings["large"]}),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for collected in timings.values():
+            self.assertEqual([entry["page"] for entry in collected], [1])
+            self.assertIn("ocr_seconds", collected[0])
+        self.assertFalse(hasattr(self.extractor, "page_timings"))
+        self.assertEqual(self.extractor.process_file(self.image("plain.png", (300, 200))),
+                         [{"page": 1, "text": "300x200", "source": "ocr"}])
+
+
+class RasterizerTests(TempDirMixin, SimpleTestCase):
+    """Windowed rasterizing with pdfinfo and the poppler render mocked out"""
+
+    def setUp(self):
+        super().setUp()
+        self.pdf = os.path.join(self.tmp, "letter.pdf")
+        with open(self.pdf, "wb") as handle:
+            handle.write(b"%PDF-1.4\n%%EOF\n")
+        self.info = {"Pages": 10, "Page size": "612 x 792 pts (letter)"}
+        self.renders = []
+
+        def convert_from_path(pdf_path, dpi, first_page, last_page, fmt):
+            self.renders.append((first_page, last_page))
+            return [Image.new("RGB", (10, 10)) for _ in range(first_page, last_page + 1)]
+
+        for name, replacement in [("pdfinfo_from_path", lambda pdf_path: self.info), ("convert_from_path", convert_from_path)]:
+            patcher = mock.patch.object(rasterizer, name, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_window_follows_the_memory_budget(self):
+        # A letter page at 200 dpi is 1700x2200 RGB, about 10.7 MiB
+        self.assertEqual(rasterizer.window_size(self.pdf, 200), 1)
+        self.assertEqual(rasterizer.window_size(self.pdf, 200, max_memory_mb=5), 1)
+        self.assertEqual(rasterizer.window_size(self.pdf, 200, max_memory_mb=32), 2)
+        self.assertEqual(rasterizer.window_size(self.pdf, 200, max_memory_mb=4096), rasterizer.MAX_WINDOW)
+        del self.info["Page size"]
+        self.assertEqual(rasterizer.estimate_page_bytes(self.pdf, 72), 612 * 792 * 3)
+
+    def test_windows_span_consecutive_pages_and_images_are_closed(self):
+        pages = []
+        for page_num, image in rasterizer.iter_pages(self.pdf, page_numbers=[9, 1, 2, 3, 5, 6], max_memory_mb=32):
+            image.getpixel((0, 0))
+            pages.append((page_num, image))
+        self.assertEqual([page_num for page_num, _ in pages], [1, 2, 3, 5, 6, 9])
+        self.assertEqual(self.renders, [(1, 2), (3, 3), (5, 6), (9, 9)])
+        for _, image in pages:
+            with self.assertRaises(ValueError):
+                image.getpixel((0, 0))
+
+    def test_every_page_by_default(self):
+        self.info["Pages"] = 3
+        self.assertEqual([page_num for page_num, _ in rasterizer.iter_pdf_pages(self.pdf)], [1, 2, 3])
+        self.assertEqual(self.renders, [(1, 1), (2, 2), (3, 3)])
+
+    def test_image_frames_come_back_as_greyscale_or_rgb(self):
+        fax = os.path.join(self.tmp, "fax.tiff")
+        frames = [Image.new("1", (8, 8), page % 2) for page in range(3)]
+        frames[0].save(fax, save_all=True, append_images=frames[1:])
+        self.assertEqual(rasterizer.document_page_count(fax), 3)
+        self.assertEqual([(page_num, image.mode) for page_num, image in rasterizer.iter_pages(fax)],
+                         [(1, "L"), (2, "L"), (3, "L")])
+        self.assertEqual([page_num for page_num, _ in rasterizer.iter_pages(fax, page_numbers=[3, 2, 7])], [2, 3])
+
+        animation = os.path.join(self.tmp, "scan.gif")
+        frames = [Image.new("RGB", (8, 8), color) for color in ("red", "blue")]
+        frames[0].save(animation, save_all=True, append_images=frames[1:])
+        self.assertEqual([image.mode for _, image in rasterizer.iter_pages(animation)], ["RGB", "RGB"])
+
+
+class ImagePreprocessorTests(TempDirMixin, SimpleTestCase):
+    def page(self, height=400, width=400):
+        """White greyscale page with seven black text-like bars"""
+        import numpy as np
+        gray = np.full((height, width), 255, np.uint8)
+        for y in range(100, 300, 30):
+            gray[y:y + 8, 60:340] = 0
+        return gray
+
+    def test_stages_run_in_order_and_end_binarized(self):
+        import numpy as np
+        image = Image.fromarray(self.page()).convert("RGB")
+        processed, timings = ImagePreprocessor(crop=True).process(image, source_dpi=300)
+        self.assertEqual(list(timings), ["grayscale", "resize", "denoise", "deskew", "crop", "binarize"])
+        self.assertEqual(processed.ndim, 2)
+        self.assertEqual(set(np.unique(processed)), {0, 255})
+        _, timings = ImagePreprocessor(denoise=False, deskew=False, binarize=False).process(image)
+        self.assertEqual(list(timings), ["grayscale", "resize"])
+
+    def test_resize_only_downscales_to_the_target_dpi(self):
+        preprocessor = ImagePreprocessor(target_dpi=300)
+        self.assertEqual(preprocessor._resize(self.page(400, 200), 600).shape, (200, 100))
+        self.assertEqual(preprocessor._resize(self.page(400, 200), 150).shape, (400, 200))
+        # Without a recorded DPI the long edge is taken as a letter page: 6600px is 600 dpi
+        self.assertEqual(preprocessor._resize(self.page(6600, 400), None).shape, (3300, 200))
+        self.assertEqual(ImagePreprocessor(target_dpi=None)._resize(self.page(400, 200), 600).shape, (400, 200))
+
+    def test_deskew_straightens_small_angles_only(self):
+        import cv2
+        page = self.page()
+        tilted = cv2.warpAffine(page, cv2.getRotationMatrix2D((200, 200), 5, 1.0), (400, 400), borderValue=255)
+        preprocessor = ImagePreprocessor()
+        self.assertAlmostEqual(abs(preprocessor._skew_angle(tilted)), 5, delta=0.5)
+        self.assertLess(abs(preprocessor._skew_angle(preprocessor._deskew(tilted))), 0.5)
+        # A tilt beyond max_skew_angle is more likely a layout than a skew, so it is left alone
+        self.assertIs(ImagePreprocessor(max_skew_angle=2)._deskew(tilted), tilted)
+        blank = page * 0 + 255
+        self.assertEqual(preprocessor._skew_angle(blank), 0.0)
+
+    def test_crop_keeps_a_margin_around_the_ink(self):
+        import numpy as np
+        gray = np.full((200, 200), 255, np.uint8)
+        gray[50:70, 40:60] = 0
+        self.assertEqual(ImagePreprocessor(crop_margin=10)._crop(gray).shape, (40, 40))
+        self.assertEqual(ImagePreprocessor()._crop(gray * 0 + 255).shape, (200, 200))
+
+
+class PostprocessTests(TempDirMixin, SimpleTestCase):
+    def test_amounts_currencies_and_dates_parse_column_wise(self):
+        import pandas as pd
+        amounts = postprocess.parse_amounts(pd.Series(["1,234.56", "$1 234,56", 154.06, "n/a", None]))
+        self.assertEqual(amounts.tolist()[:3], [1234.56, 1234.56, 154.06])
+        self.assertTrue(amounts[3:].isna().all())
+
+        currencies = postprocess.parse_currencies(pd.Series(["eur", None, None, None]),
+                                                  pd.Series(["10.00", "£5.00", "GBP 5.00", "5.00"]))
+        self.assertEqual(currencies.tolist()[:3], ["EUR", "GBP", "GBP"])
+        self.assertTrue(pd.isna(currencies[3]))
+
+        dates = postprocess.parse_dates(pd.Series(["2024-03-01", "03/04/2024", "25/12/2024", "March 5, 2024", "soon"]))
+        self.assertEqual([str(value.date()) for value in dates[:4]], ["2024-03-01", "2024-03-04", "2024-12-25", "2024-03-05"])
+        self.assertTrue(pd.isna(dates[4]))
+
+    def test_one_row_per_line_item_checked_against_the_total(self):
+        key_data = [
+            {"file": "a.pdf", "page": 1, "extracted_info": {
+                "date": "2024-03-01", "vendor_name": "Acme", "invoice_number": "INV-1", "total_amount": "$30.00",
+                "costs": [{"description": "Toner", "amount": "10.00"}, {"description": "Paper", "amount": "20.00"}],
+            }},
+            {"file": "b.pdf", "page": 1, "extracted_info": {"total_amount": "12.00", "costs": [{"amount": "10.00"}]}},
+            {"file": "c.pdf", "page": 1, "extracted_info": {"vendor_name": "No items", "costs": None}},
+            {"file": "d.pdf", "page": 1, "extracted_info": "not json", "note": "Failed to parse as JSON"},
+        ]
+        frame = postprocess.normalize_key_info(key_data)
+        self.assertEqual(frame["file"].tolist(), ["a.pdf", "a.pdf", "b.pdf", "c.pdf", "d.pdf"])
+        self.assertEqual(frame["cost_description"].tolist()[:2], ["Toner", "Paper"])
+        self.assertEqual(frame["currency_code"].tolist()[0], "USD")
+        self.assertEqual(frame["line_items_total"].tolist()[:3], [30.0, 30.0, 10.0])
+        self.assertEqual(frame["totals_match"].tolist()[:3], [True, True, False])
+        # Nothing to compare without line items or a total
+        self.assertTrue(frame["totals_match"][3:].isna().all())
+        self.assertEqual(frame["raw_extracted_info"].tolist()[4], "not json")
+
+    def test_file_column_only_when_known(self):
+        frame = postprocess.normalize_key_info([{"page": 1, "extracted_info": {"total_amount": "1.00", "costs": []}}])
+        self.assertNotIn("file", frame.columns)
+        self.assertEqual(len(frame), 1)
+
+
+class TableExtractionTests(TempDirMixin, SimpleTestCase):
+    def test_header_columns_split_cells_and_join_wrapped_descriptions(self):
+        words = _words(
+            (100, [(50, "Description"), (300, "Qty"), (360, "Unit"), (385, "Price"), (470, "Amount")]),
+            (120, [(50, "Printer"), (90, "paper"), (310, "2"), (395, "4.50"), (480, "9.00")]),
+            (135, [(50, "A4,"), (70, "bright"), (105, "white")]),
+            (150, [(50, "Toner"), (80, "cartridge"), (310, "1"), (390, "61.00"), (475, "61.00")]),
+            (180, [(300, "Subtotal:"), (475, "70.00")]),
+            (195, [(300, "VAT"), (320, "(10%)"), (475, "7.00")]),
+            (210, [(300, "Total"), (330, "due"), (475, "77.00")]),
+            (240, [(50, "Bank"), (80, "transfer"), (475, "12.00")]),
+        )
+        table = tables.extract_table(words)
+        self.assertEqual(table["costs"], [
+            {"description": "Printer paper A4, bright white", "amount": "9.00", "quantity": "2", "unit_price": "4.50"},
+            {"description": "Toner cartridge", "amount": "61.00", "quantity": "1", "unit_price": "61.00"},
+        ])
+        self.assertEqual(table["totals"], {"subtotal": "70.00", "tax": "7.00", "total": "77.00"})
+
+    def test_words_a_little_off_the_baseline_share_a_row(self):
+        words = _words((100, [(50, "Widget")]), (102, [(100, "10.00")]), (120, [(50, "Gadget")]))
+        self.assertEqual([[word["text"] for word in row] for row in tables.group_rows(words)],
+                         [["Widget", "10.00"], ["Gadget"]])
+
+    def test_headerless_rows_need_a_trailing_money_amount(self):
+        words = _words(
+            (100, [(50, "Invoice"), (100, "date"), (150, "01.03")]),
+            (120, [(50, "Acme"), (90, "Street"), (150, "90210")]),
+            (140, [(50, "Consulting"), (300, "3"), (400, "120.00"), (480, "360.00")]),
+            (160, [(50, "Travel"), (480, "(45.50)")]),
+        )
+        self.assertEqual(tables.extract_table(words)["costs"], [
+            {"description": "Consulting", "amount": "360.00", "quantity": "3", "unit_price": "120.00"},
+            {"description": "Travel", "amount": "(45.50)"},
+        ])
+
+    def test_text_layer_pdf(self):
+        path = os.path.join(self.tmp, "invoice.pdf")
+        benchmark.write_text_pdf(path, [
+            ["Invoice INV-1001", "Printer paper A4 2 4.50 9.00"],
+            ["Toner cartridge 1 61.00 61.00", "Subtotal 70.00", "Tax 7.00", "Total 77.00", "Thank you 12.00"],
+        ])
+        table = tables.extract_pdf_tables(path)
+        self.assertEqual([(item["description"], item["amount"]) for item in table["costs"]],
+                         [("Printer paper A4", "9.00"), ("Toner cartridge", "61.00")])
+        self.assertEqual(table["totals"], {"subtotal": "70.00", "tax": "7.00", "total": "77.00"})
+
+
+class ResultCacheTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.now = 1000.0
+        patcher = mock.patch.object(result_cache.time, "time", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.cache = result_cache.ResultCache(os.path.join(self.tmp, "results.sqlite3"), ttl_seconds=60, max_entries=3)
+
+    def test_default_path_comes_from_the_environment(self):
+        self.assertEqual(result_cache.ResultCache().path, os.path.join(self.tmp, "cache.sqlite3"))
+
+    def test_round_trip_and_counters(self):
+        self.assertIsNone(self.cache.get("abc", "vision", "v1", page=1))
+        self.cache.set("abc", "vision", "v1", {"total": "70.00"}, page=1)
+        self.assertEqual(self.cache.get("abc", "vision", "v1", page=1), {"total": "70.00"})
+        self.assertIsNone(self.cache.get("abc", "vision", "v1", page=2))
+        self.assertEqual(self.cache.stats(), {"hits": 1, "misses": 2, "hit_rate": 0.3333, "entries": 1})
+
+    def test_new_schema_version_misses(self):
+        self.cache.set("abc", "vision", "v1", {"total": "70.00"})
+        self.assertIsNone(self.cache.get("abc", "vision", "v2"))
+        self.assertIsNone(self.cache.get("abc", "documentai", "v1"))
+        self.assertEqual(self.cache.get("abc", "vision", "v1"), {"total": "70.00"})
+
+    def test_entries_expire_after_the_ttl(self):
+        self.cache.set("abc", "vision", "v1", [1])
+        self.now += 59
+        self.assertEqual(self.cache.get("abc", "vision", "v1"), [1])
+        self.now += 2
+        self.assertIsNone(self.cache.get("abc", "vision", "v1"))
+        self.assertEqual(self.cache.stats()["entries"], 0)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        for n, file_hash in enumerate(["a", "b", "c"]):
+            self.now += 1
+            self.cache.set(file_hash, "vision", "v1", n)
+        self.now += 1
+        self.cache.get("a", "vision", "v1")
+        self.now += 1
+        self.cache.set("d", "vision", "v1", 3)
+        self.assertEqual(self.cache.stats()["entries"], 3)
+        self.assertIsNone(self.cache.get("b", "vision", "v1"))
+        self.assertEqual([self.cache.get(file_hash, "vision", "v1") for file_hash in "acd"], [0, 2, 3])
+
+    def test_invalidate(self):
+        for file_hash, engine in [("a", "vision"), ("a", "documentai"), ("b", "vision")]:
+            self.cache.set(file_hash, engine, "v1", {})
+        self.assertEqual(self.cache.invalidate(file_hash="a", engine="vision"), 1)
+        self.assertEqual(self.cache.invalidate(file_hash="a"), 1)
+        self.assertEqual(self.cache.invalidate(), 1)
+
+    def test_file_sha256(self):
+        path = os.path.join(self.tmp, "a.pdf")
+        with open(path, "wb") as f:
+            f.write(b"%PDF-1.4 a")
+        expected = hashlib.sha256(b"%PDF-1.4 a").hexdigest()
+        self.assertEqual(result_cache.file_sha256(path, chunk_size=3), expected)
+        # A file mapped for the current extraction is not read again
+        with mock.patch.object(documents, "active", return_value=SimpleNamespace(sha256="from-the-handle")):
+            self.assertEqual(result_cache.file_sha256(path), "from-the-handle")
+
+
+class FakeDocumentAIClient:
+    """Answers process_document with the invoice number written in the file; "fail" in the file raises"""
+
+    def __init__(self):
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def process_document(self, request):
+        with self.lock:
+            self.requests.append(request)
+        content = request.raw_document.content
+        if b"fail" in content:
+            raise RuntimeError("processor unavailable")
+        number = content.split(b"INV-")[1][:4].decode()
+        entities = [SimpleNamespace(type_="invoice_id", mention_text=f"INV-{number}"),
+                    SimpleNamespace(type_="total_amount", mention_text=" 70.00 ")]
+        return SimpleNamespace(document=SimpleNamespace(entities=entities, pages=[object()]))
+
+
+class DocumentAIBatchTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.client = FakeDocumentAIClient()
+        self.extractor = InvoiceExtractor(client=self.client, processor_name="projects/p/locations/us/processors/x")
+        self.source = os.path.join(self.tmp, "invoices")
+        os.makedirs(os.path.join(self.source, "march"))
+        for name, content in [("a.pdf", b"%PDF-1.4 INV-0001"), ("march/b.png", b"\x89PNG\r\n\x1a\n INV-0002"),
+                              ("march/scan.dat", b"%PDF-1.4 INV-0003"), ("broken.pdf", b"%PDF-1.4 fail"),
+                              ("notes.txt", b"not an invoice")]:
+            with open(os.path.join(self.source, name), "wb") as f:
+                f.write(content)
+
+    def test_directory_batch_to_jsonl(self):
+        output = os.path.join(self.tmp, "results.jsonl")
+        with self.assertLogs("module_data_extraction", "WARNING"):
+            summary = self.extractor.process_batch(self.source, output, max_workers=3)
+        self.assertEqual(summary, {"processed": 4, "success": 3, "error": 1, "output_path": output})
+        with open(output, encoding="utf-8") as f:
+            records = {os.path.relpath(record["file"], self.source): record for record in map(json.loads, f)}
+        self.assertEqual(sorted(records), ["a.pdf", "broken.pdf", "march/b.png", "march/scan.dat"])
+        self.assertEqual((records["march/scan.dat"]["invoice_id"], records["a.pdf"]["total_cost"]), ("INV-0003", "70.00"))
+        self.assertEqual(records["broken.pdf"]["error_message"], "processor unavailable")
+        self.assertEqual({request.name for request in self.client.requests}, {self.extractor.processor_name})
+        self.assertEqual(sorted(request.raw_document.mime_type for request in self.client.requests),
+                         ["application/pdf", "application/pdf", "application/pdf", "image/png"])
+
+    def test_missing_file_is_an_error_row(self):
+        listed = [os.path.join(self.source, "a.pdf"), os.path.join(self.source, "gone.pdf")]
+        with self.assertLogs("module_data_extraction", "WARNING") as logs:
+            results = dict(self.extractor.iter_batch(listed, max_workers=2))
+        self.assertIn("Cannot read", logs.output[0])
+        self.assertEqual(results[listed[0]]["extraction_status"], "success")
+        self.assertEqual(results[listed[1]]["extraction_status"], "error")
+        self.assertEqual(len(self.client.requests), 1)
+
+    def test_csv_output(self):
+        output = os.path.join(self.tmp, "results.csv")
+        self.extractor.process_batch([os.path.join(self.source, "a.pdf")], output)
+        with open(output, encoding="utf-8") as f:
+            header, row = f.read().splitlines()
+        self.assertEqual(header.split(","), ["file", "total_cost", "invoice_id", "invoice_date", "supplier_name",
+                                             "extraction_status", "error_message"])
+        self.assertIn(",70.00,INV-0001,,,success,", row)
+
+    def test_cached_results_skip_the_processor(self):
+        self.extractor.cache = result_cache.ResultCache(os.path.join(self.tmp, "results.sqlite3"))
+        path = os.path.join(self.source, "a.pdf")
+        first = self.extractor.process_invoice(path)
+        self.assertEqual(self.extractor.process_invoice(path), first)
+        self.assertEqual(len(self.client.requests), 1)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+    def monotonic(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+class RateLimiterTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.clock = FakeClock()
+        for target, attribute, replacement in [(rate_limit.time, "monotonic", self.clock.monotonic),
+                                               (rate_limit.asyncio, "sleep", self.clock.sleep)]:
+            patcher = mock.patch.object(target, attribute, replacement)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_bucket_refills_at_its_rate_up_to_capacity(self):
+        bucket = rate_limit.TokenBucket(60)
+        bucket.consume(60)
+        self.assertEqual(bucket.wait_time(1), 1.0)
+        self.clock.now += 30
+        self.assertEqual(bucket.wait_time(30), 0.0)
+        self.clock.now += 3600
+        bucket.consume(0)
+        self.assertEqual(bucket.tokens, 60)
+
+    def test_requests_beyond_the_limit_wait(self):
+        limiter = rate_limit.AsyncRateLimiter(requests_per_minute=2, tokens_per_minute=100000)
+
+        async def acquire_three():
+            for _ in range(3):
+                await limiter.acquire(10)
+
+        asyncio.run(acquire_three())
+        self.assertEqual(self.clock.slept, [30.0])
+
+    def test_token_budget_and_settling(self):
+        limiter = rate_limit.AsyncRateLimiter(requests_per_minute=1000, tokens_per_minute=600)
+        asyncio.run(limiter.acquire(600))
+        # Only 100 of the 600 reserved tokens were used; the rest go back
+        limiter.settle(600, 100)
+        asyncio.run(limiter.acquire(500))
+        self.assertEqual(self.clock.slept, [])
+        # Using more than reserved is charged too
+        limiter.settle(0, 60)
+        asyncio.run(limiter.acquire(60))
+        self.assertEqual(self.clock.slept, [12.0])
+
+    def test_backoff_is_jittered_and_capped(self):
+        for attempt in range(10):
+            delay = rate_limit.backoff_delay(attempt, base=1.0, cap=8.0)
+            self.assertGreaterEqual(delay, 0)
+            self.assertLessEqual(delay, min(8.0, 2 ** attempt))
+
+    def test_retry_after_in_seconds_or_as_a_date_is_clamped(self):
+        with mock.patch.object(rate_limit.time, "time", return_value=1445412480.0):
+            self.assertEqual(rate_limit.retry_after_delay("2.5"), 2.5)
+            self.assertEqual(rate_limit.retry_after_delay("Wed, 21 Oct 2015 07:28:30 GMT"), 30.0)
+            self.assertEqual(rate_limit.retry_after_delay("Wed, 21 Oct 2015 09:28:00 GMT"), rate_limit.MAX_BACKOFF_SECONDS)
+            self.assertEqual(rate_limit.retry_after_delay("Wed, 21 Oct 2015 07:00:00 GMT"), 0.0)
+        self.assertEqual(rate_limit.retry_after_delay("86400", cap=10.0), 10.0)
+        self.assertIsNone(rate_limit.retry_after_delay("soon"))
+        self.assertIsNone(rate_limit.retry_after_delay(None))
+
+    def vision_call(self, *responses):
+        """Run one async page call against a client that raises or returns each response in turn"""
+        responses = list(responses)
+
+        async def create(**kwargs):
+            response = responses.pop(0)
+            if isinstance(response, Exception):
+                raise response
+            return response
+
+        client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+        limiter = rate_limit.AsyncRateLimiter(requests_per_minute=1000, tokens_per_minute=100000)
+        with mock.patch.dict(os.environ, {"OPENAI_API_KEY": "stub"}):
+            extractor = DocumentExtractor(max_retries=2)
+        payload = {"base64": "", "mime_type": "image/png", "detail": "low"}
+        with mock.patch.object(limiter, "settle", wraps=limiter.settle) as settle:
+            result = asyncio.run(extractor._extract_key_info_async(client, payload, 1, limiter))
+        return result, settle
+
+    def test_http_date_retry_after_is_honoured(self):
+        class RateLimited(Exception):
+            response = SimpleNamespace(headers={"retry-after": "Wed, 21 Oct 2015 07:28:30 GMT"})
+
+        answer = SimpleNamespace(usage=None, choices=[SimpleNamespace(message=SimpleNamespace(content='{"total_amount": "5"}'))])
+        with mock.patch.object(rate_limit.time, "time", return_value=1445412480.0), \
+                mock.patch.object(file_reader_gen_ai, "retryable_errors", return_value=(RateLimited,)):
+            result, _ = self.vision_call(RateLimited("slow down"), answer)
+        self.assertEqual(result["extracted_info"], {"total_amount": "5"})
+        self.assertEqual(self.clock.slept, [30.0])
+
+    def test_response_without_usage_settles_the_estimate(self):
+        answer = SimpleNamespace(usage=None, choices=[SimpleNamespace(message=SimpleNamespace(content="{}"))])
+        _, settle = self.vision_call(answer)
+        estimate = file_reader_gen_ai.ESTIMATED_INPUT_TOKENS + file_reader_gen_ai.MAX_TOKENS
+        settle.assert_called_once_with(estimate, estimate)
+
+
+class StubOpenAIHandler(BaseHTTPRequestHandler):
+    """Answers every chat completion with the number of images it was sent"""
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        images = [part for part in body["messages"][0]["content"] if part["type"] == "image_url"]
+        self.server.requests += 1
+        payload = json.dumps({
+            "id": "chatcmpl-stub", "object": "chat.completion", "created": 0, "model": body["model"],
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {
+                "role": "assistant", "content": json.dumps({"vendor_name": "Stub Ltd", "images": len(images)}),
+            }}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+        }).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+
+class VisionStubServerTests(TempDirMixin, SimpleTestCase):
+    """The vision extractor against a local HTTP stub, through OPENAI_BASE_URL"""
+
+    def setUp(self):
+        super().setUp()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), StubOpenAIHandler)
+        self.server.requests = 0
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        environment = mock.patch.dict(os.environ, {
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{self.server.server_address[1]}/v1",
+            "OPENAI_API_KEY": "stub",
+        })
+        environment.start()
+        self.addCleanup(environment.stop)
+
+        self.tiff = os.path.join(self.tmp, "fax.tiff")
+        frames = [Image.new("RGB", (400, 500), (255, 255, shade)) for shade in (0, 100, 200)]
+        frames[0].save(self.tiff, save_all=True, append_images=frames[1:])
+
+    def test_concurrent_pages_come_back_in_order_with_per_call_stats(self):
+        extractor = DocumentExtractor(max_concurrency=3)
+        stats = []
+        results = extractor.extract_key_info(self.tiff, payload_stats=stats)
+        self.assertEqual([result["page"] for result in results], [1, 2, 3])
+        self.assertEqual(results[0]["extracted_info"]["vendor_name"], "Stub Ltd")
+        self.assertEqual(sorted(entry["page"] for entry in stats), [1, 2, 3])
+        self.assertEqual(self.server.requests, 3)
+        self.assertFalse(hasattr(extractor, "payload_stats"))
+        self.assertFalse(hasattr(extractor, "async_client"))
+
+    def test_sequential_client(self):
+        results = DocumentExtractor(max_concurrency=1).extract_key_info(self.tiff)
+        self.assertEqual(len(results), 3)
+
+    def test_sync_call_from_inside_a_running_loop(self):
+        extractor = DocumentExtractor(max_concurrency=2)
+        stats = []
+
+        async def view():
+            return extractor.extract_key_info(self.tiff, payload_stats=stats)
+
+        results = asyncio.run(view())
+        self.assertEqual(len(results), 3)
+        self.assertEqual(len(stats), 3)
+
+    def test_async_callers_await_the_coroutine(self):
+        results = asyncio.run(DocumentExtractor(max_concurrency=2).aextract_key_info_from_pdf(self.tiff))
+        self.assertEqual(len(results), 3)
+
+    def test_a_failed_page_cancels_the_rest_before_the_client_closes(self):
+        cancelled, seen_at_close = set(), []
+
+        async def extract(client, payload, page_num, limiter):
+            if page_num == 1:
+                raise RuntimeError("boom")
+            try:
+                await asyncio.Event().wait()
+            except asyncio.CancelledError:
+                cancelled.add(page_num)
+                raise
+
+        class FakeAsyncClient:
+            def __init__(self, **kwargs):
+                pass
+
+            async def close(self):
+                seen_at_close.append(set(cancelled))
+
+        extractor = DocumentExtractor(max_concurrency=3)
+        with mock.patch("openai.AsyncOpenAI", FakeAsyncClient), \
+                mock.patch.object(extractor, "_extract_key_info_async", extract), \
+                self.assertLogs("module_data_extraction", "ERROR"):
+            results = asyncio.run(extractor.aextract_key_info_from_pdf(self.tiff))
+        self.assertEqual(results, [])
+        self.assertEqual(seen_at_close, [{2, 3}])
+
+    def test_calls_sharing_an_extractor_keep_their_stats_apart(self):
+        extractor = DocumentExtractor(max_concurrency=2)
+        single = os.path.join(self.tmp, "receipt.png")
+        Image.new("RGB", (300, 300), "white").save(single)
+        stats = {"fax": [], "receipt": []}
+        threads = [
+            threading.Thread(target=extractor.extract_key_info, args=(self.tiff,), kwargs={"payload_stats": stats["fax"]}),
+            threading.Thread(target=extractor.extract_key_info, args=(single,), kwargs={"payload_stats": stats["receipt"]}),
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(stats["fax"]), 3)
+        self.assertEqual(len(stats["receipt"]), 1)
+
+
+class FakeChatClient:
+    """Records the prompt and image count of every chat completion and answers with answer(prompt, images)"""
+
+    def __init__(self, answer):
+        self.answer = answer
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    def create(self, **kwargs):
+        content = kwargs["messages"][0]["content"]
+        prompt, images = content[0]["text"], sum(part["type"] == "image_url" for part in content)
+        self.requests.append((prompt, images))
+        message = SimpleNamespace(content=json.dumps(self.answer(prompt, images)))
+        return SimpleNamespace(usage=None, choices=[SimpleNamespace(message=message)])
+
+
+class VisionEncodingTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        with mock.patch.dict(os.environ, {"OPENAI_API_KEY": "stub"}):
+            self.extractor = DocumentExtractor()
+
+    def encode(self, image):
+        stats = []
+        with file_reader_gen_ai.collecting_payload_stats(stats):
+            payload = self.extractor._encode_image_to_base64(image)
+        decoded = Image.open(BytesIO(base64.b64decode(payload["base64"])))
+        return payload, decoded, stats[0]
+
+    def photo(self, width, height):
+        import numpy as np
+        pixels = np.random.default_rng(0).integers(0, 256, (height, width, 3), dtype=np.uint8)
+        return Image.fromarray(pixels)
+
+    def test_large_photo_is_shrunk_to_the_high_detail_size_as_jpeg(self):
+        payload, decoded, stats = self.encode(self.photo(4000, 3000))
+        # Short side 768 wins over long side 2048
+        self.assertEqual(decoded.size, (1024, 768))
+        self.assertEqual((payload["mime_type"], payload["detail"], decoded.mode), ("image/jpeg", "high", "RGB"))
+        self.assertEqual((stats["format"], stats["width"], stats["height"]), ("JPEG", 1024, 768))
+
+    def test_long_side_limit(self):
+        _, decoded, _ = self.encode(self.photo(3000, 600))
+        self.assertEqual(decoded.size, (2048, 410))
+
+    def test_small_text_page_is_low_detail_greyscale_png(self):
+        page = Image.new("RGB", (500, 400), "white")
+        page.paste((0, 0, 0), (50, 50, 450, 80))
+        payload, decoded, stats = self.encode(page)
+        self.assertEqual(decoded.size, (500, 400))
+        self.assertEqual((payload["mime_type"], payload["detail"], decoded.mode), ("image/png", "low", "L"))
+        self.assertEqual(stats["bytes"], len(base64.b64decode(payload["base64"])))
+
+    def test_only_images_within_one_tile_are_low_detail(self):
+        payload, _, _ = self.encode(self.photo(513, 300))
+        self.assertEqual(payload["detail"], "high")
+
+
+class VisionDocumentModeTests(TempDirMixin, SimpleTestCase):
+    def setUp(self):
+        super().setUp()
+        self.path = os.path.join(self.tmp, "statement.tiff")
+        frames = [Image.new("RGB", (850, 1100), (255, 255, 255 - page)) for page in range(6)]
+        frames[0].save(self.path, save_all=True, append_images=frames[1:])
+
+    def test_header_pages_then_grouped_line_items_merge_into_one_record(self):
+        def answer(prompt, images):
+            if prompt == file_reader_gen_ai.KEY_INFO_PROMPT:
+                # The invoice number is only on the second page, so it is read with the full prompt too
+                header = {"vendor_name": "Acme Office Goods", "date": "2024-03-01", "currency": "USD",
+                          "costs": [{"description": "Header item", "amount": "1.00"}]}
+                if len(client.requests) == 2:
+                    header = {"invoice_number": "INV-7", "total_amount": "5.00"}
+                return header
+            pages = prompt.split("continuation pages ")[1].split(" of one invoice")[0]
+            result = {"costs": [{"description": f"pages {pages}", "amount": "2.00"}]}
+            if pages == "6":
+                result["total_amount"] = "99.00"
+            return result
+
+        client = FakeChatClient(answer)
+        with mock.patch.dict(os.environ, {"OPENAI_API_KEY": "stub"}):
+            extractor = DocumentExtractor(document_mode=True, pages_per_request=3)
+        extractor.client = client
+        [result] = extractor.extract_key_info(self.path)
+
+        self.assertEqual([images for _, images in client.requests], [1, 1, 3, 1])
+        self.assertIn("continuation pages 3, 4, 5 ", client.requests[2][0])
+        self.assertEqual((result["pages"], result["requests"]), (6, 4))
+        record = result["extracted_info"]
+        self.assertEqual((record["vendor_name"], record["invoice_number"], record["date"]),
+                         ("Acme Office Goods", "INV-7", "2024-03-01"))
+        self.assertEqual([cost["description"] for cost in record["costs"]],
+                         ["Header item", "pages 3, 4, 5", "pages 6"])
+        # The last total found closes the invoice
+        self.assertEqual((record["total_amount"], record["currency"]), ("99.00", "USD"))
+
+
+class DocumentHandleTests(TempDirMixin, SimpleTestCase):
+    def write(self, name, content):
+        path = os.path.join(self.tmp, name)
+        with open(path, "wb") as f:
+            f.write(content)
+        return path
+
+    def test_hash_is_computed_once_and_only_when_asked_for(self):
+        content = b"%PDF-1.4 " + os.urandom(3 * documents.HASH_BLOCK_SIZE)
+        path = self.write("invoice.pdf", content)
+        expected = hashlib.sha256(content).hexdigest()
+        with mock.patch.object(documents.hashlib, "sha256", wraps=hashlib.sha256) as sha256:
+            with documents.open_document(path) as handle:
+                self.assertEqual(handle.mime_type, "application/pdf")
+                self.assertEqual(sha256.call_count, 0)
+                self.assertEqual(handle.sha256, expected)
+                self.assertEqual(handle.sha256, expected)
+                self.assertEqual(sha256.call_count, 1)
+
+    def test_empty_file(self):
+        with documents.open_document(self.write("empty.pdf", b"")) as handle:
+            self.assertEqual(handle.sha256, hashlib.sha256(b"").hexdigest())
+            self.assertEqual(handle.read_bytes(), b"")
+
+    def test_sharing_hands_out_one_handle(self):
+        path = self.write("invoice.pdf", b"%PDF-1.4 shared")
+        with documents.sharing(path) as shared:
+            with documents.open_document(path) as first, documents.open_document(os.path.join(self.tmp, ".", "invoice.pdf")) as second:
+                self.assertIs(first, shared)
+                self.assertIs(second, shared)
+        self.assertIsNone(documents.active(path))
+
+    def test_kind_follows_content_not_extension(self):
+        self.assertEqual(documents.document_kind(self.write("scan.pdf", b"\x89PNG\r\n\x1a\n....")), documents.IMAGE)
+        self.assertEqual(documents.document_kind(self.write("fax.dat", b"II*\x00....")), documents.IMAGE)
+        self.assertEqual(documents.document_kind(self.write("upload", b"junk%PDF-1.7")), documents.PDF)
+        self.assertIsNone(documents.document_kind(self.write("notes.bin", b"hello")))